@@ -0,0 +1,206 @@
+"""Benchmarks CachedAMDA and the Pyramid views against a local fake AMDA server.
+
+Examples:
+    python bench/bench_cache.py --target amda --pattern pan zoom random multi --latency 0.05
+    python bench/bench_cache.py --target views --cadence 0.5 --window 2 --requests 100
+    python bench/bench_cache.py --index-scaling 100 1000 10000
+"""
+import argparse
+import json
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+from sciqlopcache.cache import Cache, CacheEntry
+from sciqlopcache.cached_amda import CachedAMDA
+from sciqlopcache.datetime_range import DateTimeRange
+from sciqlopcache.fake_amda import FakeAMDA
+
+ORIGIN = datetime(2010, 1, 1)
+
+
+def pan(count, window, seed=0):
+    start = ORIGIN + timedelta(days=seed)
+    return [(start + i * window / 4, start + i * window / 4 + window) for i in range(count)]
+
+
+def zoom(count, window, seed=0):
+    center = ORIGIN + timedelta(days=seed) + window * 8
+    levels = [2 ** k for k in range(-3, 4)]
+    levels += levels[-2:0:-1]
+    return [(center - window * levels[i % len(levels)] / 2, center + window * levels[i % len(levels)] / 2)
+            for i in range(count)]
+
+
+def random_windows(count, window, seed=0):
+    rng = random.Random(seed)
+    span = window * 100
+    starts = [ORIGIN + span * rng.random() for _ in range(count)]
+    return [(start, start + window) for start in starts]
+
+
+PATTERNS = {'pan': pan, 'zoom': zoom, 'random': random_windows}
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100. * (len(ordered) - 1))))]
+
+
+class AmdaClient:
+    def __init__(self, fake, data_folder):
+        self.amda = CachedAMDA(server_url=fake.url, data_folder=data_folder)
+        self.amda._unpack_inventory(fake.inventory())
+
+    def get(self, start, stop, parameter_id):
+        return self.amda.get_parameter(start, stop, parameter_id)
+
+    def close(self):
+        self.amda._save()
+        return self.amda
+
+
+class ViewsClient:
+    def __init__(self, fake, data_folder):
+        from webtest import TestApp
+        from sciqlopcache import main
+        self.app = main({}, amda_cache_folder=data_folder, amda_server_url=fake.url)
+        self.app.registry.amda._unpack_inventory(fake.inventory())
+        self.testapp = TestApp(self.app)
+
+    def get(self, start, stop, parameter_id):
+        res = self.testapp.get('/php/rest/getParameter.php', params={
+            'startTime': start.isoformat(), 'stopTime': stop.isoformat(), 'parameterID': parameter_id})
+        url = json.loads(res.text)['dataFileURLs']
+        return self.testapp.get(urlsplit(url).path).body
+
+    def close(self):
+        # the registry would keep CachedAMDA alive, and saving, after its folder is removed
+        amda = self.app.registry.amda
+        del self.app.registry.amda
+        amda._save()
+        return amda
+
+
+def run_pattern(args, fake, pattern):
+    data_folder = tempfile.mkdtemp()
+    client = (AmdaClient if args.target == 'amda' else ViewsClient)(fake, data_folder)
+    window = timedelta(hours=args.window)
+    clients = args.clients if pattern == 'multi' else 1
+    generator = PATTERNS['pan' if pattern == 'multi' else pattern]
+    workloads = [generator(args.requests, window, seed=i) for i in range(clients)]
+    latencies = []
+    lock = threading.Lock()
+    upstream_before = dict(fake.requests)
+
+    def run(workload):
+        for start, stop in workload:
+            t0 = time.perf_counter()
+            client.get(start, stop, fake.parameters[0])
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(workload,)) for workload in workloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t_start
+    peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+    amda = client.close()
+    entries = sum(len(amda.cache[p]) for p in amda.cache)
+    del client, amda
+    shutil.rmtree(data_folder)
+    return {
+        'target': args.target, 'pattern': pattern, 'clients': clients, 'requests': len(latencies),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': 1000 * statistics.median(latencies), 'p99_ms': 1000 * percentile(latencies, 99),
+        'upstream_requests': fake.requests['getParameter'] - upstream_before['getParameter'],
+        'cache_entries': entries,
+        'traced_peak_mb': peak / 2 ** 20 if peak is not None else None,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def index_scaling(sizes, lookups=200):
+    results = []
+    for size in sizes:
+        folder = tempfile.mkdtemp()
+        cache = Cache(folder + '/db.json')
+        for i in range(size):
+            start = ORIGIN + timedelta(hours=2 * i)
+            cache.add_entry('p', CacheEntry(DateTimeRange(start, start + timedelta(hours=1)), f'file{i}'))
+        span = DateTimeRange(ORIGIN, ORIGIN + timedelta(hours=2 * size))
+        rng = random.Random(0)
+        t0 = time.perf_counter()
+        for _ in range(lookups):
+            start = ORIGIN + (span.stop_time - span.start_time) * rng.random()
+            cache.get_missing_ranges('p', DateTimeRange(start, start + timedelta(hours=24)))
+        narrow = (time.perf_counter() - t0) / lookups
+        t0 = time.perf_counter()
+        cache.get_missing_ranges('p', span)
+        full = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        cache._save()
+        save = time.perf_counter() - t0
+        shutil.rmtree(folder)
+        results.append({'entries': size, 'missing_24h_ms': 1000 * narrow, 'missing_full_span_ms': 1000 * full,
+                        'save_ms': 1000 * save})
+    return results
+
+
+def print_table(rows, out):
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    print(' '.join(f'{key:>18}' for key in keys), file=out)
+    for row in rows:
+        print(' '.join(f'{row[key]:>18.3f}' if isinstance(row[key], float) else f'{str(row[key]):>18}'
+                       for key in keys), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=('amda', 'views'), default='amda')
+    parser.add_argument('--pattern', nargs='+', choices=('pan', 'zoom', 'random', 'multi'),
+                        default=['pan', 'zoom', 'random', 'multi'])
+    parser.add_argument('--requests', type=int, default=50, help='requests per client')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients of the multi pattern')
+    parser.add_argument('--window', type=float, default=6., help='request width in hours')
+    parser.add_argument('--cadence', type=float, default=4., help='fake data sampling period in seconds')
+    parser.add_argument('--columns', type=int, default=3, help='fake data column count')
+    parser.add_argument('--latency', type=float, default=0., help='fake server latency in seconds per call')
+    parser.add_argument('--tracemalloc', action='store_true', help='report traced peak memory (slower)')
+    parser.add_argument('--index-scaling', type=int, nargs='*', metavar='ENTRIES',
+                        help='only measure index lookup/save time for these entry counts')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(argv)
+
+    if args.index_scaling:
+        results = index_scaling(args.index_scaling)
+    else:
+        fake = FakeAMDA(cadence=timedelta(seconds=args.cadence), columns=args.columns, latency=args.latency)
+        with fake:
+            results = [run_pattern(args, fake, pattern) for pattern in args.pattern]
+    print_table(results, sys.stdout)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,25 @@
 from pyramid.config import Configurator
+from pyramid.settings import aslist
+from .cache import lock_folder
 from .cached_amda import CachedAMDA
+from .views import DATA_ENCODERS
 
 import logging
 log = logging.getLogger(__name__)
 
 
+def data_encodings(settings) -> list:
+    """Content-Encodings offered on the data route, in order of preference, without the unavailable ones"""
+    encodings = []
+    for encoding in aslist(settings.get('data_encodings', '')):
+        try:
+            DATA_ENCODERS[encoding]()
+            encodings.append(encoding)
+        except (KeyError, ImportError) as e:
+            log.warning(f'''Ignoring data encoding {encoding}: {e!r}''')
+    return encodings
+
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
@@ -15,11 +30,16 @@ def main(global_config, **settings):
     config.add_route('auth', '/php/rest/auth.php')
     config.add_route('getParameter', '/php/rest/getParameter.php')
     config.add_route('data', 'data/*file')
+    config.add_route('metrics', '/metrics')
+    config.add_route('join', '/join')
+    config.add_route('admin_stats', '/admin/stats')
+    config.add_route('admin_action', '/admin/{action}')
     config.scan()
-    amda_cache_folder = settings.get('amda_cache_folder','/tmp/amdacache')
-    log.debug(f'''amda_cache_folder is {amda_cache_folder}''')
-    config.registry.amda = CachedAMDA(data_folder=amda_cache_folder)
+    config.registry.amda = CachedAMDA.from_settings(settings)
+    # keeps offline tools (prefill) from rewriting the index under the server
+    config.registry.cache_lock = lock_folder(config.registry.amda.data_folder)
     config.registry.tmp_files = []
+    config.registry.data_encodings = data_encodings(settings)
     retval = config.make_wsgi_app()
     config.registry.amda._save()
     return retval
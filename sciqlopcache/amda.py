@@ -1,6 +1,7 @@
 import os
+import re
 import sys
-from typing import Optional
+from typing import List, Optional
 
 import jsonpickle
 import requests
@@ -9,6 +10,9 @@ import pandas as pds
 from datetime import datetime, timedelta
 import xmltodict
 from .cache import Cache, CacheEntry, DateTimeRange
+from .chunk_codecs import atomic_write
+from .metrics import Metrics
+from .workers import parse_amda_csv
 import uuid
 import pathlib
 import urllib.request
@@ -19,8 +23,16 @@ log = logging.getLogger(__name__)
 
 class AMDA_soap:
     def __init__(self, server_url="http://amda.irap.omp.eu", WSDL='AMDA/public/wsdl/Methods_AMDA.wsdl', strict=True):
-        self.soap_client = Client(server_url + '/' + WSDL)
         self.server_url = server_url
+        self.WSDL = WSDL
+        self._soap_client = None
+
+    @property
+    def soap_client(self):
+        # the WSDL is only downloaded once SOAP is actually used, REST only setups never need it
+        if self._soap_client is None:
+            self._soap_client = Client(self.server_url + '/' + self.WSDL)
+        return self._soap_client
 
     def get_parameter(self, **kwargs):
         resp = self.soap_client.service.getParameter(**kwargs).__json__()
@@ -99,6 +111,7 @@ class AMDA:
 
     def __init__(self, WSDL='AMDA/public/wsdl/Methods_AMDA.wsdl', server_url="http://amda.irap.omp.eu",
                  inventory_file=None):
+        self.server_url = server_url
         self.METHODS = {
             "REST": AMDA_REST(server_url=server_url),
             "SOAP": AMDA_soap(server_url=server_url, WSDL=WSDL)
@@ -112,6 +125,7 @@ class AMDA:
         self.component = {}
         self.dataCenter = {}
         self.inventory_file = inventory_file
+        self.metrics = Metrics()
         if inventory_file:
             pathlib.Path(os.path.dirname(inventory_file)).mkdir(parents=True, exist_ok=True)
             if os.path.exists(inventory_file):
@@ -120,8 +134,7 @@ class AMDA:
 
     def _save(self):
         if self.inventory_file:
-            with open(self.inventory_file, 'w') as f:
-                f.write(jsonpickle.dumps(self._pack_inventory()))
+            atomic_write(self.inventory_file, jsonpickle.dumps(self._pack_inventory()).encode())
 
     def __del__(self):
         self._save()
@@ -147,7 +160,8 @@ class AMDA:
         AMDA.ObsDataTreeParser.extrac_all(tree, storage)
 
     def get_token(self, method="SOAP", **kwargs):
-        return self.METHODS[method.upper()].get_token()
+        with self.metrics.timer('token'):
+            return self.METHODS[method.upper()].get_token()
 
     def _get_parameter_url(self, start_time, stop_time, parameter_id, method="REST", **kwargs):
         token = self.get_token()
@@ -155,8 +169,9 @@ class AMDA:
             start_time = start_time.isoformat()
         if type(stop_time) is datetime:
             stop_time = stop_time.isoformat()
-        url = self.METHODS[method.upper()].get_parameter(
-            startTime=start_time, stopTime=stop_time, parameterID=parameter_id, token=token, **kwargs)
+        with self.metrics.timer('get_parameter'):
+            url = self.METHODS[method.upper()].get_parameter(
+                startTime=start_time, stopTime=stop_time, parameterID=parameter_id, token=token, **kwargs)
         return url
 
     def _get_header_(self, parameter_id, method="REST", **kwargs):
@@ -170,10 +185,10 @@ class AMDA:
     def get_parameter(self, start_time: datetime, stop_time: datetime, parameter_id: str, method: str = "REST",
                       **kwargs) -> Optional[pds.DataFrame]:
         url = self._get_parameter_url(start_time, stop_time, parameter_id, method, **kwargs)
-        if url is not None:
+        if url:
             log.debug(f'Data file URL {url}')
-            return pds.read_csv(url, delim_whitespace=True, comment='#', parse_dates=True, infer_datetime_format=True,
-                                index_col=0, header=None)
+            with self.metrics.timer('download_parse'):
+                return parse_amda_csv(url)
         return None
 
     def get_obs_data_tree(self, method="SOAP") -> dict:
@@ -181,6 +196,25 @@ class AMDA:
             self.METHODS[method.upper()].get_obs_data_tree()).text)
         return datatree
 
+    def find_parameters(self, missions=(), datasets=()) -> List[str]:
+        if not len(self.parameter):
+            self.update_inventory()
+        return [name for name, parameter in self.parameter.items()
+                if parameter.get('mission') in missions or parameter.get('dataset') in datasets]
+
+    def parameter_cadence(self, parameter_id) -> Optional[timedelta]:
+        """Sampling period of parameter_id from the inventory (parameter then dataset), None if unknown"""
+        node = self.parameter.get(parameter_id) or self.component.get(parameter_id)
+        if node is None:
+            return None
+        for source in (node, self.dataset.get(node.get('dataset'), {})):
+            for key in ('sampling', 'minSampling'):
+                if key in source:
+                    cadence = parse_sampling(source[key])
+                    if cadence is not None:
+                        return cadence
+        return None
+
     def parameter_range(self, parameter_id):
         if not len(self.parameter):
             self.update_inventory()
@@ -197,6 +231,15 @@ class AMDA:
             )
 
 
+def parse_sampling(value) -> Optional[timedelta]:
+    """Inventory sampling ('4', '4S', '0.5s', '1M', '3H', '1D'), plain numbers are seconds, M stands for minutes"""
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)\s*([sSmMhHdD]?)\s*', str(value))
+    if match is None:
+        return None
+    unit = {'': 'seconds', 's': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2).lower()]
+    return timedelta(**{unit: float(match.group(1))})
+
+
 def extract_header(content: str) -> str:
     lines = content.split('\n')
     for index, _ in enumerate(lines):
@@ -0,0 +1,135 @@
+"""Shared second level storage for cached chunks, looked up on local misses before asking AMDA.
+
+A backend is a flat key/value store of encoded chunks (see chunk_codecs) with sorted prefix listing. Keys are
+'<quoted product>/<start>_<stop>_<uuid>' so every node can find the chunks of a range from a listing alone and
+concurrent publications never conflict. Keys sort by start time and published chunks span at most MAX_CHUNK_SPAN, so
+finding the chunks of a range only lists the keys starting from MAX_CHUNK_SPAN before it to its end.
+"""
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import quote, urlsplit
+
+from .chunk_codecs import atomic_write
+from .datetime_range import DateTimeRange
+
+_TIME_FORMAT = '%Y%m%dT%H%M%S%f'
+MAX_CHUNK_SPAN = timedelta(days=7)
+
+
+def chunk_key(product: str, dt_range: DateTimeRange) -> str:
+    return f'{quote(product, safe="")}/{dt_range.start_time.strftime(_TIME_FORMAT)}_' \
+           f'{dt_range.stop_time.strftime(_TIME_FORMAT)}_{uuid.uuid4()}'
+
+
+def parse_chunk_key(key: str) -> Optional[DateTimeRange]:
+    try:
+        start, stop, _ = key.rsplit('/', 1)[-1].split('_')
+        return DateTimeRange(datetime.strptime(start, _TIME_FORMAT), datetime.strptime(stop, _TIME_FORMAT))
+    except ValueError:
+        return None
+
+
+class Backend:
+    def scan(self, prefix: str, start_after: str = '') -> Iterator[str]:
+        """Keys starting with prefix and greater than start_after, in order"""
+        raise NotImplementedError()
+
+    def list(self, prefix: str) -> List[str]:
+        return list(self.scan(prefix))
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError()
+
+    def chunks(self, product: str, dt_range: DateTimeRange) -> List[Tuple[DateTimeRange, str]]:
+        """Published chunks of product intersecting dt_range"""
+        prefix = quote(product, safe="") + '/'
+        found = []
+        for key in self.scan(prefix, prefix + (dt_range.start_time - MAX_CHUNK_SPAN).strftime(_TIME_FORMAT)):
+            chunk_range = parse_chunk_key(key)
+            if chunk_range is None:
+                continue
+            if chunk_range.start_time > dt_range.stop_time:
+                break
+            if dt_range.intersect(chunk_range):
+                found.append((chunk_range, key))
+        return found
+
+
+class FolderBackend(Backend):
+    """Shared filesystem path (NFS, CephFS...), writes are atomic renames"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def scan(self, prefix: str, start_after: str = '') -> Iterator[str]:
+        folder = os.path.join(self.path, prefix)
+        if not os.path.isdir(folder):
+            return iter([])
+        return (key for key in sorted(prefix + name for name in os.listdir(folder) if not name.startswith('.'))
+                if key > start_after)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.path, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        fname = os.path.join(self.path, key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        atomic_write(fname, data)
+
+
+class S3Backend(Backend):
+    """S3 compatible object store (AWS, MinIO, Ceph RGW...), needs boto3 unless a client is given"""
+
+    def __init__(self, bucket: str, prefix: str = '', client=None, **client_kwargs):
+        if client is None:
+            import boto3
+            client = boto3.client('s3', **client_kwargs)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def scan(self, prefix: str, start_after: str = '') -> Iterator[str]:
+        # pages are only requested as keys are consumed
+        kwargs = {'Bucket': self.bucket, 'Prefix': self.prefix + prefix}
+        if start_after:
+            kwargs['StartAfter'] = self.prefix + start_after
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            for item in response.get('Contents', []):
+                yield item['Key'][len(self.prefix):]
+            if not response.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+
+def backend_from_url(url: Optional[str], **kwargs) -> Optional[Backend]:
+    """'s3://bucket/prefix' (kwargs go to boto3.client, e.g. endpoint_url) or a folder path / 'file://' URL"""
+    if not url:
+        return None
+    parts = urlsplit(url)
+    if parts.scheme == 's3':
+        return S3Backend(parts.netloc, parts.path, **kwargs)
+    if parts.scheme in ('', 'file'):
+        return FolderBackend(parts.path)
+    raise ValueError(f"Unsupported shared cache URL {url}")
@@ -1,21 +1,83 @@
 import os
+from datetime import datetime
 from pathlib import Path
 from typing import List, Optional
 
 import jsonpickle
-from .datetime_range import DateTimeRange
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows, folders are not locked
+    fcntl = None
+from .backends import Backend
+from .chunk_codecs import atomic_write
+from .datetime_range import DateTimeRange, DateTimeRangeSet
+
+
+# reasons of entries without data (negative entries)
+EMPTY = 'empty'  # upstream answered without data
+ERROR = 'error'  # upstream request failed
+OUT_OF_RANGE = 'out_of_range'  # outside of the dataset range from the inventory
+
+
+class CacheLockedError(RuntimeError):
+    pass
+
+
+def lock_folder(folder: str, exclusive: bool = False):
+    """Locks a cache folder until the returned file is closed: shared by the server processes using it,
+    exclusive for the offline tools rewriting its index, which would otherwise overwrite each other's entries.
+    """
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    lock = open(folder + '/.lock', 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise CacheLockedError(f'{folder} is in use by ' + ('a server or another tool' if exclusive else
+                                                               'an offline tool (prefill...)'))
+    return lock
 
 
 class CacheEntry:
 
     dt_range: DateTimeRange
-    data_file: str
+    data_file: Optional[str]
+    reason: Optional[str]
+    expires: Optional[datetime]
+    codec: str
+    size: Optional[int]
+    checksum: Optional[int]
 
-    __slots__ = ['dt_range', 'data_file']
+    __slots__ = ['dt_range', 'data_file', 'reason', 'expires', 'codec', 'size', 'checksum']
 
-    def __init__(self, dt_range: DateTimeRange, data_file: str):
+    # values of the slots added after the first release, missing from entries loaded from older indexes
+    _DEFAULTS = {'reason': None, 'expires': None, 'codec': 'pickle', 'size': None, 'checksum': None}
+
+    def __init__(self, dt_range: DateTimeRange, data_file: Optional[str], reason: Optional[str] = None,
+                 expires: Optional[datetime] = None, codec: str = 'pickle', size: Optional[int] = None,
+                 checksum: Optional[int] = None):
         self.dt_range = dt_range
         self.data_file = data_file
+        self.reason = reason
+        self.expires = expires
+        self.codec = codec
+        # of the data file, None for entries written before they were recorded
+        self.size = size
+        self.checksum = checksum
+
+    def _fill_defaults(self):
+        for name, value in CacheEntry._DEFAULTS.items():
+            if not hasattr(self, name):
+                setattr(self, name, value)
+
+    @property
+    def is_negative(self) -> bool:
+        return self.data_file is None
+
+    def expired(self, now: Optional[datetime] = None) -> bool:
+        return self.expires is not None and self.expires <= (now or datetime.now())
 
     def __eq__(self, other):
         assert type(other) is CacheEntry
@@ -43,19 +105,35 @@ class CacheEntry:
 
 
 class Cache:
-    __slots__ = ['cache_file', '_data']
+    __slots__ = ['cache_file', 'meta_file', 'backend', '_data', '_meta', '_bounds']
 
-    def __init__(self, cache_file=None):
+    def __init__(self, cache_file=None, backend: Optional[Backend] = None):
         self.cache_file = cache_file or str(Path.home()) + '/.sciqlopcache/db.json'
+        # per product metadata (watermarks, statistics...) lives next to the index to keep db.json format unchanged
+        self.meta_file = os.path.splitext(self.cache_file)[0] + '_meta.json'
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, 'r') as f:
+                self._meta = jsonpickle.loads(f.read())
+        else:
+            self._meta = {}
         if os.path.exists(self.cache_file):
             with open(self.cache_file, 'r') as f:
                 self._data = jsonpickle.loads(f.read())
+            for entries in self._data.values():
+                for entry in entries:
+                    entry._fill_defaults()
         else:
             self._data = {}
+        self._bounds = {}
+        # shared second level store, looked up on local misses and fed with newly fetched chunks
+        self.backend = backend
 
     def _save(self):
-        with open(self.cache_file, 'w') as f:
-            f.write(jsonpickle.dumps(self._data))
+        atomic_write(self.cache_file, jsonpickle.dumps(self._data).encode())
+        atomic_write(self.meta_file, jsonpickle.dumps(self._meta).encode())
+
+    def meta(self, product) -> dict:
+        return self._meta.setdefault(product, {})
 
     def __del__(self):
         pass
@@ -66,24 +144,87 @@ class Cache:
     def __getitem__(self, item):
         return self._data[item]
 
+    def __iter__(self):
+        return iter(self._data)
+
     def add_entry(self, product, entry):
         if product in self._data:
             self._data[product].append(entry)
         else:
             self._data[product] = [entry]
+        self._bounds.pop(product, None)
+
+    def _entries_bounds(self, product):
+        # start/stop/expires arrays aligned with self._data[product], rebuilt lazily after each modification
+        if product not in self._bounds:
+            entries = self._data[product]
+            self._bounds[product] = (
+                np.array([entry.start_time for entry in entries], dtype='datetime64[us]'),
+                np.array([entry.stop_time for entry in entries], dtype='datetime64[us]'),
+                np.array([entry.expires or 'NaT' for entry in entries], dtype='datetime64[us]')
+            )
+        return self._bounds[product]
+
+    def has_entry(self, product, entry: CacheEntry) -> bool:
+        return any(e is entry for e in self._data.get(product, []))
+
+    def replace_entry(self, product, old: CacheEntry, new: CacheEntry) -> bool:
+        """Puts new in place of old, False (and no change) if old is no longer indexed, e.g. evicted or compacted"""
+        entries = self._data.get(product, [])
+        for i, entry in enumerate(entries):
+            if entry is old:
+                entries[i] = new
+                self._bounds.pop(product, None)
+                return True
+        return False
+
+    def last_entry(self, product) -> Optional[CacheEntry]:
+        """Entry with data reaching the latest time"""
+        return max((entry for entry in self._data.get(product, []) if not entry.is_negative),
+                   key=lambda entry: entry.stop_time, default=None)
+
+    def remove_entries(self, product, entries: List[CacheEntry]):
+        if product in self._data:
+            removed = {id(entry) for entry in entries}
+            self._data[product] = [entry for entry in self._data[product] if id(entry) not in removed]
+            self._bounds.pop(product, None)
+
+    def remove_product(self, product) -> List[CacheEntry]:
+        """Forgets every entry and the metadata of product, returns its entries"""
+        self._meta.pop(product, None)
+        self._bounds.pop(product, None)
+        return self._data.pop(product, [])
+
+    def purge_expired(self, product, now: Optional[datetime] = None) -> List[CacheEntry]:
+        """Removes and returns the entries of product whose TTL elapsed"""
+        if product not in self._data:
+            return []
+        expires = self._entries_bounds(product)[2]
+        expired = np.flatnonzero(expires <= np.datetime64(now or datetime.now(), 'us'))
+        if not len(expired):
+            return []
+        entries = [self._data[product][i] for i in expired]
+        self.remove_entries(product, entries)
+        return entries
+
+    def _hit_indexes(self, parameter_id: str, dt_range: DateTimeRange) -> np.ndarray:
+        starts, stops, _ = self._entries_bounds(parameter_id)
+        return np.flatnonzero((stops >= np.datetime64(dt_range.start_time, 'us')) &
+                              (starts <= np.datetime64(dt_range.stop_time, 'us')))
 
     def get_entries(self, parameter_id: str, dt_range: DateTimeRange) -> List[CacheEntry]:
         if parameter_id in self:
-            entries = [entry for entry in self[parameter_id] if dt_range.intersect(entry.dt_range)]
-            #return entries if len(entries) else None
-            return entries
+            entries = self[parameter_id]
+            return [entries[i] for i in self._hit_indexes(parameter_id, dt_range)]
         else:
             return []
 
     def get_missing_ranges(self, parameter_id: str, dt_range: DateTimeRange) -> List[DateTimeRange]:
-        hit_ranges = self.get_entries(parameter_id, dt_range)
-        if hit_ranges:
-            return dt_range - hit_ranges
-        else:
+        if parameter_id not in self:
+            return [dt_range]
+        hits = self._hit_indexes(parameter_id, dt_range)
+        if not len(hits):
             return [dt_range]
+        starts, stops, _ = self._entries_bounds(parameter_id)
+        return (DateTimeRangeSet.from_ranges([dt_range]) - DateTimeRangeSet(starts[hits], stops[hits])).to_ranges()
 
@@ -1,26 +1,133 @@
 from .amda import AMDA, extract_header
 import os
+import io
+from typing import List, Optional, Tuple
 
 import jsonpickle
+import numpy as np
 import pandas as pds
-from datetime import datetime
-from .cache import Cache, CacheEntry
-from .datetime_range import DateTimeRange
+from datetime import datetime, timedelta
+from pyramid.settings import asbool
+from .backends import MAX_CHUNK_SPAN, Backend, backend_from_url, chunk_key
+from .cache import Cache, CacheEntry, EMPTY, ERROR, OUT_OF_RANGE
+from .chunk_codecs import SHARED_CODEC, ChunkError, atomic_write, check_codec, decode_chunk, decode_header, \
+    encode_chunk, read_chunk, write_chunk
+from .datetime_range import DateTimeRange, DateTimeRangeSet
+from .join import check_method, join, join_key, make_grid, margin
+from .scheduler import FetchScheduler
+from .text_chunks import INDEX_SUFFIX, SIDECAR_SUFFIXES, TEXT_SUFFIX, copy_range, render_table, text_range, \
+    write_text_chunk
+from .workers import WorkerPool, fetch_to_chunk, render_chunk
 import uuid
 import pathlib
+import shutil
+import threading
 
 import logging
 log = logging.getLogger(__name__)
 
 
+class UpstreamError(RuntimeError):
+    """Part of the requested range could not be fetched from upstream, it is retried once its error entry expires"""
+    pass
+
+
+def trim_chunk(df: pds.DataFrame, start_time: datetime, stop_time: datetime) -> pds.DataFrame:
+    try:
+        return df[start_time:stop_time]
+    except Exception:
+        log.debug(f'''can't slice dataframe, slice: {start_time}->{stop_time}  | dataframe : {df.index[0]}->{df.index[-1]}''')
+        return df
+
+
+def merge_chunks(chunks: List[pds.DataFrame]) -> Optional[pds.DataFrame]:
+    """Orders already trimmed chunks in time and concatenates them in a single pass."""
+    if not chunks:
+        return None
+    non_empty = sorted((df for df in chunks if len(df)), key=lambda df: df.index[0])
+    if len(non_empty) == 0:
+        return chunks[0]
+    if len(non_empty) == 1:
+        return non_empty[0]
+    return pds.concat(non_empty)
+
+
+def _nbytes(df: pds.DataFrame) -> int:
+    return int(df.memory_usage(index=True).sum())
+
+
+def _chunk_size(entry: CacheEntry) -> int:
+    if entry.size is not None:
+        return entry.size
+    return os.path.getsize(entry.data_file) if os.path.exists(entry.data_file) else 0
+
+
+_GRID_ORIGIN = datetime(1970, 1, 1)
+
+
+def grid_floor(t: datetime, span: timedelta) -> datetime:
+    return _GRID_ORIGIN + ((t - _GRID_ORIGIN) // span) * span
+
+
+def split_on_grid(dt_range: DateTimeRange, span: timedelta) -> List[DateTimeRange]:
+    """Splits dt_range at the multiples of span, so that chunks of the same product line up"""
+    pieces = []
+    start = dt_range.start_time
+    while start < dt_range.stop_time:
+        stop = min(grid_floor(start, span) + span, dt_range.stop_time)
+        pieces.append(DateTimeRange(start, stop))
+        start = stop
+    return pieces
+
+
 class CachedAMDA(AMDA):
     def __init__(self, WSDL='AMDA/public/wsdl/Methods_AMDA.wsdl',
                  server_url="http://amda.irap.omp.eu",
-                 data_folder='/tmp/amdacache'
+                 data_folder='/tmp/amdacache',
+                 error_ttl=timedelta(minutes=1),
+                 empty_ttl=timedelta(minutes=10),
+                 recent_window=timedelta(days=2),
+                 tail_refresh=timedelta(minutes=1),
+                 chunk_codec='pickle',
+                 shared_cache: Optional[Backend] = None,
+                 scheduler: Optional[FetchScheduler] = None,
+                 text_chunks=False,
+                 chunk_target_bytes=0,
+                 chunk_min_span=timedelta(minutes=10),
+                 chunk_max_span=timedelta(days=30),
+                 process_pool_workers=0,
+                 retire_delay=timedelta(minutes=5)
                  ):
         super(CachedAMDA, self).__init__(WSDL, server_url, data_folder + '/amda_inventory.json')
         self.data_folder = data_folder
-        self.cache = Cache(data_folder + '/db.json')
+        # how long a failed upstream request is remembered before being retried
+        self.error_ttl = error_ttl
+        # how long an empty answer about recent data (or past the dataset stop) is trusted
+        self.empty_ttl = empty_ttl
+        # data younger than this may still be filled upstream, empty answers older than this are kept forever
+        self.recent_window = recent_window
+        # minimum delay between two upstream checks for new data past a parameter's watermark
+        self.tail_refresh = tail_refresh
+        check_codec(chunk_codec)
+        # codec of newly written chunks, existing ones keep the codec recorded in their entry
+        self.chunk_codec = chunk_codec
+        self.cache = Cache(data_folder + '/db.json', backend=shared_cache)
+        # splits, throttles and retries upstream requests, shared by every request to this instance
+        self.scheduler = scheduler or FetchScheduler()
+        # also keep each chunk as AMDA text lines, text answers are then spliced from them without any parsing
+        self.text_chunks = text_chunks
+        # once a product's sampling and row size are known, its chunks are sized to hold about chunk_target_bytes,
+        # aligned on a grid of that span, and misses are widened to whole grid cells (0 disables it)
+        self.chunk_target_bytes = chunk_target_bytes
+        self.chunk_min_span = chunk_min_span
+        self.chunk_max_span = chunk_max_span
+        # parse upstream answers and render text answers in that many processes instead of the request threads
+        self.workers = WorkerPool(process_pool_workers) if process_pool_workers else None
+        # chunks replaced in the index (tail refresh, compaction) are only deleted that long after, so that requests
+        # which looked them up just before can still read them
+        self.retire_delay = retire_delay
+        self._retired = []
+        self._lock = threading.RLock()
         self.headers_files = data_folder + '/headers.json'
         if os.path.exists(self.headers_files):
             with open(self.headers_files, 'r') as f:
@@ -29,22 +136,424 @@ class CachedAMDA(AMDA):
             self.headers = {}
         pathlib.Path(data_folder).mkdir(parents=True, exist_ok=True)
 
+    @staticmethod
+    def from_settings(settings: dict) -> 'CachedAMDA':
+        """Builds a CachedAMDA from the amda_* keys of the application settings (.ini file)"""
+        amda_cache_folder = settings.get('amda_cache_folder', '/tmp/amdacache')
+        log.debug(f'''amda_cache_folder is {amda_cache_folder}''')
+        shared_cache_options = {}
+        if settings.get('amda_shared_cache_endpoint'):
+            shared_cache_options['endpoint_url'] = settings['amda_shared_cache_endpoint']
+        rate = float(settings.get('amda_rate', 0)) or None
+        scheduler = FetchScheduler(
+            max_concurrency=int(settings.get('amda_max_concurrency', 4)),
+            rate=rate,
+            max_span=timedelta(seconds=float(settings.get('amda_max_request_span', 7 * 86400))),
+            max_points=int(settings.get('amda_max_request_points', 500000)),
+            retries=int(settings.get('amda_retries', 2)),
+            retry_delay=float(settings.get('amda_retry_delay', 1)))
+        return CachedAMDA(
+            server_url=settings.get('amda_server_url', 'http://amda.irap.omp.eu'),
+            data_folder=amda_cache_folder,
+            error_ttl=timedelta(seconds=float(settings.get('amda_error_ttl', 60))),
+            empty_ttl=timedelta(seconds=float(settings.get('amda_empty_ttl', 600))),
+            recent_window=timedelta(seconds=float(settings.get('amda_recent_window', 2 * 86400))),
+            tail_refresh=timedelta(seconds=float(settings.get('amda_tail_refresh', 60))),
+            chunk_codec=settings.get('amda_chunk_codec', 'pickle'),
+            shared_cache=backend_from_url(settings.get('amda_shared_cache'), **shared_cache_options),
+            scheduler=scheduler,
+            text_chunks=asbool(settings.get('amda_text_chunks', False)),
+            chunk_target_bytes=int(settings.get('amda_chunk_target_bytes', 0)),
+            chunk_min_span=timedelta(seconds=float(settings.get('amda_chunk_min_span', 600))),
+            chunk_max_span=timedelta(seconds=float(settings.get('amda_chunk_max_span', 30 * 86400))),
+            process_pool_workers=int(settings.get('amda_process_pool_workers', 0)),
+            retire_delay=timedelta(seconds=float(settings.get('amda_retire_delay', 300)))
+        )
+
     def _save(self):
-        super(CachedAMDA, self)._save()
-        with open(self.headers_files, 'w') as f:
-            f.write(jsonpickle.dumps(self.headers))
-        self.cache._save()
+        with self._lock:
+            super(CachedAMDA, self)._save()
+            atomic_write(self.headers_files, jsonpickle.dumps(self.headers).encode())
+            self.cache._save()
 
     def __del__(self):
         self._save()
+        self._remove_retired(force=True)
+
+    def add_to_cache(self, parameter_id: str, dt_range: DateTimeRange, df: Optional[pds.DataFrame],
+                     entry: Optional[CacheEntry] = None) -> Optional[CacheEntry]:
+        """Indexes df, written to a new chunk unless entry already holds it"""
+        if df is None or not len(df):
+            if dt_range.stop_time > datetime.now() - self.recent_window:
+                self.add_negative_entry(parameter_id, dt_range, EMPTY, self.empty_ttl)
+            else:
+                self.add_negative_entry(parameter_id, dt_range, EMPTY)
+            return None
+        entry = entry or self._write_chunk(parameter_id, dt_range, df)
+        with self._lock:
+            last = self.cache.last_entry(parameter_id)
+            self.cache.add_entry(parameter_id, entry)
+            self._record_shape(parameter_id, df, entry)
+            if dt_range.stop_time > datetime.now() - self.recent_window and \
+                    (last is None or dt_range.stop_time >= last.stop_time):
+                self._set_watermark(parameter_id, df.index[-1].to_pydatetime())
+        return entry
+
+    @staticmethod
+    def _chunk_meta(parameter_id: str, dt_range: DateTimeRange) -> dict:
+        # lets fsck rebuild the index entry from the file alone
+        return {'product': parameter_id, 'start': dt_range.start_time.isoformat(),
+                'stop': dt_range.stop_time.isoformat()}
+
+    def _write_chunk(self, parameter_id: str, dt_range: DateTimeRange, df: pds.DataFrame) -> CacheEntry:
+        fname = self.data_folder + '/' + str(uuid.uuid4())
+        with self.metrics.timer('chunk_write'):
+            size, checksum = write_chunk(fname, df, self.chunk_codec, self._chunk_meta(parameter_id, dt_range))
+        if self.text_chunks:
+            with self.metrics.timer('text_write'):
+                write_text_chunk(fname, df)
+        return CacheEntry(dt_range, fname, codec=self.chunk_codec, size=size, checksum=checksum)
+
+    def _read_chunk(self, entry: CacheEntry) -> pds.DataFrame:
+        """Raises ChunkError if the file is missing or doesn't match the entry"""
+        with self.metrics.timer('chunk_read'):
+            return read_chunk(entry.data_file, entry.size, entry.checksum)
+
+    def _quarantine(self, parameter_id: str, entries: List[CacheEntry]):
+        """Drops entries whose chunk can't be read so their range gets fetched again, keeps their files aside"""
+        quarantine = self.data_folder + '/quarantine'
+        pathlib.Path(quarantine).mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self.cache.remove_entries(parameter_id, entries)
+        for entry in entries:
+            log.warning(f'''Quarantining chunk {entry.data_file} of {parameter_id} {entry.dt_range}''')
+            self.metrics.inc('sciqlopcache_chunks_quarantined_total')
+            for fname in [entry.data_file] + [entry.data_file + suffix for suffix in SIDECAR_SUFFIXES]:
+                if os.path.exists(fname):
+                    shutil.move(fname, quarantine + '/' + os.path.basename(fname))
+
+    @staticmethod
+    def _remove_chunk(entry: CacheEntry):
+        for fname in [entry.data_file] + [entry.data_file + suffix for suffix in SIDECAR_SUFFIXES]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def _retire_chunk(self, entry: CacheEntry):
+        """Deletes the chunk of an entry no longer indexed once retire_delay has passed"""
+        with self._lock:
+            self._retired.append((datetime.now(), entry))
+        self._remove_retired()
+
+    def _remove_retired(self, force=False):
+        with self._lock:
+            limit = datetime.now() - self.retire_delay
+            due = [entry for retired_at, entry in self._retired if force or retired_at <= limit]
+            self._retired = [(retired_at, entry) for retired_at, entry in self._retired
+                             if not force and retired_at > limit]
+        for entry in due:
+            self._remove_chunk(entry)
+
+    def _publish(self, parameter_id: str, entry: CacheEntry, df: pds.DataFrame):
+        """Shares a chunk fetched from upstream with the other nodes, once it is old enough to be complete.
+        Only columnar chunks are shared since other nodes won't unpickle them.
+        """
+        backend = self.cache.backend
+        if backend is None or entry.stop_time > datetime.now() - self.recent_window or \
+                entry.stop_time - entry.start_time > MAX_CHUNK_SPAN:
+            return
+        try:
+            if entry.codec == 'pickle':
+                data = encode_chunk(df, SHARED_CODEC, self._chunk_meta(parameter_id, entry.dt_range))
+            else:
+                with open(entry.data_file, 'rb') as f:
+                    data = f.read()
+            if decode_header(data).get('layout') != 'columns':
+                log.debug(f'''Not publishing {parameter_id} chunks, they are not columnar''')
+                return
+            with self.metrics.timer('shared_put'):
+                backend.put(chunk_key(parameter_id, entry.dt_range), data)
+        except Exception as e:
+            log.warning(f'''Failed to publish {parameter_id} {entry.dt_range} to shared cache: {e}''')
+
+    def _fetch_shared(self, parameter_id: str,
+                      dt_range: DateTimeRange) -> Tuple[List[pds.DataFrame], List[DateTimeRange]]:
+        """Copies the parts of dt_range published by other nodes to the local cache,
+        returns their data and the ranges still missing
+        """
+        backend = self.cache.backend
+        if backend is None:
+            return [], [dt_range]
+        requested = DateTimeRangeSet.from_ranges([dt_range])
+        covered = DateTimeRangeSet()
+        chunks = []
+        try:
+            with self.metrics.timer('shared_list'):
+                published = sorted(backend.chunks(parameter_id, dt_range), key=lambda item: item[0].start_time)
+            for chunk_range, key in published:
+                # chunks published concurrently by several nodes may overlap, only keep what is still missing
+                new = (DateTimeRangeSet.from_ranges([chunk_range]) & requested) - covered
+                if not len(new):
+                    continue
+                with self.metrics.timer('shared_get'):
+                    data = backend.get(key)
+                if data is None:
+                    continue
+                try:
+                    df = decode_chunk(data, trusted=False)
+                except Exception as e:
+                    log.warning(f'''Ignoring shared chunk {key}: {e}''')
+                    continue
+                for r in new.to_ranges():
+                    part = trim_chunk(df, r.start_time, r.stop_time)
+                    if r.stop_time < chunk_range.stop_time:
+                        # the sample at r.stop_time belongs to the entry following r
+                        part = part[part.index < pds.Timestamp(r.stop_time)]
+                    self.add_to_cache(parameter_id, r, part)
+                    chunks.append(part)
+                covered = covered | new
+                self.metrics.inc('sciqlopcache_shared_hits_total')
+        except Exception as e:
+            log.warning(f'''Failed to get {parameter_id} {dt_range} from shared cache: {e}''')
+        return chunks, (requested - covered).to_ranges()
+
+    def _record_shape(self, parameter_id: str, df: pds.DataFrame, entry: CacheEntry):
+        """Remembers the sampling (seconds), column count and stored bytes per row of the first chunk ingested"""
+        meta = self.cache.meta(parameter_id)
+        if 'sampling' in meta or len(df) < 2:
+            return
+        meta['sampling'] = float(np.median(np.diff(df.index.values)) / np.timedelta64(1, 's'))
+        meta['columns'] = df.shape[1]
+        meta['bytes_per_row'] = entry.size / len(df) if entry.size else _nbytes(df) / len(df)
+
+    def chunk_span(self, parameter_id: str) -> Optional[timedelta]:
+        """Time span holding about chunk_target_bytes of parameter_id, None until its shape is known"""
+        meta = self.cache.meta(parameter_id)
+        if not self.chunk_target_bytes or not meta.get('sampling'):
+            return None
+        span = timedelta(seconds=self.chunk_target_bytes / meta['bytes_per_row'] * meta['sampling'])
+        return min(max(span, self.chunk_min_span), self.chunk_max_span)
+
+    def _widen(self, parameter_id: str, dt_range: DateTimeRange, span: timedelta) -> List[DateTimeRange]:
+        """dt_range widened to whole grid cells (never further in the future than it already is),
+        minus what is already cached
+        """
+        stop_time = grid_floor(dt_range.stop_time, span)
+        if stop_time < dt_range.stop_time:
+            stop_time += span
+        stop_time = max(dt_range.stop_time, min(stop_time, datetime.now()))
+        with self._lock:
+            return self.cache.get_missing_ranges(
+                parameter_id, DateTimeRange(grid_floor(dt_range.start_time, span), stop_time))
+
+    def _record_access(self, parameter_id: str, hits: int, misses: int):
+        meta = self.cache.meta(parameter_id)
+        meta['hits'] = meta.get('hits', 0) + hits
+        meta['misses'] = meta.get('misses', 0) + misses
+        meta['last_access'] = datetime.now()
+
+    def _set_watermark(self, parameter_id: str, valid_until: datetime):
+        """Data of the last chunk of parameter_id is complete up to valid_until, the rest of it may still grow"""
+        meta = self.cache.meta(parameter_id)
+        meta['valid_until'] = valid_until
+        meta['checked_at'] = datetime.now()
+
+    def _refresh_tail(self, parameter_id: str, dt_range: DateTimeRange, method="REST", **kwargs):
+        """When dt_range goes past the watermark, fetches only what follows it and appends it to the last chunk,
+        up to the end of its grid cell, the rest going to new chunks
+        """
+        with self._lock:
+            meta = self.cache.meta(parameter_id)
+            valid_until = meta.get('valid_until')
+            if valid_until is None or dt_range.stop_time <= valid_until:
+                return
+            last = self.cache.last_entry(parameter_id)
+            if last is None or last.stop_time < valid_until:
+                del meta['valid_until']
+                return
+            if dt_range.start_time > last.stop_time or datetime.now() - meta['checked_at'] < self.tail_refresh:
+                return
+            meta['checked_at'] = datetime.now()
+        # what is yet to come is not covered
+        stop_time = max(last.stop_time, min(dt_range.stop_time, datetime.now()))
+        if stop_time <= valid_until:
+            return
+        log.debug(f'''Refreshing tail of {parameter_id} from {valid_until} to {stop_time}''')
+        self.metrics.inc('sciqlopcache_tail_refreshes_total')
+        get_parameter = super(CachedAMDA, self).get_parameter
+        (_, tail, error), = self.scheduler.run(
+            self.server_url, [DateTimeRange(valid_until, stop_time)],
+            lambda r: get_parameter(r.start_time, r.stop_time, parameter_id, method, **kwargs))
+        if error is not None:
+            log.warning(f'''Failed to refresh tail of {parameter_id}: {error}''')
+            return
+        span = self.chunk_span(parameter_id)
+        head_stop = stop_time
+        if span is not None:
+            head_stop = min(stop_time, max(last.stop_time, grid_floor(last.start_time, span) + span))
+        extended = DateTimeRange(last.start_time, head_stop)
+        if tail is not None:
+            tail = tail[tail.index > pds.Timestamp(valid_until)]
+        if tail is None or not len(tail):
+            with self._lock:
+                # no-op if last was evicted or compacted meanwhile
+                self.cache.replace_entry(parameter_id, last, CacheEntry(extended, last.data_file, codec=last.codec,
+                                                                        size=last.size, checksum=last.checksum))
+            return
+        try:
+            previous = self._read_chunk(last)
+        except ChunkError as e:
+            log.warning(f'''Can't extend last chunk of {parameter_id}: {e}''')
+            self._quarantine(parameter_id, [last])
+            return
+        df = pds.concat([previous[:valid_until], tail[:head_stop]])
+        entry = self._write_chunk(parameter_id, extended, df)
+        with self._lock:
+            replaced = self.cache.replace_entry(parameter_id, last, entry)
+            if replaced:
+                meta['valid_until'] = df.index[-1].to_pydatetime()
+        if not replaced:
+            log.debug(f'''Last chunk of {parameter_id} was removed while refreshing its tail''')
+            self._remove_chunk(entry)
+            return
+        self._retire_chunk(last)
+        if head_stop < stop_time:
+            rest = tail[tail.index > pds.Timestamp(head_stop)]
+            for r in split_on_grid(DateTimeRange(head_stop, stop_time), span):
+                piece = rest[(rest.index > pds.Timestamp(r.start_time)) & (rest.index <= pds.Timestamp(r.stop_time))]
+                # pieces without data are left to the regular fetch of missing ranges
+                if len(piece):
+                    self.add_to_cache(parameter_id, r, piece)
+
+    def add_negative_entry(self, parameter_id: str, dt_range: DateTimeRange, reason: str,
+                           ttl: Optional[timedelta] = None):
+        expires = datetime.now() + ttl if ttl is not None else None
+        log.debug(f'''Negative entry {dt_range} ({reason}) for {parameter_id}, expires {expires}''')
+        with self._lock:
+            self.cache.add_entry(parameter_id, CacheEntry(dt_range, None, reason=reason, expires=expires))
+
+    def _check_errors(self, parameter_id: str, dt_range: DateTimeRange):
+        """Raises UpstreamError when dt_range overlaps an unexpired error entry, so that callers can tell a failure
+        from an absence of data
+        """
+        now = datetime.now()
+        with self._lock:
+            failed = [e.dt_range for e in self.cache.get_entries(parameter_id, dt_range)
+                      if e.reason == ERROR and not e.expired(now) and
+                      e.start_time < dt_range.stop_time and e.stop_time > dt_range.start_time]
+        if failed:
+            raise UpstreamError(f'Upstream request failed for {parameter_id} {failed}, retried after {self.error_ttl}')
 
-    def add_to_cache(self, parameter_id: str, dt_range: DateTimeRange, df: pds.DataFrame):
+    def _dataset_range(self, parameter_id) -> Optional[DateTimeRange]:
+        # never triggers an inventory download, only uses it when already loaded
+        if not len(self.parameter):
+            return None
+        return self.parameter_range(parameter_id)
+
+    def _past_stop_checked(self, parameter_id: str) -> bool:
+        """Whether upstream was asked about data past the inventory's dataStop less than empty_ttl ago,
+        records a new check otherwise
+        """
+        with self._lock:
+            meta = self.cache.meta(parameter_id)
+            checked_at = meta.get('past_stop_checked_at')
+            if checked_at is not None and datetime.now() - checked_at < self.empty_ttl:
+                return True
+            meta['past_stop_checked_at'] = datetime.now()
+            return False
+
+    def _fetch_in_worker(self, parameter_id: str, dt_range: DateTimeRange, method="REST",
+                         **kwargs) -> Tuple[Optional[pds.DataFrame], Optional[CacheEntry]]:
+        """Has a worker process download and parse dt_range into a new chunk, returns the chunk data read back and
+        its entry, (None, None) for empty answers
+        """
+        url = self._get_parameter_url(dt_range.start_time, dt_range.stop_time, parameter_id, method, **kwargs)
+        if not url:
+            return None, None
         fname = self.data_folder + '/' + str(uuid.uuid4())
-        if df is not None:
-            df.to_pickle(fname)
-            self.cache.add_entry(parameter_id, CacheEntry(dt_range, fname))
+        with self.metrics.timer('download_parse'):
+            written = self.workers.run(fetch_to_chunk, url, fname, self.chunk_codec,
+                                       self._chunk_meta(parameter_id, dt_range), self.text_chunks)
+        if written is None:
+            return None, None
+        size, checksum = written
+        entry = CacheEntry(dt_range, fname, codec=self.chunk_codec, size=size, checksum=checksum)
+        return self._read_chunk(entry), entry
+
+    def _fetch_upstream(self, parameter_id: str, ranges: List[DateTimeRange], method="REST",
+                        **kwargs) -> List[pds.DataFrame]:
+        """Downloads ranges in size bounded pieces through the scheduler, committing each piece once received"""
+        get_parameter = super(CachedAMDA, self).get_parameter
+        if self.workers is not None:
+            def fetch(r):
+                return self._fetch_in_worker(parameter_id, r, method, **kwargs)
         else:
-            self.cache.add_entry(parameter_id, CacheEntry(dt_range, None))
+            def fetch(r):
+                return get_parameter(r.start_time, r.stop_time, parameter_id, method, **kwargs), None
+        span = self.chunk_span(parameter_id)
+        if span is not None:
+            ranges = [piece for r in ranges for piece in split_on_grid(r, span)]
+        pieces = self.scheduler.split(ranges, self.parameter_cadence(parameter_id))
+        chunks = []
+
+        def on_retry(piece, error):
+            self.metrics.inc('sciqlopcache_upstream_retries_total')
+
+        for piece, result, error in self.scheduler.run(self.server_url, pieces, fetch, on_retry):
+            if error is not None:
+                log.warning(f'''Failed to get {parameter_id} {piece} from upstream: {error}''')
+                self.add_negative_entry(parameter_id, piece, ERROR, self.error_ttl)
+                continue
+            df, entry = result
+            entry = self.add_to_cache(parameter_id, piece, df, entry)
+            if entry is not None:
+                self._publish(parameter_id, entry, df)
+                chunks.append(df)
+        return chunks
+
+    def _fetch(self, parameter_id: str, dt_range: DateTimeRange, method="REST", prefetch=True,
+               **kwargs) -> Optional[pds.DataFrame]:
+        """Gets dt_range from the shared cache or else from upstream and records the outcome in cache,
+        empty answers and errors included. With prefetch, dt_range is first widened to whole chunks.
+        """
+        to_fetch = [dt_range]
+        span = self.chunk_span(parameter_id)
+        if prefetch and span is not None:
+            to_fetch = self._widen(parameter_id, dt_range, span)
+        dataset_range = self._dataset_range(parameter_id)
+        if dataset_range is not None:
+            requested = DateTimeRangeSet.from_ranges(to_fetch)
+            available = DateTimeRangeSet.from_ranges([dataset_range])
+            to_fetch = (requested & available).to_ranges()
+            for r in (requested - available).to_ranges():
+                if r.stop_time <= dataset_range.start_time:
+                    self.add_negative_entry(parameter_id, r, OUT_OF_RANGE)
+                elif self._past_stop_checked(parameter_id):
+                    self.add_negative_entry(parameter_id, r, OUT_OF_RANGE, self.empty_ttl)
+                else:
+                    # the inventory is never refreshed, the dataset may have grown past its dataStop
+                    to_fetch.append(r)
+        chunks, upstream = [], []
+        for r in to_fetch:
+            shared, missing = self._fetch_shared(parameter_id, r)
+            chunks += shared
+            upstream += missing
+        if upstream:
+            chunks += self._fetch_upstream(parameter_id, upstream, method, **kwargs)
+        return merge_chunks(chunks)
+
+    def fetch_missing(self, parameter_id: str, dt_range: DateTimeRange, method="REST", **kwargs) -> int:
+        """Downloads and caches the parts of dt_range not yet in cache, returns the number of upstream requests.
+        Raises UpstreamError if part of dt_range failed.
+        Safe to call from several threads as long as they work on disjoint ranges.
+        """
+        with self._lock:
+            miss = self.cache.get_missing_ranges(parameter_id, dt_range)
+        for r in miss:
+            log.debug(f'''Prefetching missing interval {r}''')
+            # callers split their work on their own, widening could make their ranges overlap
+            self._fetch(parameter_id, r, method, prefetch=False, **kwargs)
+        self._check_errors(parameter_id, dt_range)
+        return len(miss)
 
     def get_header(self, parameter_id, method="REST", **kwargs):
         if parameter_id in self.headers:
@@ -55,57 +564,333 @@ class CachedAMDA(AMDA):
             return header
 
     def get_parameter(self, start_time, stop_time, parameter_id, method="REST", **kwargs):
+        """Data of parameter_id in [start_time, stop_time], None if there is none,
+        raises UpstreamError if part of it recently failed upstream
+        """
         if type(start_time) is str:
             start_time = datetime.fromisoformat(start_time)
         if type(stop_time) is str:
             stop_time = datetime.fromisoformat(stop_time)
-        result = None
-        if parameter_id in self.cache:
-            entries = self.cache.get_entries(parameter_id, DateTimeRange(start_time, stop_time))
-            for e in entries:
-                log.debug(f'''Cache hit! {e.dt_range}''')
-                if e.data_file is not None:
-                    df = pds.read_pickle(e.data_file)
-                    if result is None:
-                        result = df
-                    else:
-                        if result.index[0] > df.index[-1]:
-                            result = pds.concat([df, result])
-                        else:
-                            result = pds.concat([result, df])
-            miss = self.cache.get_missing_ranges(parameter_id, DateTimeRange(start_time, stop_time))
+        self.metrics.inc('sciqlopcache_requests_total')
+        with self.metrics.timer('total'):
+            dt_range = DateTimeRange(start_time, stop_time)
+            self._refresh_tail(parameter_id, dt_range, method, **kwargs)
+            hits, chunks, miss = self._read_cached(parameter_id, dt_range)
+            self._record_access(parameter_id, hits, len(miss))
+            self.metrics.inc('sciqlopcache_cache_hits_total', hits)
+            for df in chunks:
+                self.metrics.inc('sciqlopcache_bytes_served_total', _nbytes(df), source='cache')
             for r in miss:
                 log.debug(f'''Missing interval {r}''')
-                df = super(CachedAMDA, self).get_parameter(r.start_time, r.stop_time, parameter_id, method, **kwargs)
-                self.add_to_cache(parameter_id, r, df)
+                self.metrics.inc('sciqlopcache_cache_misses_total')
+                df = self._fetch(parameter_id, r, method, **kwargs)
                 if df is not None:
-                    if result is None:
-                        result = df
+                    df = trim_chunk(df, start_time, stop_time)
+                    self.metrics.inc('sciqlopcache_bytes_served_total', _nbytes(df), source='upstream')
+                    chunks.append(df)
+            self._check_errors(parameter_id, dt_range)
+            with self.metrics.timer('concat'):
+                return merge_chunks(chunks)
+
+    def _read_cached(self, product: str,
+                     dt_range: DateTimeRange) -> Tuple[int, List[pds.DataFrame], List[DateTimeRange]]:
+        """Reads the cached chunks of dt_range trimmed to it, returns (entries hit, chunks, missing ranges).
+        Chunks that can't be read are quarantined, those replaced meanwhile by a tail refresh or a compaction are
+        looked up again.
+        """
+        for attempt in range(3):
+            with self._lock:
+                self.cache.purge_expired(product)
+                entries = self.cache.get_entries(product, dt_range)
+                miss = self.cache.get_missing_ranges(product, dt_range)
+            chunks, corrupt, replaced = [], [], False
+            for e in entries:
+                log.debug(f'''Cache hit! {e.dt_range}''')
+                if e.data_file is None:
+                    continue
+                try:
+                    chunks.append(trim_chunk(self._read_chunk(e), dt_range.start_time, dt_range.stop_time))
+                except ChunkError as error:
+                    if self._is_indexed(product, e):
+                        log.warning(f'''{error}''')
+                        corrupt.append(e)
                     else:
-                        if result.index[0] > df.index[-1]:
-                            result = pds.concat([df, result])
-                        else:
-                            result = pds.concat([result, df])
+                        log.debug(f'''{e.data_file} of {product} was replaced while being read''')
+                        replaced = True
+            if corrupt:
+                self._quarantine(product, corrupt)
+            if not corrupt and not replaced:
+                break
         else:
-            result = super(CachedAMDA, self).get_parameter(start_time, stop_time, parameter_id, method, **kwargs)
-            self.add_to_cache(parameter_id, DateTimeRange(start_time, stop_time), result)
-        if type(result) is pds.DataFrame:
+            # still unreadable, what got quarantined is fetched again
+            with self._lock:
+                miss = self.cache.get_missing_ranges(product, dt_range)
+        return len(entries), chunks, miss
+
+    def _is_indexed(self, product: str, entry: CacheEntry) -> bool:
+        with self._lock:
+            return self.cache.has_entry(product, entry)
+
+    def _fill(self, parameter_id: str, dt_range: DateTimeRange, method="REST", **kwargs) -> List[CacheEntry]:
+        """Fetches what the cache misses of dt_range, returns the chunks overlapping it in time order"""
+        self._refresh_tail(parameter_id, dt_range, method, **kwargs)
+        with self._lock:
+            self.cache.purge_expired(parameter_id)
+            hits = len(self.cache.get_entries(parameter_id, dt_range))
+            miss = self.cache.get_missing_ranges(parameter_id, dt_range)
+            self._record_access(parameter_id, hits, len(miss))
+        self.metrics.inc('sciqlopcache_cache_hits_total', hits)
+        for r in miss:
+            log.debug(f'''Missing interval {r}''')
+            self.metrics.inc('sciqlopcache_cache_misses_total')
+            self._fetch(parameter_id, r, method, **kwargs)
+        self._check_errors(parameter_id, dt_range)
+        with self._lock:
+            return sorted(e for e in self.cache.get_entries(parameter_id, dt_range) if not e.is_negative)
+
+    def _text_ranges(self, parameter_id: str, dt_range: DateTimeRange, method="REST",
+                     **kwargs) -> Optional[List[Tuple[str, int, int]]]:
+        """Fills the cache for dt_range then returns the (text file, offset, size) pieces of the answer,
+        None if a chunk can't be used, after quarantining it unless it was replaced meanwhile
+        """
+        pieces = []
+        for e in self._fill(parameter_id, dt_range, method, **kwargs):
             try:
-                result = result[start_time:stop_time]
-            except:
-                log.debug(f'''can't slice dataframe, slice: {start_time}->{stop_time}  | dataframe : {result.index[0]}->{result.index[-1]}''')
-        return result
+                if not all(os.path.exists(e.data_file + suffix) for suffix in (TEXT_SUFFIX, INDEX_SUFFIX)):
+                    # chunk written before text chunks were enabled, or with an older index format
+                    with self.metrics.timer('text_write'):
+                        write_text_chunk(e.data_file, self._read_chunk(e))
+                offset, size = text_range(e.data_file, dt_range.start_time, dt_range.stop_time)
+            except (ChunkError, OSError, ValueError) as error:
+                log.warning(f'''Can't use text of {e.data_file}: {error}''')
+                if self._is_indexed(parameter_id, e):
+                    self._quarantine(parameter_id, [e])
+                return None
+            if size:
+                pieces.append((e.data_file + TEXT_SUFFIX, offset, size))
+        return pieces
 
-    def get_parameter_as_txt(self, start_time, stop_time, parameter_id, method="REST", **kwargs):
+    def _render_in_workers(self, parameter_id: str, dt_range: DateTimeRange, method="REST",
+                           **kwargs) -> Optional[List[Tuple[str, int]]]:
+        """Fills the cache for dt_range then has worker processes render each chunk's part of the answer to a
+        temporary file, returns their (file, size) in time order, None if a chunk can't be used, after quarantining it
+        unless it was replaced meanwhile
+        """
+        entries = self._fill(parameter_id, dt_range, method, **kwargs)
+        # dotted names, skipped by fsck
+        files = [self.data_folder + '/.render-' + str(uuid.uuid4()) for _ in entries]
+        futures = [self.workers.submit(render_chunk, e.data_file, e.size, e.checksum, dt_range.start_time,
+                                       dt_range.stop_time, fname) for e, fname in zip(entries, files)]
+        pieces, corrupt = [], []
+        for e, fname, future in zip(entries, files, futures):
+            try:
+                pieces.append((fname, future.result()))
+            except ChunkError as error:
+                log.warning(f'''{error}''')
+                corrupt.append(e)
+        if corrupt:
+            self._quarantine(parameter_id, [e for e in corrupt if self._is_indexed(parameter_id, e)])
+            for fname in files:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            return None
+        return pieces
+
+    def write_parameter_as_txt(self, start_time, stop_time, parameter_id, out, method="REST", **kwargs):
+        """Writes the AMDA text answer to the binary file out"""
         if type(start_time) is str:
             start_time = datetime.fromisoformat(start_time)
         if type(stop_time) is str:
             stop_time = datetime.fromisoformat(stop_time)
-        data = self.get_parameter(start_time, stop_time, parameter_id, method, **kwargs)
         header = self.get_header(parameter_id)
-        txt = header.format(interval_start=start_time.isoformat(), interval_stop=stop_time.isoformat()) + '\n'
-        data.index = data.index.format(formatter=lambda x: x.isoformat())
-        txt += data.to_string(index_names=False, header=False,
-                              formatters={i: "{:.3f}".format for i in range(1, data.shape[1])}
-                              )
-        return txt
+        header = header.format(interval_start=start_time.isoformat(), interval_stop=stop_time.isoformat()) + '\n'
+        if self.text_chunks:
+            self.metrics.inc('sciqlopcache_requests_total')
+            with self.metrics.timer('total'):
+                pieces = self._text_ranges(parameter_id, DateTimeRange(start_time, stop_time), method, **kwargs)
+            if pieces is not None:
+                with self.metrics.timer('text_copy'):
+                    out.write(header.encode())
+                    for fname, offset, size in pieces:
+                        copy_range(out, fname, offset, size)
+                        self.metrics.inc('sciqlopcache_bytes_served_total', size, source='text')
+                return
+        elif self.workers is not None:
+            self.metrics.inc('sciqlopcache_requests_total')
+            with self.metrics.timer('total'):
+                pieces = self._render_in_workers(parameter_id, DateTimeRange(start_time, stop_time), method,
+                                                 **kwargs)
+            if pieces is not None:
+                with self.metrics.timer('text_copy'):
+                    out.write(header.encode())
+                    for fname, size in pieces:
+                        copy_range(out, fname, 0, size)
+                        os.remove(fname)
+                        self.metrics.inc('sciqlopcache_bytes_served_total', size, source='workers')
+                return
+        data = self.get_parameter(start_time, stop_time, parameter_id, method, **kwargs)
+        with self.metrics.timer('format'):
+            out.write(header.encode())
+            if data is not None:
+                out.write(render_table(data))
+
+    def get_parameter_as_txt(self, start_time, stop_time, parameter_id, method="REST", **kwargs):
+        out = io.BytesIO()
+        self.write_parameter_as_txt(start_time, stop_time, parameter_id, out, method, **kwargs)
+        return out.getvalue().decode()
+
+    def _complete(self, frames: dict, dt_range: DateTimeRange) -> bool:
+        """Whether every parameter of frames has data in dt_range and nothing there may still change
+        (no error or expiring empty entry), so that a join of it can be cached for good
+        """
+        if any(df is None or not len(df) for df in frames.values()):
+            return False
+        with self._lock:
+            return not any(e.is_negative and e.expires is not None
+                           for parameter_id in frames for e in self.cache.get_entries(parameter_id, dt_range))
+
+    def get_joined(self, start_time, stop_time, parameter_ids: List[str], step: timedelta, method='nearest',
+                   tolerance: Optional[timedelta] = None) -> pds.DataFrame:
+        """parameter_ids resampled on the multiples of step in [start_time, stop_time] with method (see join.METHODS),
+        NaN where a parameter has no sample within tolerance (step by default) of a grid point.
+        Parts whose source data is older than recent_window and complete are cached under a synthetic product and
+        reused. Raises UpstreamError if the data of a parameter recently failed upstream.
+        """
+        check_method(method)
+        if type(start_time) is str:
+            start_time = datetime.fromisoformat(start_time)
+        if type(stop_time) is str:
+            stop_time = datetime.fromisoformat(stop_time)
+        tolerance = tolerance or step
+        key = join_key(parameter_ids, step, method, tolerance)
+        grid = make_grid(start_time, stop_time, step)
+        if not len(grid):
+            return join({}, grid, method, step, tolerance)
+        dt_range = DateTimeRange(grid[0].to_pydatetime(), grid[-1].to_pydatetime())
+        _, chunks, miss = self._read_cached(key, dt_range)
+        extra = margin(step, method, tolerance)
+        pieces = []
+        for r in miss:
+            piece_grid = make_grid(r.start_time, r.stop_time, step)
+            if not len(piece_grid):
+                continue
+            first, last = piece_grid[0].to_pydatetime(), piece_grid[-1].to_pydatetime()
+            frames = {parameter_id: self.get_parameter(first - extra, last + extra, parameter_id)
+                      for parameter_id in parameter_ids}
+            pieces.append((piece_grid, first, last, frames))
+        # parameters without data in a piece keep the column count they have elsewhere
+        widths = {parameter_id: self.cache.meta(parameter_id).get('columns', 0) for parameter_id in parameter_ids}
+        for _, _, _, frames in pieces:
+            widths.update({parameter_id: df.shape[1] for parameter_id, df in frames.items() if df is not None})
+        for piece_grid, first, last, frames in pieces:
+            df = join(frames, piece_grid, method, step, tolerance, widths)
+            if last + extra < datetime.now() - self.recent_window and \
+                    self._complete(frames, DateTimeRange(first - extra, last + extra)):
+                entry = self._write_chunk(key, DateTimeRange(first, last), df)
+                with self._lock:
+                    self.cache.add_entry(key, entry)
+            chunks.append(df)
+        df = merge_chunks(chunks)
+        return df[~df.index.duplicated()]
+
+    def parameter_stats(self, parameter_id: str) -> dict:
+        """Usage of parameter_id computed from the index alone, no chunk is read"""
+        with self._lock:
+            entries = list(self.cache[parameter_id]) if parameter_id in self.cache else []
+            meta = dict(self.cache.meta(parameter_id))
+        chunks = [entry for entry in entries if not entry.is_negative]
+        covered = DateTimeRangeSet.from_ranges(entry.dt_range for entry in entries)
+        with_data = DateTimeRangeSet.from_ranges(entry.dt_range for entry in chunks)
+        last_access = meta.get('last_access')
+        return {
+            'parameter': parameter_id,
+            'entries': len(entries),
+            'chunks': len(chunks),
+            'start': covered.starts[0].astype(datetime).isoformat() if len(covered) else None,
+            'stop': covered.stops[-1].astype(datetime).isoformat() if len(covered) else None,
+            'span': float((with_data.stops - with_data.starts).sum() / np.timedelta64(1, 's')),
+            'bytes': sum(_chunk_size(entry) for entry in chunks),
+            # holes between the ranges known to the cache, with or without data
+            'gaps': max(len(covered) - 1, 0),
+            'hits': meta.get('hits', 0),
+            'misses': meta.get('misses', 0),
+            'last_access': last_access.isoformat() if last_access is not None else None,
+        }
+
+    def stats(self) -> List[dict]:
+        """parameter_stats of every cached parameter, largest first"""
+        with self._lock:
+            parameters = list(self.cache)
+        return sorted((self.parameter_stats(parameter_id) for parameter_id in parameters),
+                      key=lambda stats: stats['bytes'], reverse=True)
+
+    def evict(self, parameter_id: str) -> int:
+        """Drops everything cached about parameter_id, returns the number of chunks removed"""
+        with self._lock:
+            entries = self.cache.remove_product(parameter_id)
+        chunks = [entry for entry in entries if not entry.is_negative]
+        for entry in chunks:
+            self._remove_chunk(entry)
+        log.info(f'''Evicted {len(chunks)} chunk(s) of {parameter_id}''')
+        return len(chunks)
+
+    def compact(self, parameter_id: str, max_bytes: Optional[int] = None) -> int:
+        """Merges runs of contiguous chunks of parameter_id into chunks of at most max_bytes (chunk_target_bytes
+        by default, unbounded when both are unset), dropping expired negative entries and entries whose chunk is
+        gone. Returns the number of chunks removed.
+        """
+        max_bytes = max_bytes or self.chunk_target_bytes or None
+        with self._lock:
+            if parameter_id not in self.cache:
+                return 0
+            self.cache.purge_expired(parameter_id)
+            chunks = sorted(entry for entry in self.cache[parameter_id] if not entry.is_negative)
+            lost = [entry for entry in chunks if not os.path.exists(entry.data_file)]
+            self.cache.remove_entries(parameter_id, lost)
+        removed = len(lost)
+        groups, group, size, reach = [], [], 0, None
+        for entry in chunks:
+            if entry in lost:
+                continue
+            if group and (entry.start_time > reach or (max_bytes and size + _chunk_size(entry) > max_bytes)):
+                groups.append(group)
+                group, size = [], 0
+            reach = max(reach, entry.stop_time) if group else entry.stop_time
+            group.append(entry)
+            size += _chunk_size(entry)
+        groups.append(group)
+        for group in groups:
+            if len(group) < 2:
+                continue
+            try:
+                df = pds.concat([self._read_chunk(entry) for entry in group])
+            except ChunkError as error:
+                log.warning(f'''Not compacting {parameter_id} {group[0].start_time}: {error}''')
+                continue
+            df = df[~df.index.duplicated(keep='last')].sort_index()
+            merged = self._write_chunk(parameter_id, DateTimeRange(group[0].start_time,
+                                                                   max(entry.stop_time for entry in group)), df)
+            with self._lock:
+                if not all(self.cache.has_entry(parameter_id, entry) for entry in group):
+                    # replaced or evicted meanwhile
+                    self._remove_chunk(merged)
+                    continue
+                self.cache.remove_entries(parameter_id, group)
+                self.cache.add_entry(parameter_id, merged)
+            for entry in group:
+                # requests may have looked them up just before
+                self._retire_chunk(entry)
+            removed += len(group) - 1
+        log.info(f'''Compacted {parameter_id}: {removed} chunk(s) removed''')
+        return removed
+
+    def metrics_gauges(self):
+        with self._lock:
+            entries = {(('parameter', parameter_id),): len(self.cache[parameter_id]) for parameter_id in self.cache}
+        return {
+            'sciqlopcache_cache_entries': entries,
+            'sciqlopcache_cache_hit_ratio': {(): self.metrics.hit_ratio()}
+        }
+
+    def metrics_as_prometheus(self) -> str:
+        return self.metrics.to_prometheus(self.metrics_gauges())
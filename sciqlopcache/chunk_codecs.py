@@ -0,0 +1,221 @@
+"""On disk format of cached chunks.
+
+'pickle' chunks are plain DataFrame pickles, the historic format. Every other codec writes a small container:
+
+    MAGIC | uint32 header length | JSON header | compressed payload
+
+For frames with a naive DatetimeIndex and numeric columns the payload is columnar: the time index as int64
+nanoseconds delta encoded (constant for a fixed cadence), then each column, every array byte-shuffled (all first
+bytes, then all second bytes...) so that smooth series compress well. Other frames fall back to a compressed pickle.
+
+Chunks can carry a small metadata dict (product and time range) in the container header, or in the frame attrs of
+pickle chunks, so that an index can be rebuilt from the chunk files alone.
+
+Chunks read from a store other hosts write to are untrusted: only the columnar layout is decoded from them, since
+unpickling runs arbitrary code.
+"""
+import bz2
+import json
+import lzma
+import os
+import pickle
+import struct
+import tempfile
+import zlib
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pds
+
+MAGIC = b'SQLCHNK1'
+CODECS = ('pickle', 'none', 'zlib', 'bz2', 'lzma', 'zstd', 'lz4')
+# codec of shared chunks when the local one is 'pickle'
+SHARED_CODEC = 'zlib'
+# frame attrs key of the metadata of pickle chunks
+META_ATTR = 'sciqlopcache'
+
+
+class ChunkError(ValueError):
+    """A chunk file is missing, truncated, corrupt or does not match its index entry"""
+    pass
+
+
+def _zstd():
+    import zstandard
+    return zstandard
+
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame
+
+
+_COMPRESSORS = {
+    'none': (lambda data: data, lambda data: data),
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+    'zstd': (lambda data: _zstd().ZstdCompressor(level=3).compress(data),
+             lambda data: _zstd().ZstdDecompressor().decompress(data)),
+    'lz4': (lambda data: _lz4().compress(data), lambda data: _lz4().decompress(data)),
+}
+
+
+def check_codec(codec: str):
+    """Raises ValueError if codec is unknown or its optional dependency is not installed"""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown chunk codec {codec}, expected one of {', '.join(CODECS)}")
+    try:
+        if codec == 'zstd':
+            _zstd()
+        elif codec == 'lz4':
+            _lz4()
+    except ImportError as e:
+        raise ValueError(f"Chunk codec {codec} needs a missing package: {e}")
+
+
+def _shuffle(array: np.ndarray) -> bytes:
+    return np.ascontiguousarray(array).view(np.uint8).reshape(len(array), array.itemsize).T.tobytes()
+
+
+def _unshuffle(data: bytes, dtype: np.dtype, rows: int) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, rows).T.copy().view(dtype).ravel()
+
+
+def _is_columnar(df: pds.DataFrame) -> bool:
+    return isinstance(df.index, pds.DatetimeIndex) and df.index.tz is None and \
+           all(dtype.kind in 'biuf' for dtype in df.dtypes) and \
+           all(type(name) in (int, str) for name in df.columns) and df.columns.is_unique
+
+
+def encode_chunk(df: pds.DataFrame, codec: str, meta: Optional[dict] = None) -> bytes:
+    if codec == 'pickle':
+        if meta is not None:
+            df = df.copy(deep=False)
+            df.attrs = {META_ATTR: meta}
+        return pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+    compress = _COMPRESSORS[codec][0]
+    rows = len(df)
+    if _is_columnar(df):
+        times = df.index.values.astype('datetime64[ns]').view(np.int64)
+        deltas = np.diff(times, prepend=np.int64(0))
+        arrays = [deltas] + [df[name].values for name in df.columns]
+        header = {
+            'codec': codec, 'layout': 'columns', 'rows': rows, 'index_name': df.index.name,
+            'columns': [name for name in df.columns], 'dtypes': [str(df[name].dtype) for name in df.columns]
+        }
+        payload = b''.join(_shuffle(array) for array in arrays)
+    else:
+        header = {'codec': codec, 'layout': 'pickle', 'rows': rows}
+        payload = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+    if meta is not None:
+        header['meta'] = meta
+    header = json.dumps(header).encode()
+    return MAGIC + struct.pack('<I', len(header)) + header + compress(payload)
+
+
+def _split(data: bytes):
+    size, = struct.unpack_from('<I', data, len(MAGIC))
+    start = len(MAGIC) + 4
+    return json.loads(data[start:start + size].decode()), data[start + size:]
+
+
+def decode_header(data: bytes) -> dict:
+    if not data.startswith(MAGIC):
+        return {'codec': 'pickle', 'layout': 'pickle'}
+    return _split(data)[0]
+
+
+def decode_meta(data: bytes) -> Optional[dict]:
+    """Metadata given to encode_chunk, None for chunks written without"""
+    if not data.startswith(MAGIC):
+        return pickle.loads(data).attrs.get(META_ATTR)
+    return _split(data)[0].get('meta')
+
+
+def _check_columns(header: dict, payload: bytes):
+    """Raises ChunkError unless payload holds the arrays described by a columnar header"""
+    try:
+        rows = int(header['rows'])
+        dtypes = [np.dtype(dtype) for dtype in header['dtypes']]
+        ok = rows >= 0 and len(dtypes) == len(header['columns']) and all(dtype.kind in 'biuf' for dtype in dtypes)
+    except (KeyError, TypeError, ValueError):
+        ok = False
+    if not ok or len(payload) != rows * (8 + sum(dtype.itemsize for dtype in dtypes)):
+        raise ChunkError("Malformed columnar chunk")
+
+
+def decode_chunk(data: bytes, trusted=True) -> pds.DataFrame:
+    """Decodes an encoded chunk, untrusted data is only accepted in the columnar container layout"""
+    if not trusted:
+        if not data.startswith(MAGIC):
+            raise ChunkError("Refusing to unpickle an untrusted chunk")
+        try:
+            header = _split(data)[0]
+        except (struct.error, ValueError) as e:
+            raise ChunkError(f"Malformed chunk header: {e}")
+        if header.get('layout') != 'columns' or header.get('codec') not in _COMPRESSORS:
+            raise ChunkError(f"Refusing to decode an untrusted {header.get('layout')} chunk")
+    if not data.startswith(MAGIC):
+        df = pickle.loads(data)
+        df.attrs.pop(META_ATTR, None)
+        return df
+    header, payload = _split(data)
+    payload = _COMPRESSORS[header['codec']][1](payload)
+    if header['layout'] == 'pickle':
+        return pickle.loads(payload)
+    if not trusted:
+        _check_columns(header, payload)
+    rows = header['rows']
+    times = np.cumsum(_unshuffle(payload[:8 * rows], np.int64, rows))
+    offset, columns = 8 * rows, {}
+    for name, dtype in zip(header['columns'], header['dtypes']):
+        size = np.dtype(dtype).itemsize * rows
+        columns[name] = _unshuffle(payload[offset:offset + size], dtype, rows)
+        offset += size
+    index = pds.DatetimeIndex(times.view('datetime64[ns]'), name=header['index_name'])
+    return pds.DataFrame(columns, index=index, columns=header['columns'])
+
+
+def checksum(data: bytes) -> int:
+    return zlib.crc32(data)
+
+
+def atomic_write(fname: str, data: bytes):
+    """Readers and crashes see either the previous content of fname or data, never a partial file"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or '.', prefix='.' + os.path.basename(fname))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_chunk(fname: str, df: pds.DataFrame, codec: str, meta: Optional[dict] = None) -> Tuple[int, int]:
+    """Atomically writes df, returns the file size and checksum"""
+    data = encode_chunk(df, codec, meta)
+    atomic_write(fname, data)
+    return len(data), checksum(data)
+
+
+def read_chunk(fname: str, size: Optional[int] = None, crc: Optional[int] = None) -> pds.DataFrame:
+    """Reads a chunk, checking its size and checksum when given, raises ChunkError if it can't be decoded"""
+    try:
+        with open(fname, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        raise ChunkError(f"Can't read chunk {fname}: {e}") from e
+    if size is not None and len(data) != size:
+        raise ChunkError(f"Chunk {fname} is {len(data)} bytes long instead of {size}")
+    if crc is not None and checksum(data) != crc:
+        raise ChunkError(f"Chunk {fname} checksum mismatch")
+    try:
+        return decode_chunk(data)
+    except Exception as e:
+        raise ChunkError(f"Can't decode chunk {fname}: {e}") from e
@@ -1,4 +1,7 @@
 from datetime import datetime, timedelta
+from typing import Iterable, List
+
+import numpy as np
 
 
 class DateTimeRange:
@@ -16,8 +19,7 @@ class DateTimeRange:
         return (self.start_time == other.start_time) and (self.stop_time == other.stop_time)
 
     def intersect(self, other):
-        return ((self.stop_time >= other[0]) and (self.start_time <= other[1])) or (
-                    other[0] <= self.start_time <= other[1]) or (other[0] <= self.stop_time <= other[1])
+        return (self.stop_time >= other[0]) and (self.start_time <= other[1])
 
     def __repr__(self):
         return str(self.start_time.isoformat() + "->" + self.stop_time.isoformat())
@@ -31,6 +33,17 @@ class DateTimeRange:
         return (self.start_time <= item[0] <= self.stop_time) or \
                (self.start_time <= item[1] <= self.stop_time)
 
+    def split(self, step: timedelta) -> List['DateTimeRange']:
+        if step <= timedelta(0):
+            raise ValueError("Split step must be positive")
+        chunks = []
+        start = self.start_time
+        while start < self.stop_time:
+            stop = min(start + step, self.stop_time)
+            chunks.append(DateTimeRange(start, stop))
+            start = stop
+        return chunks
+
     def __add__(self, other):
         if type(other) is timedelta:
             return DateTimeRange(self.start_time + other, self.stop_time + other)
@@ -51,24 +64,7 @@ class DateTimeRange:
                     res.append(DateTimeRange(other[1], self.stop_time))
             return res
         elif type(other) is list:
-            diff = []
-            if len(other) > 1:
-                other.sort()
-                left = (DateTimeRange(self.start_time, other[0].stop_time) - other[0])
-                if left:
-                    diff += left
-                diff += [
-                    DateTimeRange(pair[0].stop_time, pair[1].start_time)
-                    for pair in zip(other[0:-1], other[1:]) if pair[0].stop_time != pair[1].start_time
-                ]
-                right = (DateTimeRange(other[-1].start_time, self.stop_time) - other[-1])
-                if right:
-                    diff += right
-            elif len(other):
-                diff += (self - other[0])
-            else:
-                return [self]
-            return diff
+            return (DateTimeRangeSet.from_ranges([self]) - DateTimeRangeSet.from_ranges(other)).to_ranges()
         else:
             raise TypeError()
 
@@ -76,4 +72,99 @@ class DateTimeRange:
         return self.start_time < other.start_time
 
     def __gt__(self, other):
-        return self.start_time > other.start_time
\ No newline at end of file
+        return self.start_time > other.start_time
+
+
+def _as_datetime64(values) -> np.ndarray:
+    return np.asarray(values, dtype='datetime64[us]')
+
+
+class DateTimeRangeSet:
+    """Set of time ranges stored as sorted, non overlapping datetime64 start/stop arrays.
+    Overlapping or touching ranges are merged on construction so set operations are a few vectorized passes.
+    """
+    starts: np.ndarray
+    stops: np.ndarray
+
+    __slots__ = ['starts', 'stops']
+
+    def __init__(self, starts=(), stops=(), normalized=False):
+        starts, stops = _as_datetime64(starts), _as_datetime64(stops)
+        if starts.shape != stops.shape:
+            raise ValueError("starts and stops must have the same length")
+        if not normalized:
+            starts, stops = DateTimeRangeSet._normalize(starts, stops)
+        self.starts = starts
+        self.stops = stops
+
+    @staticmethod
+    def from_ranges(ranges: Iterable) -> 'DateTimeRangeSet':
+        ranges = list(ranges)
+        return DateTimeRangeSet([r.start_time for r in ranges], [r.stop_time for r in ranges])
+
+    @staticmethod
+    def _normalize(starts: np.ndarray, stops: np.ndarray):
+        keep = stops > starts
+        starts, stops = starts[keep], stops[keep]
+        if len(starts) < 2:
+            return starts, stops
+        order = np.argsort(starts, kind='stable')
+        starts, stops = starts[order], stops[order]
+        reach = np.maximum.accumulate(stops)
+        first = np.empty(len(starts), dtype=bool)
+        first[0] = True
+        first[1:] = starts[1:] > reach[:-1]
+        heads = np.flatnonzero(first)
+        return starts[heads], np.maximum.reduceat(stops, heads)
+
+    def _combine(self, other: 'DateTimeRangeSet', keep) -> 'DateTimeRangeSet':
+        n, m = len(self.starts), len(other.starts)
+        times = np.concatenate([self.starts, self.stops, other.starts, other.stops])
+        if not len(times):
+            return DateTimeRangeSet()
+        delta_self = np.concatenate([np.ones(n, dtype=np.int64), -np.ones(n, dtype=np.int64),
+                                     np.zeros(2 * m, dtype=np.int64)])
+        delta_other = np.concatenate([np.zeros(2 * n, dtype=np.int64),
+                                      np.ones(m, dtype=np.int64), -np.ones(m, dtype=np.int64)])
+        order = np.argsort(times, kind='stable')
+        times, delta_self, delta_other = times[order], delta_self[order], delta_other[order]
+        bounds, first = np.unique(times, return_index=True)
+        # inside[i] tells whether [bounds[i], bounds[i+1]) belongs to the result
+        inside = keep(np.cumsum(np.add.reduceat(delta_self, first)) > 0,
+                      np.cumsum(np.add.reduceat(delta_other, first)) > 0)
+        previous = np.concatenate([[False], inside[:-1]])
+        following = np.concatenate([inside[1:], [False]])
+        starts = bounds[inside & ~previous]
+        stops = bounds[1:][(inside & ~following)[:-1]]
+        return DateTimeRangeSet(starts, stops, normalized=True)
+
+    def union(self, other: 'DateTimeRangeSet') -> 'DateTimeRangeSet':
+        return DateTimeRangeSet(np.concatenate([self.starts, other.starts]),
+                                np.concatenate([self.stops, other.stops]))
+
+    def intersection(self, other: 'DateTimeRangeSet') -> 'DateTimeRangeSet':
+        return self._combine(other, np.logical_and)
+
+    def difference(self, other: 'DateTimeRangeSet') -> 'DateTimeRangeSet':
+        return self._combine(other, lambda inside_self, inside_other: inside_self & ~inside_other)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def to_ranges(self) -> List[DateTimeRange]:
+        return [DateTimeRange(start, stop) for start, stop in
+                zip(self.starts.astype(datetime).tolist(), self.stops.astype(datetime).tolist())]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(self.to_ranges())
+
+    def __eq__(self, other):
+        assert type(other) is DateTimeRangeSet
+        return np.array_equal(self.starts, other.starts) and np.array_equal(self.stops, other.stops)
+
+    def __repr__(self):
+        return '[' + ', '.join(repr(r) for r in self.to_ranges()) + ']'
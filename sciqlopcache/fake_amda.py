@@ -0,0 +1,156 @@
+"""Local stand-in for the AMDA REST web service, serving synthetic data for tests and benchmarks.
+
+Only what AMDA/CachedAMDA use is implemented: auth.php, getParameter.php and the data files it points to.
+Every parameter is a set of smooth sine waves sampled at a fixed cadence inside [data_start, data_stop).
+"""
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from wsgiref.util import application_uri
+
+import numpy as np
+import pandas as pds
+
+HEADER = '''# -----------
+# AMDA INFO :
+# -----------
+# AMDA_ABOUT : Created by a fake AMDA server
+#
+# PARAMETER_ID : {parameter_id}
+# PARAMETER_COMPONENTS : {components}
+#
+# ---------------
+# INTERVAL INFO :
+# ---------------
+# INTERVAL_START : {interval_start}
+# INTERVAL_STOP : {interval_stop}
+#
+# ------
+# DATA :
+# ------
+# DATA_COLUMNS : AMDA_TIME, {columns}
+#
+'''
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAMDA:
+    def __init__(self, parameters=('fake_b',), cadence: timedelta = timedelta(seconds=4), columns: int = 3,
+                 latency: float = 0., data_start: datetime = datetime(2000, 1, 1),
+                 data_stop: datetime = datetime(2030, 1, 1)):
+        self.parameters = list(parameters)
+        self.cadence = cadence
+        self.columns = columns
+        self.latency = latency
+        # number of next getParameter requests to answer with a server error
+        self.failures = 0
+        self.data_start = data_start
+        self.data_stop = data_stop
+        self.requests = {'auth': 0, 'getParameter': 0, 'data': 0}
+        self.url = None
+        self._server = None
+        self._lock = threading.Lock()
+
+    def inventory(self) -> dict:
+        """Inventory in the layout of AMDA._pack_inventory, to be loaded with AMDA._unpack_inventory"""
+        return {
+            'mission': {'fake-mission': {'xml:id': 'fake-mission'}},
+            'dataset': {'fake-dataset': {
+                'xml:id': 'fake-dataset', 'mission': 'fake-mission',
+                'sampling': f'{self.cadence.total_seconds():g}S',
+                'dataStart': self.data_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'dataStop': self.data_stop.strftime('%Y-%m-%dT%H:%M:%SZ')
+            }},
+            'parameter': {name: {'xml:id': name, 'mission': 'fake-mission', 'dataset': 'fake-dataset'}
+                          for name in self.parameters}
+        }
+
+    def generate(self, parameter_id: str, start_time: datetime, stop_time: datetime) -> pds.DataFrame:
+        step = int(self.cadence / timedelta(microseconds=1)) * 1000
+        start = np.datetime64(max(start_time, self.data_start), 'ns').astype(np.int64)
+        stop = np.datetime64(min(stop_time, self.data_stop), 'ns').astype(np.int64)
+        times = np.arange(-(-start // step) * step, stop, step)
+        phase = times / 1e9 / 3600.
+        return pds.DataFrame(
+            {i + 1: 10. * np.sin(phase + i) for i in range(self.columns)},
+            index=pds.to_datetime(times))
+
+    def render(self, parameter_id: str, start_time: datetime, stop_time: datetime) -> str:
+        df = self.generate(parameter_id, start_time, stop_time)
+        header = HEADER.format(
+            parameter_id=parameter_id,
+            components=','.join(f'c{i}' for i in range(self.columns)),
+            interval_start=start_time.isoformat(), interval_stop=stop_time.isoformat(),
+            columns=', '.join(f'{parameter_id}[{i}]' for i in range(self.columns)))
+        return header + df.to_csv(sep=' ', header=False, float_format='%.3f', date_format='%Y-%m-%dT%H:%M:%S.%f')
+
+    def _count(self, name):
+        with self._lock:
+            self.requests[name] += 1
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        params = {key: values[0] for key, values in parse_qs(environ.get('QUERY_STRING', '')).items()}
+        status, content_type = '200 OK', 'text/plain'
+        if path.endswith('/php/rest/auth.php'):
+            self._count('auth')
+            body = str(uuid.uuid4())
+        elif path.endswith('/php/rest/getParameter.php'):
+            self._count('getParameter')
+            time.sleep(self.latency)
+            with self._lock:
+                fail, self.failures = self.failures > 0, max(self.failures - 1, 0)
+            start_time = datetime.fromisoformat(params['startTime'])
+            stop_time = datetime.fromisoformat(params['stopTime'])
+            content_type = 'application/json'
+            if fail:
+                status, body = '500 Internal Server Error', 'Internal Server Error'
+            elif params.get('parameterID') not in self.parameters or \
+                    stop_time <= self.data_start or start_time >= self.data_stop:
+                body = json.dumps({'success': False})
+            else:
+                query = urlencode({key: params[key] for key in ('parameterID', 'startTime', 'stopTime')})
+                body = json.dumps({'success': True, 'status': 'done',
+                                   'dataFileURLs': f'{application_uri(environ)}data/file.txt?{query}'})
+        elif path.startswith('/data/'):
+            self._count('data')
+            time.sleep(self.latency)
+            body = self.render(params['parameterID'], datetime.fromisoformat(params['startTime']),
+                               datetime.fromisoformat(params['stopTime']))
+        else:
+            status, body = '404 Not Found', 'Not found'
+        data = body.encode()
+        start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(data)))])
+        return [data]
+
+    def start(self, host='127.0.0.1', port=0) -> str:
+        self._server = make_server(host, port, self, server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = f'http://{host}:{self._server.server_port}'
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
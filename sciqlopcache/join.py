@@ -0,0 +1,87 @@
+"""Several parameters resampled on a common time grid.
+
+Grid points are the multiples of the step since 1970-01-01 inside the requested range, so that results computed for
+different requests line up and can be cached and reused piecewise.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pds
+
+# value at the closest sample, the last one before or the first one after, within the tolerance
+ASOF_METHODS = {'nearest': 'nearest', 'previous': 'backward', 'next': 'forward'}
+# statistic of the samples in [t, t + step)
+BIN_METHODS = ('mean', 'median', 'min', 'max', 'count')
+METHODS = tuple(ASOF_METHODS) + ('linear',) + BIN_METHODS
+
+
+def _ns(delta: timedelta) -> int:
+    return int(np.timedelta64(delta, 'ns').astype(np.int64))
+
+
+def check_method(method: str):
+    if method not in METHODS:
+        raise ValueError(f"Unknown join method {method}, expected one of {', '.join(METHODS)}")
+
+
+def join_key(parameter_ids: List[str], step: timedelta, method: str, tolerance: timedelta) -> str:
+    """Cache product under which joins of parameter_ids on a step grid with method and tolerance are stored"""
+    return f"join:{method}:{step.total_seconds():g}:{tolerance.total_seconds():g}:{','.join(parameter_ids)}"
+
+
+def make_grid(start_time: datetime, stop_time: datetime, step: timedelta) -> pds.DatetimeIndex:
+    """Grid points in [start_time, stop_time]"""
+    step_ns = _ns(step)
+    start = np.datetime64(start_time, 'ns').astype(np.int64)
+    stop = np.datetime64(stop_time, 'ns').astype(np.int64)
+    return pds.DatetimeIndex(np.arange(-(-start // step_ns) * step_ns, stop + 1, step_ns).astype('datetime64[ns]'))
+
+
+def margin(step: timedelta, method: str, tolerance: timedelta) -> timedelta:
+    """How far past the last grid point samples are needed (and before the first one, except for bins)"""
+    return step if method in BIN_METHODS else tolerance
+
+
+def resample(df: Optional[pds.DataFrame], grid: pds.DatetimeIndex, method: str, step: timedelta,
+             tolerance: timedelta, width: int = 0) -> pds.DataFrame:
+    """Values of df at each grid point, NaN where no sample is close enough (or in the bin).
+    Without df, width columns of NaN (of 0 for 'count').
+    """
+    if df is None or not len(df):
+        return pds.DataFrame(0 if method == 'count' else np.nan, index=grid,
+                             columns=df.columns if df is not None else range(width))
+    if method in ASOF_METHODS:
+        return pds.merge_asof(pds.DataFrame(index=grid), df, left_index=True, right_index=True,
+                              direction=ASOF_METHODS[method], tolerance=pds.Timedelta(tolerance))
+    times = df.index.values.astype('datetime64[ns]').astype(np.int64)
+    if method == 'linear':
+        points = grid.values.astype('datetime64[ns]').astype(np.int64)
+        # no value between samples further apart than the tolerance
+        after = np.searchsorted(times, points, side='left')
+        before = np.clip(after - 1, 0, len(times) - 1)
+        after = np.clip(after, 0, len(times) - 1)
+        exact = times[after] == points
+        ok = exact | ((times[before] <= points) & (times[after] >= points) &
+                      (times[after] - times[before] <= _ns(tolerance)))
+        return pds.DataFrame({
+            name: np.where(ok, np.interp(points, times, df[name].values.astype(float), left=np.nan, right=np.nan),
+                           np.nan)
+            for name in df.columns}, index=grid, columns=df.columns)
+    bins = ((times // _ns(step)) * _ns(step)).astype('datetime64[ns]')
+    return df.groupby(pds.DatetimeIndex(bins)).agg(method).reindex(grid, fill_value=0 if method == 'count' else np.nan)
+
+
+def join(frames: dict, grid: pds.DatetimeIndex, method: str, step: timedelta, tolerance: timedelta,
+         widths: Optional[Dict[str, int]] = None) -> pds.DataFrame:
+    """frames (parameter ID -> DataFrame) resampled on grid side by side, columns named '<parameter>[<i>]'.
+    A parameter without data (None) gets widths[parameter] columns.
+    """
+    columns = []
+    for parameter_id, df in frames.items():
+        resampled = resample(df, grid, method, step, tolerance, (widths or {}).get(parameter_id, 0))
+        resampled.columns = [f'{parameter_id}[{i}]' for i in range(resampled.shape[1])]
+        columns.append(resampled)
+    result = pds.concat(columns, axis=1) if columns else pds.DataFrame(index=grid)
+    result.index.name = None
+    return result
@@ -0,0 +1,111 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class Histogram:
+    __slots__ = ['buckets', 'counts', 'count', 'sum']
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Thread-safe counters and histograms, rendered in Prometheus text exposition format."""
+
+    HELP = {
+        'sciqlopcache_stage_seconds': 'Time spent in each processing stage, upstream stages included',
+        'sciqlopcache_cache_hits_total': 'Cache entries used to answer requests',
+        'sciqlopcache_cache_misses_total': 'Missing ranges fetched from upstream',
+        'sciqlopcache_upstream_retries_total': 'Upstream requests retried after a failure',
+        'sciqlopcache_chunks_quarantined_total': 'Unreadable chunks set aside and fetched again',
+        'sciqlopcache_shared_hits_total': 'Chunks copied from the shared cache instead of fetched from upstream',
+        'sciqlopcache_bytes_served_total': 'In-memory size of the data served, by source',
+        'sciqlopcache_requests_total': 'Number of get_parameter requests',
+    }
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(self.buckets)
+            series[key].observe(value)
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('sciqlopcache_stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def hit_ratio(self) -> float:
+        hits = self.counter('sciqlopcache_cache_hits_total')
+        total = hits + self.counter('sciqlopcache_cache_misses_total')
+        return hits / total if total else 0.
+
+    def to_prometheus(self, gauges: Dict[str, Dict[tuple, float]] = None) -> str:
+        lines = []
+
+        def header(name, kind):
+            if name in self.HELP:
+                lines.append(f'# HELP {name} {self.HELP[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                header(name, 'counter')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+            for name, series in sorted(self._histograms.items()):
+                header(name, 'histogram')
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+        for name, series in sorted((gauges or {}).items()):
+            header(name, 'gauge')
+            for labels, value in sorted(series.items()):
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,117 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .datetime_range import DateTimeRange
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Spaces calls to wait() so that at most `rate` of them return per second, shared between threads."""
+
+    def __init__(self, rate: float = None):
+        self.interval = 1. / rate if rate else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class FetchScheduler:
+    """Runs upstream requests: large ranges are split in bounded pieces, at most max_concurrency requests run at
+    once whatever the number of callers, each server has its own rate limit and failed pieces are retried alone.
+    """
+
+    def __init__(self, max_concurrency: int = 4, rate: float = None, rates: Dict[str, float] = None,
+                 max_span: timedelta = timedelta(days=7), max_points: int = 500000, retries: int = 2,
+                 retry_delay: float = 1.):
+        self.max_concurrency = max_concurrency
+        # requests started per second, by server URL, `rate` for the others (None: unlimited)
+        self.rate = rate
+        self.rates = dict(rates or {})
+        self.max_span = max_span
+        # bound on the samples of a single request, used with the parameter cadence when known
+        self.max_points = max_points
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._limiters: Dict[str, RateLimiter] = {}
+        # taken by every running request, pieces run in the caller thread included
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def limiter(self, server: str) -> RateLimiter:
+        with self._lock:
+            if server not in self._limiters:
+                self._limiters[server] = RateLimiter(self.rates.get(server, self.rate))
+            return self._limiters[server]
+
+    def request_span(self, cadence: Optional[timedelta] = None) -> timedelta:
+        if cadence is not None and cadence > timedelta(0):
+            return min(self.max_span, cadence * self.max_points)
+        return self.max_span
+
+    def split(self, ranges: List[DateTimeRange], cadence: Optional[timedelta] = None) -> List[DateTimeRange]:
+        span = self.request_span(cadence)
+        return [piece for r in ranges for piece in r.split(span)]
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                    thread_name_prefix='sciqlopcache-fetch')
+            return self._executor
+
+    def _attempt(self, server: str, fetch: Callable[[DateTimeRange], Any], piece: DateTimeRange,
+                 on_retry: Optional[Callable[[DateTimeRange, Exception], None]]):
+        limiter = self.limiter(server)
+        for attempt in range(self.retries + 1):
+            try:
+                with self._slots:
+                    limiter.wait()
+                    return fetch(piece)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                log.debug(f'''Retrying {piece} on {server} after: {e}''')
+                if on_retry is not None:
+                    on_retry(piece, e)
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def run(self, server: str, pieces: List[DateTimeRange], fetch: Callable[[DateTimeRange], Any],
+            on_retry: Optional[Callable[[DateTimeRange, Exception], None]] = None
+            ) -> Iterator[Tuple[DateTimeRange, Any, Optional[Exception]]]:
+        """Yields (piece, fetch(piece), None) or (piece, None, error) in completion order, in the caller thread so
+        each result can be committed as soon as it arrives.
+        """
+        if len(pieces) == 1:
+            try:
+                yield pieces[0], self._attempt(server, fetch, pieces[0], on_retry), None
+            except Exception as e:
+                yield pieces[0], None, e
+            return
+        executor = self._get_executor()
+        futures = {executor.submit(self._attempt, server, fetch, piece, on_retry): piece for piece in pieces}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
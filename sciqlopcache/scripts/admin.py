@@ -0,0 +1,83 @@
+import argparse
+import json
+import sys
+from datetime import datetime
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from ..cache import CacheLockedError, lock_folder
+from ..cached_amda import CachedAMDA
+from ..datetime_range import DateTimeRange
+
+import logging
+log = logging.getLogger(__name__)
+
+_COLUMNS = ('parameter', 'entries', 'chunks', 'bytes', 'span', 'gaps', 'hits', 'misses', 'last_access')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Inspect and maintain the AMDA cache. Actions changing the cache must run while the server is '
+                    'stopped, use the /admin routes otherwise.')
+    parser.add_argument('config_uri', help='Pyramid configuration file, e.g. production.ini')
+    actions = parser.add_subparsers(dest='action', required=True)
+    stats = actions.add_parser('stats', help='per parameter entries, bytes, covered span, gaps, hits and misses')
+    stats.add_argument('parameters', nargs='*', default=[], help='AMDA parameter IDs (default: all)')
+    stats.add_argument('--json', action='store_true', help='print JSON instead of a table')
+    compact = actions.add_parser('compact', help='merge contiguous chunks')
+    compact.add_argument('parameters', nargs='+', help='AMDA parameter IDs')
+    evict = actions.add_parser('evict', help='drop everything cached about parameters')
+    evict.add_argument('parameters', nargs='+', help='AMDA parameter IDs')
+    prefill = actions.add_parser('prefill', help='fill the cache of a parameter over a time range')
+    prefill.add_argument('parameter', help='AMDA parameter ID')
+    prefill.add_argument('start_time', type=datetime.fromisoformat, help='ISO 8601 start time')
+    prefill.add_argument('stop_time', type=datetime.fromisoformat, help='ISO 8601 stop time')
+    return parser.parse_args(argv)
+
+
+def format_stats(stats, out):
+    rows = [[str(s[column]) if s[column] is not None else '-' for column in _COLUMNS] for s in stats]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(_COLUMNS)]
+    for row in [list(_COLUMNS)] + rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip(), file=out)
+
+
+def run(amda: CachedAMDA, args, out=None) -> int:
+    out = out or sys.stdout
+    if args.action == 'stats':
+        stats = [amda.parameter_stats(p) for p in args.parameters] if args.parameters else amda.stats()
+        if args.json:
+            json.dump(stats, out, indent=2)
+            print(file=out)
+        else:
+            format_stats(stats, out)
+        return 0
+    if args.action == 'prefill':
+        requests = amda.fetch_missing(args.parameter, DateTimeRange(args.start_time, args.stop_time))
+        print(f'{args.parameter}: {requests} request(s)', file=out)
+    else:
+        action = amda.compact if args.action == 'compact' else amda.evict
+        for parameter_id in args.parameters:
+            print(f'{parameter_id}: {action(parameter_id)} chunk(s) removed', file=out)
+    amda._save()
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    try:
+        # stats only reads the cache and can run next to the server, the other actions rewrite its index
+        lock = lock_folder(settings.get('amda_cache_folder', '/tmp/amdacache'), exclusive=args.action != 'stats')
+    except CacheLockedError as e:
+        print(f'{e}: stop the server first or use its /admin/{args.action} route', file=sys.stderr)
+        return 1
+    try:
+        return run(CachedAMDA.from_settings(settings), args)
+    finally:
+        lock.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
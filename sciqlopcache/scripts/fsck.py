@@ -0,0 +1,145 @@
+import argparse
+import os
+import shutil
+import sys
+from datetime import datetime
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from ..cache import Cache, CacheEntry, CacheLockedError, lock_folder
+from ..chunk_codecs import checksum, decode_chunk, decode_header, decode_meta
+from ..datetime_range import DateTimeRange
+from ..text_chunks import SIDECAR_SUFFIXES
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Check every chunk of the AMDA cache and rebuild its index from the chunk files. '
+                    'Run it while the server is stopped.')
+    parser.add_argument('config_uri', help='Pyramid configuration file, e.g. production.ini')
+    parser.add_argument('--dry-run', action='store_true', help='only report, change nothing')
+    return parser.parse_args(argv)
+
+
+def _overlap(a: DateTimeRange, b: DateTimeRange) -> bool:
+    return a.start_time < b.stop_time and b.start_time < a.stop_time
+
+
+def _scan(fname):
+    """(metadata, codec, size, checksum) of a chunk file, raises if it can't be decoded"""
+    with open(fname, 'rb') as f:
+        data = f.read()
+    decode_chunk(data)
+    return decode_meta(data), decode_header(data)['codec'], len(data), checksum(data)
+
+
+def fsck(data_folder: str, dry_run: bool = False, out=None) -> dict:
+    """Rebuilds data_folder/db.json from the chunk files found in data_folder:
+    - chunks that can't be decoded are moved to data_folder/quarantine,
+    - chunks missing from the index are added back from the product and range stored in them,
+    - entries whose chunk is missing are dropped,
+    - when chunks of a product overlap, the longest ones are kept and the others quarantined,
+    - negative entries are kept unless expired or overlapping a chunk.
+    Returns counts of what was found.
+    """
+    out = out or sys.stderr
+    report = {'chunks': 0, 'recovered': 0, 'missing': 0, 'quarantined': 0, 'entries': 0}
+    index = data_folder + '/db.json'
+    try:
+        cache = Cache(index)
+    except Exception as e:
+        print(f'{index}: unreadable index ({e}), rebuilding it from scratch', file=out)
+        if dry_run:
+            # nonexistent, stands for an empty index and is never saved
+            cache = Cache(index + '.dry-run')
+        else:
+            os.replace(index, index + '.corrupt')
+            cache = Cache(index)
+    indexed = {entry.data_file: (product, entry) for product in cache for entry in cache[product]
+               if not entry.is_negative}
+    quarantine = []
+    candidates = {}
+    # chunk files are bare uuids, index, sidecar and temporary files all have a '.' in their name
+    for name in sorted(os.listdir(data_folder)):
+        fname = data_folder + '/' + name
+        if '.' in name or not os.path.isfile(fname):
+            continue
+        report['chunks'] += 1
+        try:
+            meta, codec, size, crc = _scan(fname)
+        except Exception as e:
+            print(f'{fname}: unreadable ({e})', file=out)
+            quarantine.append(fname)
+            continue
+        if fname in indexed:
+            product, entry = indexed[fname]
+            dt_range = entry.dt_range
+        elif meta is not None:
+            product = meta['product']
+            dt_range = DateTimeRange(datetime.fromisoformat(meta['start']), datetime.fromisoformat(meta['stop']))
+            report['recovered'] += 1
+            print(f'{fname}: recovered {product} {dt_range}', file=out)
+        else:
+            print(f'{fname}: not indexed and without metadata', file=out)
+            quarantine.append(fname)
+            continue
+        candidates.setdefault(product, []).append(CacheEntry(dt_range, fname, codec=codec, size=size, checksum=crc))
+    for fname, (product, entry) in indexed.items():
+        if not os.path.isfile(fname):
+            report['missing'] += 1
+            print(f'{fname}: missing chunk of {product} {entry.dt_range}', file=out)
+
+    data = {}
+    now = datetime.now()
+    for product in set(candidates) | set(cache):
+        kept = []
+        for entry in sorted(candidates.get(product, []),
+                            key=lambda e: (e.start_time - e.stop_time, e.start_time)):
+            if any(_overlap(entry.dt_range, other.dt_range) for other in kept):
+                print(f'{entry.data_file}: overlaps another chunk of {product}', file=out)
+                quarantine.append(entry.data_file)
+            else:
+                kept.append(entry)
+        negatives = [entry for entry in (cache[product] if product in cache else [])
+                     if entry.is_negative and not entry.expired(now) and
+                     not any(_overlap(entry.dt_range, other.dt_range) for other in kept)]
+        if kept or negatives:
+            data[product] = sorted(kept + negatives)
+            report['entries'] += len(data[product])
+    report['quarantined'] = len(quarantine)
+    print(f'{report["chunks"]} chunk(s), {report["recovered"]} recovered, {report["missing"]} missing, '
+          f'{report["quarantined"]} quarantined, {report["entries"]} index entries', file=out)
+    if not dry_run:
+        if quarantine:
+            os.makedirs(data_folder + '/quarantine', exist_ok=True)
+        for chunk in quarantine:
+            for fname in [chunk] + [chunk + suffix for suffix in SIDECAR_SUFFIXES]:
+                if os.path.exists(fname):
+                    shutil.move(fname, data_folder + '/quarantine/' + os.path.basename(fname))
+        cache._data = data
+        cache._save()
+    return report
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    data_folder = settings.get('amda_cache_folder', '/tmp/amdacache')
+    try:
+        lock = lock_folder(data_folder, exclusive=True)
+    except CacheLockedError as e:
+        print(f'{e}: stop the server first', file=sys.stderr)
+        return 1
+    try:
+        fsck(data_folder, dry_run=args.dry_run)
+    finally:
+        lock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from ..cache import CacheLockedError, lock_folder
+from ..cached_amda import CachedAMDA
+from ..datetime_range import DateTimeRange
+from ..scheduler import RateLimiter
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Prefill the AMDA cache for a set of parameters over a time range. The server must be stopped '
+                    'since both would rewrite the cache index, use its /admin/prefill route while it runs.')
+    parser.add_argument('config_uri', help='Pyramid configuration file, e.g. production.ini')
+    parser.add_argument('start_time', type=datetime.fromisoformat, help='ISO 8601 start time')
+    parser.add_argument('stop_time', type=datetime.fromisoformat, help='ISO 8601 stop time')
+    parser.add_argument('parameters', nargs='*', default=[], help='AMDA parameter IDs')
+    parser.add_argument('--dataset', action='append', default=[],
+                        help='add every parameter of this dataset (resolved through the inventory)')
+    parser.add_argument('--mission', action='append', default=[],
+                        help='add every parameter of this mission (resolved through the inventory)')
+    parser.add_argument('--chunk', type=float, default=24.,
+                        help='duration in hours of each upstream request (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='maximum number of concurrent upstream requests (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='maximum number of upstream requests started per second')
+    return parser.parse_args(argv)
+
+
+def prefill(amda: CachedAMDA, parameters, dt_range: DateTimeRange, chunk: timedelta, jobs: int = 4,
+            rate: float = None, out=None) -> int:
+    """Fills the cache for every parameter over dt_range, one task per chunk.
+    The cache index is saved after each task so an interrupted run resumes where it stopped: already cached
+    chunks have no missing range and are skipped without upstream request.
+    Returns the number of failed tasks.
+    """
+    out = out or sys.stderr
+    limiter = RateLimiter(rate)
+    tasks = [(parameter_id, r) for parameter_id in parameters for r in dt_range.split(chunk)]
+
+    def run(parameter_id, r):
+        limiter.wait()
+        return amda.fetch_missing(parameter_id, r)
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run, *task): task for task in tasks}
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                parameter_id, r = futures[future]
+                try:
+                    fetched = future.result()
+                    status = f'{fetched} request(s)' if fetched else 'already cached'
+                except Exception as e:
+                    failed += 1
+                    status = f'failed: {e}'
+                    log.exception(f'''Prefill of {parameter_id} {r} failed''')
+                amda._save()
+                print(f'[{done}/{len(tasks)}] {parameter_id} {r}: {status}', file=out, flush=True)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=True, cancel_futures=True)
+            amda._save()
+            raise
+    return failed
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    try:
+        lock = lock_folder(settings.get('amda_cache_folder', '/tmp/amdacache'), exclusive=True)
+    except CacheLockedError as e:
+        print(f'{e}: stop the server first or use its /admin/prefill route', file=sys.stderr)
+        return 1
+    amda = None
+    try:
+        amda = CachedAMDA.from_settings(settings)
+        parameters = list(args.parameters)
+        if args.dataset or args.mission:
+            parameters += [p for p in amda.find_parameters(missions=args.mission, datasets=args.dataset)
+                           if p not in parameters]
+        if not parameters:
+            print('Nothing to prefill: no parameter given or resolved', file=sys.stderr)
+            return 1
+        try:
+            failed = prefill(amda, parameters, DateTimeRange(args.start_time, args.stop_time),
+                             chunk=timedelta(hours=args.chunk), jobs=args.jobs, rate=args.rate)
+        except KeyboardInterrupt:
+            print('Interrupted, progress saved; run the same command again to resume', file=sys.stderr)
+            return 130
+        return 1 if failed else 0
+    finally:
+        # the index is saved when amda goes away, while the folder is still locked
+        del amda
+        lock.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
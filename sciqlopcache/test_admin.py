@@ -0,0 +1,131 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from argparse import Namespace
+from datetime import datetime, timedelta
+
+from .cache import EMPTY, lock_folder
+from .cached_amda import CachedAMDA
+from .datetime_range import DateTimeRange
+from .fake_amda import FakeAMDA
+from .scripts.admin import main, run
+
+
+class _AdminTest(unittest.TestCase):
+    def setUp(self):
+        self.data_folder = tempfile.mkdtemp()
+        self.fake = FakeAMDA()
+        self.amda = CachedAMDA(server_url='http://unused', data_folder=self.data_folder)
+        # three contiguous hours, then a hole and a lone hour
+        for hour in (1, 2, 3, 5):
+            self._add('fake_b', datetime(2006, 1, 8, hour), timedelta(hours=1))
+        self._add('fake_c', datetime(2006, 1, 8), timedelta(days=1))
+        self.amda.add_negative_entry('fake_b', DateTimeRange(datetime(2006, 1, 8, 7), datetime(2006, 1, 8, 8)), EMPTY)
+
+    def tearDown(self):
+        del self.amda
+        shutil.rmtree(self.data_folder)
+
+    def _add(self, product, start, span):
+        self.amda.add_to_cache(product, DateTimeRange(start, start + span),
+                               self.fake.generate(product, start, start + span))
+
+    def test_stats(self):
+        stats = self.amda.parameter_stats('fake_b')
+        self.assertEqual((stats['entries'], stats['chunks'], stats['gaps']), (5, 4, 2))
+        self.assertEqual(stats['span'], 4 * 3600.)
+        self.assertEqual((stats['start'], stats['stop']), ('2006-01-08T01:00:00', '2006-01-08T08:00:00'))
+        self.assertEqual(stats['bytes'], sum(os.path.getsize(e.data_file) for e in self.amda.cache['fake_b']
+                                             if not e.is_negative))
+        self.assertEqual((stats['hits'], stats['misses'], stats['last_access']), (0, 0, None))
+        self.assertEqual([s['parameter'] for s in self.amda.stats()], ['fake_c', 'fake_b'])
+
+    def test_access_statistics(self):
+        self.amda.get_parameter(datetime(2006, 1, 8, 1, 30), datetime(2006, 1, 8, 2, 30), 'fake_b')
+        stats = self.amda.parameter_stats('fake_b')
+        self.assertEqual((stats['hits'], stats['misses']), (2, 0))
+        self.assertIsNotNone(stats['last_access'])
+
+    def test_compact(self):
+        before = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 4), 'fake_b')
+        old_files = [e.data_file for e in self.amda.cache['fake_b'] if not e.is_negative]
+        self.assertEqual(self.amda.compact('fake_b'), 2)
+        chunks = sorted(e for e in self.amda.cache['fake_b'] if not e.is_negative)
+        self.assertEqual([c.dt_range for c in chunks],
+                         [DateTimeRange(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 4)),
+                          DateTimeRange(datetime(2006, 1, 8, 5), datetime(2006, 1, 8, 6))])
+        # kept for the requests that looked them up before
+        self.assertTrue(all(os.path.exists(f) for f in old_files[:3]))
+        after = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 4), 'fake_b')
+        self.assertTrue(after.equals(before))
+        self.assertEqual(self.amda.compact('fake_b'), 0)
+        self.amda.retire_delay = timedelta(0)
+        self.amda._remove_retired()
+        self.assertFalse(any(os.path.exists(f) for f in old_files[:3]))
+
+    def test_compact_while_reading(self):
+        self.amda.retire_delay = timedelta(0)
+        before = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 4), 'fake_b')
+        compacted = []
+
+        def compact_then_read(entry):
+            if not compacted:
+                compacted.append(None)
+                # another request compacts the chunks between the lookup and the read
+                compacted.append(self.amda.compact('fake_b'))
+            return CachedAMDA._read_chunk(self.amda, entry)
+
+        with mock.patch.object(self.amda, '_read_chunk', side_effect=compact_then_read):
+            after = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 4), 'fake_b')
+        self.assertEqual(compacted, [None, 2])
+        self.assertTrue(after.equals(before))
+        self.assertEqual(self.amda.metrics.counter('sciqlopcache_chunks_quarantined_total'), 0)
+
+    def test_compact_is_bounded(self):
+        size = self.amda.cache['fake_b'][0].size
+        self.assertEqual(self.amda.compact('fake_b', max_bytes=2 * size), 1)
+        self.assertEqual(self.amda.parameter_stats('fake_b')['chunks'], 3)
+
+    def test_evict(self):
+        files = [e.data_file for e in self.amda.cache['fake_b'] if not e.is_negative]
+        self.assertEqual(self.amda.evict('fake_b'), 4)
+        self.assertNotIn('fake_b', self.amda.cache)
+        self.assertFalse(any(os.path.exists(f) for f in files))
+        self.assertEqual([s['parameter'] for s in self.amda.stats()], ['fake_c'])
+
+    def test_cli(self):
+        out = io.StringIO()
+        run(self.amda, Namespace(action='stats', parameters=[], json=False), out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('parameter'))
+        self.assertTrue(lines[2].startswith('fake_b'))
+        out = io.StringIO()
+        run(self.amda, Namespace(action='stats', parameters=['fake_c'], json=True), out)
+        self.assertEqual(json.loads(out.getvalue())[0]['chunks'], 1)
+        out = io.StringIO()
+        run(self.amda, Namespace(action='evict', parameters=['fake_c']), out)
+        self.assertEqual(out.getvalue(), 'fake_c: 1 chunk(s) removed\n')
+
+    def test_cli_locks_the_cache(self):
+        server = lock_folder(self.data_folder)
+        with mock.patch('sciqlopcache.scripts.admin.setup_logging'), \
+                mock.patch('sciqlopcache.scripts.admin.get_appsettings',
+                           return_value={'amda_cache_folder': self.data_folder}), \
+                mock.patch.object(CachedAMDA, 'from_settings', side_effect=lambda _: self.amda) as from_settings, \
+                mock.patch('sys.stdout', new_callable=io.StringIO), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as err:
+            self.assertEqual(main(['unused.ini', 'evict', 'fake_c']), 1)
+            self.assertIn('/admin/evict', err.getvalue())
+            from_settings.assert_not_called()
+            self.assertIn('fake_c', self.amda.cache)
+            # read only, next to a running server
+            self.assertEqual(main(['unused.ini', 'stats']), 0)
+            server.close()
+            self.assertEqual(main(['unused.ini', 'evict', 'fake_c']), 0)
+        self.assertNotIn('fake_c', self.amda.cache)
+        # released once done
+        lock_folder(self.data_folder, exclusive=True).close()
@@ -0,0 +1,129 @@
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from .backends import FolderBackend, S3Backend, backend_from_url, chunk_key, parse_chunk_key
+from .datetime_range import DateTimeRange
+
+
+class _NoSuchKey(Exception):
+    response = {'Error': {'Code': 'NoSuchKey'}}
+
+
+class _Body:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeS3Client:
+    """In memory stand-in for the few boto3 S3 client calls S3Backend uses, pages listings like S3"""
+
+    def __init__(self, page_size=1000):
+        self.buckets = {}
+        self.page_size = page_size
+        self.listed = 0
+
+    def put_object(self, Bucket, Key, Body):
+        self.buckets.setdefault(Bucket, {})[Key] = bytes(Body)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.buckets.get(Bucket, {}):
+            raise _NoSuchKey(Key)
+        return {'Body': _Body(self.buckets[Bucket][Key])}
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=None):
+        keys = sorted(key for key in self.buckets.get(Bucket, {}) if key.startswith(Prefix) and key > StartAfter)
+        first = int(ContinuationToken or 0)
+        page = keys[first:first + self.page_size]
+        self.listed += len(page)
+        response = {'Contents': [{'Key': key} for key in page], 'IsTruncated': first + self.page_size < len(keys)}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(first + self.page_size)
+        return response
+
+
+class _BackendTest:
+    def test_get_missing_key(self):
+        self.assertIsNone(self.backend.get('p/nothing'))
+
+    def test_put_get_list(self):
+        self.backend.put('p/a', b'a')
+        self.backend.put('p/b', b'b')
+        self.backend.put('q/c', b'c')
+        self.assertEqual(self.backend.get('p/a'), b'a')
+        self.assertEqual(sorted(self.backend.list('p/')), ['p/a', 'p/b'])
+        self.assertEqual(self.backend.list('r/'), [])
+
+    def test_chunks(self):
+        jan = DateTimeRange(datetime(2006, 1, 1), datetime(2006, 1, 8))
+        feb = DateTimeRange(datetime(2006, 2, 1), datetime(2006, 2, 8))
+        self.backend.put(chunk_key('c1/b', jan), b'jan')
+        self.backend.put(chunk_key('c1/b', feb), b'feb')
+        self.backend.put(chunk_key('c1', feb), b'other')
+        found = self.backend.chunks('c1/b', DateTimeRange(datetime(2006, 2, 5), datetime(2006, 2, 6)))
+        self.assertEqual([(r, self.backend.get(key)) for r, key in found], [(feb, b'feb')])
+        self.assertEqual(len(self.backend.chunks('c1/b', DateTimeRange(datetime(2006, 1, 1), datetime(2007, 1, 1)))),
+                         2)
+
+    def test_chunks_of_a_long_history(self):
+        days = [DateTimeRange(datetime(2006, 1, 1) + timedelta(days=i), datetime(2006, 1, 2) + timedelta(days=i))
+                for i in range(60)]
+        for day in days:
+            self.backend.put(chunk_key('p', day), b'day')
+        found = self.backend.chunks('p', DateTimeRange(datetime(2006, 1, 20, 12), datetime(2006, 1, 20, 13)))
+        self.assertEqual([r for r, _ in found], [days[19]])
+        found = self.backend.chunks('p', DateTimeRange(datetime(2006, 1, 20, 12), datetime(2006, 1, 21, 12)))
+        self.assertEqual([r for r, _ in found], days[19:21])
+
+
+class _FolderBackendTest(_BackendTest, unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.backend = FolderBackend(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+class _S3BackendTest(_BackendTest, unittest.TestCase):
+    def setUp(self):
+        self.client = FakeS3Client(page_size=1)
+        self.backend = S3Backend('bucket', '/cache/', client=self.client)
+
+    def test_chunks_listing_is_bounded(self):
+        for i in range(60):
+            self.backend.put(chunk_key('p', DateTimeRange(datetime(2006, 1, 1) + timedelta(days=i),
+                                                          datetime(2006, 1, 2) + timedelta(days=i))), b'day')
+        self.backend.chunks('p', DateTimeRange(datetime(2006, 1, 20, 12), datetime(2006, 1, 20, 13)))
+        # from a week before to the first chunk past the range
+        self.assertEqual(self.client.listed, 8)
+
+    def test_keys_are_prefixed(self):
+        self.backend.put('p/a', b'a')
+        self.assertEqual(list(self.client.buckets['bucket']), ['cache/p/a'])
+
+
+class _KeysTest(unittest.TestCase):
+    def test_chunk_key_round_trip(self):
+        dt_range = DateTimeRange(datetime(2006, 1, 8, 1, 2, 3, 4), datetime(2006, 1, 9))
+        key = chunk_key('c1_b_gsm', dt_range)
+        self.assertTrue(key.startswith('c1_b_gsm/'))
+        self.assertEqual(parse_chunk_key(key), dt_range)
+        self.assertNotEqual(key, chunk_key('c1_b_gsm', dt_range))
+        self.assertIsNone(parse_chunk_key('c1_b_gsm/garbage'))
+
+    def test_backend_from_url(self):
+        self.assertIsNone(backend_from_url(''))
+        folder = tempfile.mkdtemp()
+        try:
+            self.assertEqual(backend_from_url('file://' + folder).path, folder)
+            self.assertEqual(backend_from_url(folder).path, folder)
+        finally:
+            shutil.rmtree(folder)
+        with self.assertRaises(ValueError):
+            backend_from_url('ftp://host/path')
+
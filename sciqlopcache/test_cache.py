@@ -1,8 +1,9 @@
 import unittest
 from ddt import ddt, data, unpack
 from datetime import datetime, timedelta
-from .cache import CacheEntry, Cache
-from .datetime_range import DateTimeRange
+from .cache import CacheEntry, Cache, ERROR
+from .datetime_range import DateTimeRange, DateTimeRangeSet
+import json
 import uuid
 import os
 
@@ -147,10 +148,66 @@ class _CacheTest(unittest.TestCase):
         entry = self.cache.get_entries(product, dt_range)
         self.assertEqual(entry, expected)
 
+    def test_get_missing_ranges_with_overlapping_entries(self):
+        self.cache.add_entry('product2', CacheEntry(
+            DateTimeRange(datetime(2006, 1, 8, 0, 0, 0), datetime(2006, 1, 8, 2, 0, 0)), 'file0'))
+        self.cache.add_entry('product2', CacheEntry(
+            DateTimeRange(datetime(2006, 1, 8, 1, 0, 0), datetime(2006, 1, 8, 3, 0, 0)), 'file1'))
+        self.cache.add_entry('product2', CacheEntry(
+            DateTimeRange(datetime(2006, 1, 8, 1, 30, 0), datetime(2006, 1, 8, 1, 40, 0)), 'file2'))
+        self.cache.add_entry('product2', CacheEntry(
+            DateTimeRange(datetime(2006, 1, 8, 4, 0, 0), datetime(2006, 1, 8, 5, 0, 0)), 'file3'))
+        missing = self.cache.get_missing_ranges(
+            'product2', DateTimeRange(datetime(2006, 1, 7, 23, 0, 0), datetime(2006, 1, 8, 6, 0, 0)))
+        self.assertEqual(missing, [
+            DateTimeRange(datetime(2006, 1, 7, 23, 0, 0), datetime(2006, 1, 8, 0, 0, 0)),
+            DateTimeRange(datetime(2006, 1, 8, 3, 0, 0), datetime(2006, 1, 8, 4, 0, 0)),
+            DateTimeRange(datetime(2006, 1, 8, 5, 0, 0), datetime(2006, 1, 8, 6, 0, 0))
+        ])
+
+    def test_purge_expired(self):
+        now = datetime(2020, 1, 1)
+        expired = CacheEntry(DateTimeRange(datetime(2006, 2, 20), datetime(2006, 2, 21)), None, ERROR,
+                             now - timedelta(seconds=1))
+        self.cache.add_entry('product1', expired)
+        self.cache.add_entry('product1', CacheEntry(DateTimeRange(datetime(2006, 2, 21), datetime(2006, 2, 22)),
+                                                    None, ERROR, now + timedelta(seconds=1)))
+        self.assertEqual(len(self.cache.get_entries('product1', DateTimeRange(datetime(2006, 2, 20),
+                                                                              datetime(2006, 2, 22)))), 2)
+        self.assertEqual(self.cache.purge_expired('product1', now), [expired])
+        self.assertEqual(self.cache.get_missing_ranges('product1', DateTimeRange(datetime(2006, 2, 20),
+                                                                                 datetime(2006, 2, 22))),
+                         [DateTimeRange(datetime(2006, 2, 20), datetime(2006, 2, 21))])
+        self.assertEqual(self.cache.purge_expired('product1', now), [])
+
+    def test_replace_entry(self):
+        old = self.cache['product1'][0]
+        new = CacheEntry(old.dt_range, 'other_file')
+        self.assertTrue(self.cache.replace_entry('product1', old, new))
+        self.assertTrue(self.cache.has_entry('product1', new))
+        self.assertFalse(self.cache.has_entry('product1', old))
+        self.assertFalse(self.cache.replace_entry('product1', old, new))
+        self.assertFalse(self.cache.replace_entry('unknown', old, new))
+
+    def test_load_index_without_negative_fields(self):
+        self.cache._save()
+        with open(self.dbfile) as f:
+            index = json.load(f)
+        for entry in index['product1']:
+            del entry['reason']
+            del entry['expires']
+        with open(self.dbfile, 'w') as f:
+            json.dump(index, f)
+        entries = Cache(self.dbfile)['product1']
+        self.assertEqual(len(entries), 12)
+        self.assertTrue(all(e.reason is None and e.expires is None for e in entries))
+
     def tearDown(self):
+        meta_file = self.cache.meta_file
         del self.cache
-        if os.path.exists(self.dbfile):
-            os.remove(self.dbfile)
+        for f in (self.dbfile, meta_file):
+            if os.path.exists(f):
+                os.remove(f)
 
 
 @ddt
@@ -220,3 +277,75 @@ class _DateTimeRangeTest(unittest.TestCase):
     def test_substract_with_wrong_type(self):
         with self.assertRaises(TypeError):
             DateTimeRange(datetime(2006, 1, 8, 3, 0, 0), datetime(2006, 1, 8, 4, 0, 0)) - 1
+
+    def test_split(self):
+        dt_range = DateTimeRange(datetime(2006, 1, 8, 0, 0, 0), datetime(2006, 1, 8, 2, 30, 0))
+        self.assertEqual(dt_range.split(timedelta(hours=1)), [
+            DateTimeRange(datetime(2006, 1, 8, 0, 0, 0), datetime(2006, 1, 8, 1, 0, 0)),
+            DateTimeRange(datetime(2006, 1, 8, 1, 0, 0), datetime(2006, 1, 8, 2, 0, 0)),
+            DateTimeRange(datetime(2006, 1, 8, 2, 0, 0), datetime(2006, 1, 8, 2, 30, 0))
+        ])
+        with self.assertRaises(ValueError):
+            dt_range.split(timedelta(0))
+
+    def test_substract_list_keeps_order(self):
+        ranges = [
+            DateTimeRange(datetime(2006, 1, 8, 3, 0, 0), datetime(2006, 1, 8, 4, 0, 0)),
+            DateTimeRange(datetime(2006, 1, 8, 1, 0, 0), datetime(2006, 1, 8, 2, 0, 0))
+        ]
+        expected_order = list(ranges)
+        diff = DateTimeRange(datetime(2006, 1, 8, 0, 0, 0), datetime(2006, 1, 8, 5, 0, 0)) - ranges
+        self.assertEqual(ranges, expected_order)
+        self.assertEqual(len(diff), 3)
+
+
+def _range_set(*hours):
+    return DateTimeRangeSet([datetime(2006, 1, 8) + timedelta(hours=start) for start in hours[::2]],
+                            [datetime(2006, 1, 8) + timedelta(hours=stop) for stop in hours[1::2]])
+
+
+@ddt
+class _DateTimeRangeSetTest(unittest.TestCase):
+    @data(
+        (_range_set(0, 2, 1, 3), _range_set(0, 3)),
+        (_range_set(4, 5, 0, 1, 1, 2), _range_set(0, 2, 4, 5)),
+        (_range_set(0, 10, 2, 3, 4, 5), _range_set(0, 10)),
+        (_range_set(1, 1, 2, 3), _range_set(2, 3)),
+    )
+    @unpack
+    def test_normalization(self, range_set, expected):
+        self.assertEqual(range_set, expected)
+
+    @data(
+        (_range_set(0, 2, 5, 6), _range_set(1, 3), _range_set(0, 3, 5, 6)),
+        (_range_set(0, 1), _range_set(), _range_set(0, 1)),
+    )
+    @unpack
+    def test_union(self, left, right, expected):
+        self.assertEqual(left | right, expected)
+
+    @data(
+        (_range_set(0, 4, 6, 10), _range_set(2, 7, 9, 12), _range_set(2, 4, 6, 7, 9, 10)),
+        (_range_set(0, 1), _range_set(1, 2), _range_set()),
+        (_range_set(0, 1), _range_set(), _range_set()),
+    )
+    @unpack
+    def test_intersection(self, left, right, expected):
+        self.assertEqual(left & right, expected)
+
+    @data(
+        (_range_set(0, 10), _range_set(2, 3, 5, 6), _range_set(0, 2, 3, 5, 6, 10)),
+        (_range_set(0, 10), _range_set(-1, 2, 8, 11), _range_set(2, 8)),
+        (_range_set(0, 10), _range_set(-1, 11), _range_set()),
+        (_range_set(0, 2, 4, 6), _range_set(1, 5), _range_set(0, 1, 5, 6)),
+        (_range_set(), _range_set(1, 5), _range_set()),
+    )
+    @unpack
+    def test_difference(self, left, right, expected):
+        self.assertEqual(left - right, expected)
+
+    def test_to_ranges(self):
+        self.assertEqual(_range_set(0, 1, 2, 3).to_ranges(), [
+            DateTimeRange(datetime(2006, 1, 8, 0, 0, 0), datetime(2006, 1, 8, 1, 0, 0)),
+            DateTimeRange(datetime(2006, 1, 8, 2, 0, 0), datetime(2006, 1, 8, 3, 0, 0))
+        ])
@@ -0,0 +1,575 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pds
+
+from .backends import FolderBackend, S3Backend, chunk_key
+from .cache import EMPTY, ERROR, OUT_OF_RANGE
+from .chunk_codecs import decode_header, encode_chunk
+from .cached_amda import CachedAMDA, UpstreamError, merge_chunks, trim_chunk
+from .datetime_range import DateTimeRange
+from .fake_amda import FakeAMDA
+from .scheduler import FetchScheduler
+from .test_backends import FakeS3Client
+from .workers import WorkerPool
+
+
+def make_chunk(start, stop, freq='1min'):
+    index = pds.date_range(start, stop, freq=freq)
+    return pds.DataFrame({1: np.arange(len(index), dtype=float)}, index=index)
+
+
+class _ChunkAssemblyTest(unittest.TestCase):
+    def test_trim_chunk(self):
+        df = make_chunk(datetime(2006, 1, 8, 0, 0), datetime(2006, 1, 8, 1, 0))
+        trimmed = trim_chunk(df, datetime(2006, 1, 8, 0, 50), datetime(2006, 1, 8, 2, 0))
+        self.assertEqual(len(trimmed), 11)
+        self.assertEqual(trimmed.index[0], datetime(2006, 1, 8, 0, 50))
+
+    def test_merge_chunks_orders_and_concatenates(self):
+        start, stop = datetime(2006, 1, 8, 0, 30), datetime(2006, 1, 8, 2, 29)
+        chunks = [
+            trim_chunk(make_chunk(datetime(2006, 1, 8, 2, 0), datetime(2006, 1, 8, 2, 59)), start, stop),
+            trim_chunk(make_chunk(datetime(2006, 1, 8, 0, 0), datetime(2006, 1, 8, 0, 59)), start, stop),
+            trim_chunk(make_chunk(datetime(2006, 1, 8, 1, 0), datetime(2006, 1, 8, 1, 59)), start, stop),
+        ]
+        result = merge_chunks(chunks)
+        self.assertEqual(len(result), 120)
+        self.assertEqual(result.index[0], start)
+        self.assertEqual(result.index[-1], stop)
+        self.assertTrue(result.index.is_monotonic_increasing)
+
+    def test_merge_chunks_empty(self):
+        self.assertIsNone(merge_chunks([]))
+        empty = trim_chunk(make_chunk(datetime(2006, 1, 8, 0, 0), datetime(2006, 1, 8, 1, 0)),
+                           datetime(2006, 1, 9), datetime(2006, 1, 10))
+        self.assertEqual(len(merge_chunks([empty])), 0)
+
+
+class _FakeAMDATestCase(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeAMDA()
+        self.fake.start()
+        self.data_folder = tempfile.mkdtemp()
+        self.amda = CachedAMDA(server_url=self.fake.url, data_folder=self.data_folder,
+                               scheduler=FetchScheduler(retry_delay=0.01))
+        self.amda._unpack_inventory(self.fake.inventory())
+
+    def tearDown(self):
+        del self.amda
+        shutil.rmtree(self.data_folder)
+        self.fake.stop()
+
+    def _negative_entries(self):
+        return [(e.reason, e.expires is not None) for e in self.amda.cache['fake_b'] if e.is_negative]
+
+
+class _CachedAMDATest(_FakeAMDATestCase):
+    def test_get_parameter_uses_cache(self):
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(df.shape, (900, 3))
+        self.assertEqual(self.fake.requests['getParameter'], 1)
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1, 10), datetime(2006, 1, 8, 1, 20), 'fake_b')
+        self.assertEqual(len(df), 151)
+        self.assertEqual(self.fake.requests['getParameter'], 1)
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1, 30), datetime(2006, 1, 8, 2, 30), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 2)
+        self.assertEqual(df.index[0], datetime(2006, 1, 8, 1, 30))
+        self.assertTrue(df.index.is_monotonic_increasing)
+
+    def test_compressed_chunks(self):
+        self.amda.chunk_codec = 'zlib'
+        expected = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(self.amda.cache['fake_b'][0].codec, 'zlib')
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 1)
+        pds.testing.assert_frame_equal(df, expected, check_freq=False)
+
+    def test_get_parameter_as_txt(self):
+        txt = self.amda.get_parameter_as_txt('2006-01-08T01:00:00', '2006-01-08T01:01:00', 'fake_b')
+        self.assertIn('# INTERVAL_START : 2006-01-08T01:00:00', txt)
+        self.assertEqual(len([line for line in txt.splitlines() if not line.startswith('#')]), 15)
+
+
+class _NegativeCacheTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_NegativeCacheTest, self).setUp()
+        self.now = datetime.now().replace(microsecond=0)
+        self.fake.data_stop = self.now - timedelta(hours=1)
+        self.amda._unpack_inventory(self.fake.inventory())
+
+    def test_errors_are_retried_after_ttl(self):
+        self.fake.failures = 1 + self.amda.scheduler.retries
+        with self.assertRaises(UpstreamError):
+            self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(self._negative_entries(), [(ERROR, True)])
+        # hits on the error entry fail too, without asking upstream again
+        with self.assertRaises(UpstreamError):
+            self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 3)
+        self.amda.cache.purge_expired('fake_b', datetime.now() + self.amda.error_ttl)
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(len(df), 900)
+        self.assertEqual(self.fake.requests['getParameter'], 4)
+        self.assertEqual(self._negative_entries(), [])
+
+    def test_out_of_dataset_range(self):
+        self.amda.get_parameter(datetime(1999, 12, 31, 23), datetime(2000, 1, 1, 1), 'fake_b')
+        self.assertEqual(self._negative_entries(), [(OUT_OF_RANGE, False)])
+        self.amda.get_parameter(self.now - timedelta(hours=2), self.now, 'fake_b')
+        # past dataStop, upstream is asked once per empty_ttl
+        self.assertEqual(self._negative_entries(), [(OUT_OF_RANGE, False), (EMPTY, True)])
+        requests = self.fake.requests['getParameter']
+        self.amda.cache.purge_expired('fake_b', datetime.now() + self.amda.empty_ttl)
+        self.amda.get_parameter(self.now - timedelta(minutes=30), self.now, 'fake_b')
+        self.assertEqual(self._negative_entries(), [(OUT_OF_RANGE, False), (OUT_OF_RANGE, True)])
+        self.assertEqual(self.fake.requests['getParameter'], requests)
+        self.amda.get_parameter(self.now - timedelta(minutes=30), self.now, 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], requests)
+
+    def test_data_past_stale_dataset_stop(self):
+        self.amda.empty_ttl = timedelta(0)
+        start, stop = self.now - timedelta(minutes=50), self.now - timedelta(minutes=20)
+        self.assertIsNone(self.amda.get_parameter(start, stop, 'fake_b'))
+        self.assertTrue(self._negative_entries())
+        # the dataset grew but the inventory still has the old dataStop
+        self.fake.data_stop = self.now
+        df = self.amda.get_parameter(start, stop, 'fake_b')
+        self.assertAlmostEqual(len(df), 450, delta=1)
+
+    def test_recent_empty_answers_expire(self):
+        self.amda.dataset['fake-dataset']['dataStop'] = (self.now + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.amda.get_parameter(self.now - timedelta(minutes=30), self.now, 'fake_b')
+        self.assertEqual(self._negative_entries(), [(EMPTY, True)])
+        self.fake.data_start = datetime(2006, 1, 8, 2)
+        self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 1, 30), 'fake_b')
+        self.assertEqual(self._negative_entries(), [(EMPTY, True), (EMPTY, False)])
+
+
+class _SplitRequestsTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_SplitRequestsTest, self).setUp()
+        # 4s cadence: one hour per request
+        self.amda.scheduler.max_points = 900
+
+    def test_large_ranges_are_split(self):
+        self.assertEqual(self.amda.parameter_cadence('fake_b'), timedelta(seconds=4))
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 5), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 4)
+        self.assertEqual(len(self.amda.cache['fake_b']), 4)
+        self.assertEqual(len(df), 3600)
+        self.assertTrue(df.index.is_monotonic_increasing)
+
+    def test_only_failed_pieces_are_retried(self):
+        self.fake.failures = 1
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 5), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 5)
+        self.assertEqual(self.amda.metrics.counter('sciqlopcache_upstream_retries_total'), 1)
+        self.assertEqual(len(df), 3600)
+
+    def test_failed_pieces_keep_the_others(self):
+        self.amda.scheduler.retries = 0
+        self.fake.failures = 1
+        with self.assertRaises(UpstreamError):
+            self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 5), 'fake_b')
+        self.assertEqual(self._negative_entries(), [(ERROR, True)])
+        # the other pieces are served from cache
+        for entry in [e for e in self.amda.cache['fake_b'] if not e.is_negative]:
+            self.assertEqual(len(self.amda.get_parameter(entry.start_time, entry.stop_time - timedelta(seconds=1),
+                                                         'fake_b')), 900)
+        self.assertEqual(self.fake.requests['getParameter'], 4)
+        self.assertEqual(len(self.amda.cache['fake_b']), 4)
+
+
+class _ChunkSizingTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_ChunkSizingTest, self).setUp()
+        self.amda.chunk_target_bytes = 1 << 20
+        self.amda.chunk_min_span = self.amda.chunk_max_span = timedelta(hours=1)
+
+    def test_chunk_span(self):
+        self.assertIsNone(self.amda.chunk_span('fake_b'))
+        self.amda.cache.meta('fake_b').update(sampling=4., bytes_per_row=32.)
+        self.amda.chunk_max_span = timedelta(days=30)
+        self.assertEqual(self.amda.chunk_span('fake_b'), timedelta(seconds=4 * (1 << 20) / 32))
+        self.amda.chunk_max_span = timedelta(hours=2)
+        self.assertEqual(self.amda.chunk_span('fake_b'), timedelta(hours=2))
+        self.amda.chunk_target_bytes = 0
+        self.assertIsNone(self.amda.chunk_span('fake_b'))
+
+    def test_misses_are_widened_to_aligned_chunks(self):
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 1, 10), 'fake_b')
+        self.assertEqual(len(df), 150)
+        meta = self.amda.cache.meta('fake_b')
+        self.assertEqual((meta['sampling'], meta['columns']), (4., 3))
+        self.assertGreater(meta['bytes_per_row'], 0)
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 2, 10), datetime(2006, 1, 8, 2, 20), 'fake_b')
+        self.assertEqual(df.index[0], datetime(2006, 1, 8, 2, 10))
+        self.assertEqual(self.amda.cache['fake_b'][-1].dt_range,
+                         DateTimeRange(datetime(2006, 1, 8, 2), datetime(2006, 1, 8, 3)))
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 2, 30), datetime(2006, 1, 8, 2, 40), 'fake_b')
+        self.assertEqual(len(df), 151)
+        self.assertEqual(self.fake.requests['getParameter'], 2)
+
+    def test_chunks_follow_the_grid(self):
+        self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 1, 10), 'fake_b')
+        self.amda.get_parameter(datetime(2006, 1, 8, 3, 30), datetime(2006, 1, 8, 5, 30), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 4)
+        self.assertEqual(sorted(e.start_time for e in self.amda.cache['fake_b'])[1:],
+                         [datetime(2006, 1, 8, h) for h in (3, 4, 5)])
+
+
+class _TailRefreshTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_TailRefreshTest, self).setUp()
+        self.now = datetime.now().replace(microsecond=0)
+        self.fake.data_stop = self.now - timedelta(minutes=10)
+        self.amda.tail_refresh = timedelta(0)
+
+    def _data_entries(self):
+        return [e for e in self.amda.cache['fake_b'] if not e.is_negative]
+
+    def test_only_the_tail_is_fetched_and_appended(self):
+        df = self.amda.get_parameter(self.now - timedelta(hours=2), self.now, 'fake_b')
+        valid_until = self.amda.cache.meta('fake_b')['valid_until']
+        self.assertEqual(valid_until, df.index[-1])
+        self.assertLess(valid_until, self.now - timedelta(minutes=10))
+        self.fake.data_stop = self.now
+        df = self.amda.get_parameter(self.now - timedelta(hours=1), self.now, 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 2)
+        self.assertEqual(len(self._data_entries()), 1)
+        self.assertEqual(self._data_entries()[0].stop_time, self.now)
+        self.assertAlmostEqual(len(df), 15 * 60, delta=1)
+        self.assertTrue(df.index.is_unique)
+        self.assertGreater(self.amda.cache.meta('fake_b')['valid_until'], self.now - timedelta(seconds=5))
+
+    def test_future_is_not_covered(self):
+        self.amda.get_parameter(self.now - timedelta(hours=2), self.now, 'fake_b')
+        self.fake.data_stop = self.now
+        self.amda._refresh_tail('fake_b', DateTimeRange(self.now - timedelta(hours=1), self.now + timedelta(hours=1)))
+        self.assertLessEqual(self.amda.cache.last_entry('fake_b').stop_time, datetime.now())
+
+    def test_full_last_chunk_is_not_grown(self):
+        self.amda.chunk_target_bytes = 1 << 20
+        self.amda.chunk_min_span = self.amda.chunk_max_span = span = timedelta(minutes=30)
+        self.fake.data_stop = self.now - timedelta(minutes=50)
+        # chunks are aligned on the grid once the parameter shape is known
+        self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.amda.get_parameter(self.now - timedelta(hours=2), self.now - timedelta(minutes=45), 'fake_b')
+        last = self.amda.cache.last_entry('fake_b')
+        self.assertEqual(last.stop_time - last.start_time, span)
+        self.fake.data_stop = self.now
+        requests = self.fake.requests['getParameter']
+        df = self.amda.get_parameter(self.now - timedelta(hours=1), self.now, 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], requests + 1)
+        self.assertAlmostEqual(len(df), 15 * 60, delta=1)
+        self.assertTrue(df.index.is_unique)
+        entries = sorted(e for e in self._data_entries() if e.start_time > datetime(2006, 1, 9))
+        self.assertTrue(all(e.stop_time - e.start_time <= span for e in entries))
+        self.assertTrue(all(a.stop_time == b.start_time for a, b in zip(entries, entries[1:])))
+        # the tail went to new chunks after the full one
+        self.assertIn(last.dt_range, [e.dt_range for e in entries])
+        self.assertGreater(entries[-1].start_time, last.start_time)
+        self.assertEqual(entries[-1].stop_time, self.now)
+        self.assertGreater(self.amda.cache.meta('fake_b')['valid_until'], self.now - timedelta(seconds=5))
+
+    def test_tail_refresh_is_throttled(self):
+        self.amda.tail_refresh = timedelta(hours=1)
+        self.amda.get_parameter(self.now - timedelta(hours=2), self.now, 'fake_b')
+        self.amda.get_parameter(self.now - timedelta(hours=2), self.now, 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 1)
+
+    def test_replaced_chunks_are_removed_later(self):
+        df = self.amda.get_parameter(self.now - timedelta(hours=2), self.now, 'fake_b')
+        replaced = self._data_entries()[0]
+        self.fake.data_stop = self.now
+        self.amda.get_parameter(self.now - timedelta(hours=1), self.now, 'fake_b')
+        self.assertIsNot(self._data_entries()[0], replaced)
+        self.assertEqual(len(self.amda._read_chunk(replaced)), len(df))
+        self.amda.retire_delay = timedelta(0)
+        self.amda._remove_retired()
+        self.assertFalse(os.path.exists(replaced.data_file))
+
+    def test_chunk_replaced_while_being_read(self):
+        self.amda.retire_delay = timedelta(0)
+        self.amda.get_parameter(self.now - timedelta(hours=2), self.now, 'fake_b')
+        def refresh_then_read(entry):
+            if self.fake.data_stop < self.now:
+                # another request refreshes the tail between the lookup and the read
+                self.fake.data_stop = self.now
+                self.amda._refresh_tail('fake_b', DateTimeRange(self.now - timedelta(minutes=1), self.now))
+            return CachedAMDA._read_chunk(self.amda, entry)
+
+        with mock.patch.object(self.amda, '_read_chunk', side_effect=refresh_then_read):
+            df = self.amda.get_parameter(self.now - timedelta(hours=1), self.now, 'fake_b')
+        self.assertAlmostEqual(len(df), 15 * 60, delta=1)
+        self.assertFalse(os.path.exists(self.data_folder + '/quarantine'))
+        self.assertEqual(self.fake.requests['getParameter'], 3)
+
+    def test_tail_of_a_removed_chunk_is_dropped(self):
+        self.amda.get_parameter(self.now - timedelta(hours=2), self.now, 'fake_b')
+        self.fake.data_stop = self.now + timedelta(minutes=1)
+        def evict_then_write(*args):
+            # another request evicts the parameter while its tail is being appended
+            self.amda.evict('fake_b')
+            return CachedAMDA._write_chunk(self.amda, *args)
+
+        with mock.patch.object(self.amda, '_write_chunk', side_effect=evict_then_write):
+            self.amda._refresh_tail('fake_b', DateTimeRange(self.now, self.now + timedelta(minutes=1)))
+        self.assertIsNone(self.amda.cache.last_entry('fake_b'))
+        self.assertEqual([f for f in os.listdir(self.data_folder) if not f.endswith('.json')], [])
+
+    def test_old_data_has_no_watermark(self):
+        self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertNotIn('valid_until', self.amda.cache.meta('fake_b'))
+
+
+class _SharedCacheTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_SharedCacheTest, self).setUp()
+        self.shared_folder = tempfile.mkdtemp()
+        self.other_folder = tempfile.mkdtemp()
+        self.amda.cache.backend = FolderBackend(self.shared_folder)
+        self.other = CachedAMDA(server_url=self.fake.url, data_folder=self.other_folder,
+                                shared_cache=FolderBackend(self.shared_folder))
+        self.other._unpack_inventory(self.fake.inventory())
+
+    def tearDown(self):
+        del self.other
+        shutil.rmtree(self.other_folder)
+        shutil.rmtree(self.shared_folder)
+        super(_SharedCacheTest, self).tearDown()
+
+    def test_other_node_reads_shared_chunks(self):
+        expected = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 1)
+        df = self.other.get_parameter(datetime(2006, 1, 8, 1, 30), datetime(2006, 1, 8, 2, 30), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 2)
+        self.assertEqual(len(df), 900)
+        self.assertTrue(df.index.is_monotonic_increasing)
+        self.assertEqual(self.other.metrics.counter('sciqlopcache_shared_hits_total'), 1)
+        df = self.other.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 2)
+        self.assertTrue(df.index.is_unique)
+        pds.testing.assert_frame_equal(df[:expected.index[-1]], expected, check_freq=False)
+
+    def test_overlapping_shared_chunks(self):
+        self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.other.get_parameter(datetime(2006, 1, 8, 0, 30), datetime(2006, 1, 8, 1, 30), 'fake_b')
+        # both nodes published [1:00, 1:30], the third one must not duplicate it
+        third_folder = tempfile.mkdtemp()
+        third = CachedAMDA(server_url=self.fake.url, data_folder=third_folder,
+                           shared_cache=FolderBackend(self.shared_folder))
+        try:
+            df = third.get_parameter(datetime(2006, 1, 8, 0, 30), datetime(2006, 1, 8, 2), 'fake_b')
+            self.assertEqual(self.fake.requests['getParameter'], 2)
+            self.assertEqual(len(df), 1350)
+            self.assertTrue(df.index.is_unique)
+        finally:
+            del third
+            shutil.rmtree(third_folder)
+
+    def test_only_columnar_chunks_are_shared(self):
+        self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        key, = self.amda.cache.backend.list('fake_b/')
+        self.assertEqual(decode_header(self.amda.cache.backend.get(key))['layout'], 'columns')
+
+    def test_pickled_shared_chunks_are_ignored(self):
+        dt_range = DateTimeRange(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2))
+        self.other.cache.backend.put(chunk_key('fake_b', dt_range),
+                                     encode_chunk(make_chunk(dt_range.start_time, dt_range.stop_time), 'pickle'))
+        df = self.other.get_parameter(dt_range.start_time, dt_range.stop_time, 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 1)
+        self.assertEqual(len(df), 900)
+        self.assertEqual(self.other.metrics.counter('sciqlopcache_shared_hits_total'), 0)
+
+    def test_recent_chunks_are_not_published(self):
+        now = datetime.now().replace(microsecond=0)
+        self.amda.get_parameter(now - timedelta(hours=1), now, 'fake_b')
+        self.assertEqual(self.amda.cache.backend.list('fake_b/'), [])
+
+    def test_publish_to_s3(self):
+        client = FakeS3Client()
+        self.amda.cache.backend = S3Backend('bucket', 'amda', client=client)
+        self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.other.cache.backend = S3Backend('bucket', 'amda', client=client)
+        self.other.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 1)
+
+
+class _IntegrityTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_IntegrityTest, self).setUp()
+        self.expected = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        self.entry = self.amda.cache['fake_b'][0]
+
+    def test_entries_record_size_and_checksum(self):
+        self.assertEqual(self.entry.size, os.path.getsize(self.entry.data_file))
+        self.assertIsNotNone(self.entry.checksum)
+        self.assertEqual([name for name in os.listdir(self.data_folder) if name.startswith('.')], [])
+
+    def _check_refetched(self):
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), 'fake_b')
+        pds.testing.assert_frame_equal(df, self.expected, check_freq=False)
+        self.assertEqual(self.fake.requests['getParameter'], 2)
+        self.assertEqual(self.amda.metrics.counter('sciqlopcache_chunks_quarantined_total'), 1)
+        self.assertEqual(len(self.amda.cache['fake_b']), 1)
+        self.assertNotEqual(self.amda.cache['fake_b'][0].data_file, self.entry.data_file)
+
+    def test_corrupt_chunk_is_quarantined_and_fetched_again(self):
+        with open(self.entry.data_file, 'r+b') as f:
+            f.seek(100)
+            f.write(b'garbage')
+        self._check_refetched()
+        self.assertTrue(os.path.exists(self.data_folder + '/quarantine/' + os.path.basename(self.entry.data_file)))
+
+    def test_missing_chunk_is_fetched_again(self):
+        os.remove(self.entry.data_file)
+        self._check_refetched()
+
+
+def _rows(txt):
+    # pre-rendered answers have the same rows and values as the default one, without its column alignment
+    return [line.split() for line in txt.splitlines()]
+
+
+class _TextChunksTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_TextChunksTest, self).setUp()
+        self.expected = _rows(self.amda.get_parameter_as_txt('2006-01-08T01:10:00', '2006-01-08T02:20:00', 'fake_b'))
+        self.amda.text_chunks = True
+
+    def _txt(self, start='2006-01-08T01:10:00', stop='2006-01-08T02:20:00'):
+        with tempfile.TemporaryFile() as f:
+            self.amda.write_parameter_as_txt(start, stop, 'fake_b', f)
+            f.seek(0)
+            return f.read().decode()
+
+    def test_same_answer_as_without_text_chunks(self):
+        self.assertEqual(_rows(self._txt()), self.expected)
+        self.assertEqual(_rows(self._txt()), self.expected)
+        self.assertEqual(self.fake.requests['getParameter'], 2)
+        self.assertTrue(all(os.path.exists(e.data_file + '.txt') for e in self.amda.cache['fake_b']))
+        self.assertGreater(self.amda.metrics.counter('sciqlopcache_bytes_served_total', source='text'), 0)
+
+    def test_partial_ranges(self):
+        self._txt()
+        txt = self._txt('2006-01-08T01:30:00', '2006-01-08T01:30:08')
+        lines = [line for line in txt.splitlines() if not line.startswith('#')]
+        self.assertEqual([line.split()[0] for line in lines],
+                         ['2006-01-08T01:30:00', '2006-01-08T01:30:04', '2006-01-08T01:30:08'])
+        self.amda.text_chunks = False
+        self.assertEqual(_rows(self.amda.get_parameter_as_txt('2006-01-08T01:30:00', '2006-01-08T01:30:08', 'fake_b')),
+                         _rows(txt))
+
+    def test_missing_text_is_rendered_again(self):
+        self._txt()
+        for e in self.amda.cache['fake_b']:
+            os.remove(e.data_file + '.txt')
+        self.assertEqual(_rows(self._txt()), self.expected)
+        self.assertEqual(self.fake.requests['getParameter'], 2)
+
+    def test_legacy_index_is_replaced(self):
+        self._txt()
+        for e in self.amda.cache['fake_b']:
+            os.rename(e.data_file + '.idx.npy', e.data_file + '.npz')
+        self.assertEqual(_rows(self._txt()), self.expected)
+        self.assertTrue(all(os.path.exists(e.data_file + '.idx.npy') and not os.path.exists(e.data_file + '.npz')
+                            for e in self.amda.cache['fake_b']))
+
+    def test_corrupt_chunk_falls_back(self):
+        os.remove(self.amda.cache['fake_b'][0].data_file)
+        self.assertEqual(_rows(self._txt()), self.expected)
+        self.assertEqual(self.amda.metrics.counter('sciqlopcache_chunks_quarantined_total'), 1)
+
+
+class _WorkerPoolTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_WorkerPoolTest, self).setUp()
+        self.amda.workers = WorkerPool(2)
+        self.addCleanup(self.amda.workers.shutdown)
+
+    def test_get_parameter(self):
+        df = self.amda.get_parameter(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 5), 'fake_b')
+        self.assertEqual(df.shape, (3600, 3))
+        pds.testing.assert_frame_equal(
+            df, self.fake.generate('fake_b', datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 5)),
+            check_freq=False, check_names=False, atol=1e-3)
+        self.assertEqual(self.amda.cache.meta('fake_b')['columns'], 3)
+        self.amda.get_parameter(datetime(2006, 1, 8, 2), datetime(2006, 1, 8, 3), 'fake_b')
+        self.assertEqual(self.fake.requests['getParameter'], 1)
+
+    def test_get_parameter_as_txt(self):
+        start, stop = '2006-01-08T01:00:00', '2006-01-08T02:30:00'
+        txt = self.amda.get_parameter_as_txt(start, stop, 'fake_b')
+        self.amda.workers = None
+        self.assertEqual(_rows(txt), _rows(self.amda.get_parameter_as_txt(start, stop, 'fake_b')))
+        self.assertEqual([f for f in os.listdir(self.data_folder) if f.startswith('.render')], [])
+
+
+class _JoinTest(_FakeAMDATestCase):
+    def setUp(self):
+        super(_JoinTest, self).setUp()
+        self.fake.parameters.append('fake_c')
+        self.amda._unpack_inventory(self.fake.inventory())
+
+    def test_get_joined(self):
+        df = self.amda.get_joined(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), ['fake_b', 'fake_c'],
+                                  timedelta(minutes=1), 'mean')
+        self.assertEqual(df.shape, (61, 6))
+        self.assertEqual(list(df.columns[:3]), ['fake_b[0]', 'fake_b[1]', 'fake_b[2]'])
+        expected = self.fake.generate('fake_b', datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 1, 1))[1].mean()
+        self.assertAlmostEqual(df['fake_c[0]'].iloc[0], expected, places=2)
+        self.assertFalse(df.isna().any().any())
+
+    def test_joins_are_cached(self):
+        step = timedelta(seconds=30)
+        self.amda.get_joined(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), ['fake_b', 'fake_c'], step)
+        requests = self.fake.requests['getParameter']
+        self.assertEqual(len(self.amda.cache['join:nearest:30:30:fake_b,fake_c']), 1)
+        df = self.amda.get_joined(datetime(2006, 1, 8, 1, 10, 10), datetime(2006, 1, 8, 1, 20),
+                                  ['fake_b', 'fake_c'], step)
+        self.assertEqual(self.fake.requests['getParameter'], requests)
+        self.assertEqual(df.index[0], datetime(2006, 1, 8, 1, 10, 30))
+        self.assertEqual(len(df), 20)
+        df = self.amda.get_joined(datetime(2006, 1, 8, 1, 30), datetime(2006, 1, 8, 2, 30),
+                                  ['fake_b', 'fake_c'], step)
+        self.assertEqual(len(df), 121)
+        self.assertTrue(df.index.is_unique and df.index.is_monotonic_increasing)
+        self.assertEqual(len(self.amda.cache['join:nearest:30:30:fake_b,fake_c']), 2)
+
+    def test_failed_joins_are_not_cached(self):
+        key, hour = 'join:nearest:60:60:fake_b,fake_c', DateTimeRange(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2))
+        self.fake.failures = 1 + self.amda.scheduler.retries
+        with self.assertRaises(UpstreamError):
+            self.amda.get_joined(hour.start_time, hour.stop_time, ['fake_b', 'fake_c'], timedelta(minutes=1))
+        self.assertEqual(self.amda.cache.get_entries(key, hour), [])
+        self.amda.cache.purge_expired('fake_b', datetime.now() + self.amda.error_ttl)
+        df = self.amda.get_joined(hour.start_time, hour.stop_time, ['fake_b', 'fake_c'], timedelta(minutes=1))
+        self.assertFalse(df.isna().any().any())
+        self.assertEqual(len(self.amda.cache.get_entries(key, hour)), 1)
+
+    def test_joins_without_data_keep_their_columns(self):
+        key, step = 'join:nearest:60:60:fake_b,fake_c', timedelta(minutes=1)
+        columns = list(self.amda.get_joined(datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2), ['fake_b', 'fake_c'],
+                                            step).columns)
+        self.fake.data_start = datetime(2006, 1, 8, 5)
+        df = self.amda.get_joined(datetime(2006, 1, 8, 3), datetime(2006, 1, 8, 4), ['fake_b', 'fake_c'], step)
+        self.assertEqual(list(df.columns), columns)
+        self.assertTrue(df.isna().all().all())
+        self.assertEqual(self.amda.cache.get_entries(key, DateTimeRange(datetime(2006, 1, 8, 3),
+                                                                        datetime(2006, 1, 8, 4))), [])
+        df = self.amda.get_joined(datetime(2006, 1, 8, 1, 30), datetime(2006, 1, 8, 4), ['fake_b', 'fake_c'], step)
+        self.assertEqual(list(df.columns), columns)
+        self.assertEqual(len(df), 151)
+        self.assertFalse(df[:datetime(2006, 1, 8, 2)].isna().any().any())
+
+    def test_recent_joins_are_not_cached(self):
+        now = datetime.now()
+        self.amda.get_joined(now - timedelta(hours=1), now - timedelta(minutes=30), ['fake_b'], timedelta(minutes=1))
+        self.assertNotIn('join:nearest:60:60:fake_b', self.amda.cache)
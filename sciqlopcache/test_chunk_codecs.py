@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pds
+from ddt import ddt, data
+
+from .chunk_codecs import CODECS, ChunkError, check_codec, decode_chunk, decode_header, decode_meta, encode_chunk, \
+    read_chunk, write_chunk
+
+
+def _available(codec):
+    try:
+        check_codec(codec)
+        return True
+    except ValueError:
+        return False
+
+
+def make_frame(rows=1000):
+    index = pds.date_range(datetime(2006, 1, 8), periods=rows, freq='4s')
+    phase = np.arange(rows) / 900.
+    return pds.DataFrame({1: np.round(10 * np.sin(phase), 3), 2: np.round(10 * np.cos(phase), 3),
+                          3: np.arange(rows, dtype=np.int32)}, index=index)
+
+
+@ddt
+class _ChunkCodecsTest(unittest.TestCase):
+    @data(*[codec for codec in CODECS if _available(codec)])
+    def test_round_trip(self, codec):
+        df = make_frame()
+        decoded = decode_chunk(encode_chunk(df, codec))
+        pds.testing.assert_frame_equal(decoded, df, check_freq=False)
+        self.assertEqual(decode_header(encode_chunk(df, codec))['codec'], codec)
+
+    @data(*[codec for codec in CODECS if codec != 'pickle' and _available(codec)])
+    def test_non_columnar_frames_fall_back_to_pickle_layout(self, codec):
+        df = pds.DataFrame({'name': ['a', 'b']}, index=[0, 1])
+        encoded = encode_chunk(df, codec)
+        self.assertEqual(decode_header(encoded)['layout'], 'pickle')
+        pds.testing.assert_frame_equal(decode_chunk(encoded), df)
+
+    def test_untrusted_chunks_are_never_unpickled(self):
+        df = make_frame()
+        pds.testing.assert_frame_equal(decode_chunk(encode_chunk(df, 'zlib'), trusted=False), df, check_freq=False)
+        for encoded in (encode_chunk(df, 'pickle'), encode_chunk(pds.DataFrame({'name': ['a']}, index=[0]), 'zlib')):
+            with self.assertRaises(ChunkError):
+                decode_chunk(encoded, trusted=False)
+
+    def test_untrusted_chunks_are_checked(self):
+        encoded = encode_chunk(make_frame(), 'none')
+        with self.assertRaises(ChunkError):
+            decode_chunk(encoded[:-8], trusted=False)
+        # same header length, arrays of Python objects
+        forged = encoded.replace(b'"float64"', b'"object" ', 1)
+        self.assertEqual(decode_header(forged)['dtypes'][0], 'object')
+        with self.assertRaises(ChunkError):
+            decode_chunk(forged, trusted=False)
+
+    def test_empty_frame(self):
+        df = make_frame(0)
+        pds.testing.assert_frame_equal(decode_chunk(encode_chunk(df, 'zlib')), df, check_freq=False)
+
+    def test_compression(self):
+        df = make_frame(20000)
+        self.assertLess(len(encode_chunk(df, 'zlib')), len(encode_chunk(df, 'pickle')) / 2)
+
+    def test_legacy_pickle_files(self):
+        df = make_frame()
+        fd, fname = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            df.to_pickle(fname)
+            pds.testing.assert_frame_equal(read_chunk(fname), df)
+            write_chunk(fname, df, 'zlib')
+            pds.testing.assert_frame_equal(read_chunk(fname), df, check_freq=False)
+        finally:
+            os.remove(fname)
+
+    def test_meta(self):
+        df = make_frame()
+        meta = {'product': 'p', 'start': '2006-01-08T00:00:00', 'stop': '2006-01-09T00:00:00'}
+        for codec in ('pickle', 'zlib'):
+            encoded = encode_chunk(df, codec, meta)
+            self.assertEqual(decode_meta(encoded), meta)
+            self.assertEqual(decode_chunk(encoded).attrs, {})
+        self.assertIsNone(decode_meta(encode_chunk(df, 'zlib')))
+
+    def test_read_chunk_checks(self):
+        df = make_frame()
+        folder = tempfile.mkdtemp()
+        fname = folder + '/chunk'
+        try:
+            size, crc = write_chunk(fname, df, 'zlib')
+            self.assertEqual(os.listdir(folder), ['chunk'])
+            pds.testing.assert_frame_equal(read_chunk(fname, size, crc), df, check_freq=False)
+            with self.assertRaises(ChunkError):
+                read_chunk(fname, size + 1, crc)
+            with self.assertRaises(ChunkError):
+                read_chunk(fname, size, crc + 1)
+            with open(fname, 'r+b') as f:
+                f.truncate(size // 2)
+            with self.assertRaises(ChunkError):
+                read_chunk(fname)
+            with self.assertRaises(ChunkError):
+                read_chunk(folder + '/missing')
+        finally:
+            shutil.rmtree(folder)
+
+    def test_check_codec(self):
+        with self.assertRaises(ValueError):
+            check_codec('snappy')
@@ -0,0 +1,91 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from .cache import Cache, EMPTY, lock_folder
+from .cached_amda import CachedAMDA
+from .datetime_range import DateTimeRange
+from .fake_amda import FakeAMDA
+from .scripts.fsck import fsck, main
+
+
+class _FsckTest(unittest.TestCase):
+    def setUp(self):
+        self.data_folder = tempfile.mkdtemp()
+        fake = FakeAMDA()
+        amda = CachedAMDA(server_url='http://unused', data_folder=self.data_folder)
+        for day in (1, 2, 3):
+            start = datetime(2006, 1, day)
+            amda.add_to_cache('fake_b', DateTimeRange(start, start + timedelta(hours=1)),
+                              fake.generate('fake_b', start, start + timedelta(hours=1)))
+        amda.chunk_codec = 'zlib'
+        amda.add_to_cache('fake_c', DateTimeRange(datetime(2006, 1, 1), datetime(2006, 1, 2)),
+                          fake.generate('fake_c', datetime(2006, 1, 1), datetime(2006, 1, 2)))
+        amda.add_negative_entry('fake_b', DateTimeRange(datetime(2006, 2, 1), datetime(2006, 2, 2)), EMPTY)
+        amda._save()
+        self.entries = {product: list(amda.cache[product]) for product in amda.cache}
+        del amda
+
+    def tearDown(self):
+        shutil.rmtree(self.data_folder)
+
+    def _fsck(self, dry_run=False):
+        out = io.StringIO()
+        return fsck(self.data_folder, dry_run=dry_run, out=out), Cache(self.data_folder + '/db.json')
+
+    def test_clean_cache(self):
+        report, cache = self._fsck()
+        self.assertEqual(report['chunks'], 4)
+        self.assertEqual(report['quarantined'] + report['missing'] + report['recovered'], 0)
+        self.assertEqual(sorted(cache['fake_b']), sorted(self.entries['fake_b']))
+        self.assertEqual(len(cache['fake_c']), 1)
+
+    def test_rebuild_lost_index(self):
+        os.remove(self.data_folder + '/db.json')
+        report, cache = self._fsck()
+        self.assertEqual(report['recovered'], 4)
+        self.assertEqual(sorted(cache['fake_b']), sorted(e for e in self.entries['fake_b'] if not e.is_negative))
+        self.assertEqual(cache['fake_c'][0].codec, 'zlib')
+        self.assertEqual(cache['fake_c'][0].checksum, self.entries['fake_c'][0].checksum)
+
+    def test_corrupt_index(self):
+        with open(self.data_folder + '/db.json', 'w') as f:
+            f.write('{"truncated')
+        report, cache = self._fsck()
+        self.assertEqual(report['recovered'], 4)
+        self.assertTrue(os.path.exists(self.data_folder + '/db.json.corrupt'))
+
+    def test_corrupt_and_missing_chunks(self):
+        corrupt, missing = [e.data_file for e in self.entries['fake_b'][:2]]
+        with open(corrupt, 'wb') as f:
+            f.write(b'garbage')
+        os.remove(missing)
+        report, cache = self._fsck()
+        self.assertEqual((report['quarantined'], report['missing']), (1, 1))
+        self.assertEqual(len(cache['fake_b']), 2)
+        self.assertTrue(os.path.exists(self.data_folder + '/quarantine/' + os.path.basename(corrupt)))
+
+    def test_dry_run_changes_nothing(self):
+        os.remove(self.data_folder + '/db.json')
+        report, cache = self._fsck(dry_run=True)
+        self.assertEqual(report['recovered'], 4)
+        self.assertFalse(os.path.exists(self.data_folder + '/db.json'))
+
+    def test_cli_needs_the_server_stopped(self):
+        os.remove(self.entries['fake_b'][0].data_file)
+        server = lock_folder(self.data_folder)
+        with mock.patch('sciqlopcache.scripts.fsck.setup_logging'), \
+                mock.patch('sciqlopcache.scripts.fsck.get_appsettings',
+                           return_value={'amda_cache_folder': self.data_folder}), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as err:
+            self.assertEqual(main(['unused.ini']), 1)
+            self.assertIn('stop the server first', err.getvalue())
+            self.assertEqual(len(Cache(self.data_folder + '/db.json')['fake_b']), 4)
+            server.close()
+            self.assertEqual(main(['unused.ini']), 0)
+        self.assertEqual(len(Cache(self.data_folder + '/db.json')['fake_b']), 3)
+        lock_folder(self.data_folder, exclusive=True).close()
@@ -0,0 +1,62 @@
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pds
+
+from .join import join, join_key, make_grid, resample
+
+
+def make_frame(start, periods, freq, values=None):
+    index = pds.date_range(start, periods=periods, freq=freq)
+    values = np.arange(periods, dtype=float) if values is None else values
+    return pds.DataFrame({1: values}, index=index)
+
+
+class _JoinTest(unittest.TestCase):
+    def setUp(self):
+        # one sample every 10s from 00:00:05, values 0, 1, 2...
+        self.df = make_frame(datetime(2006, 1, 8, 0, 0, 5), 30, '10s')
+        self.step = timedelta(minutes=1)
+        self.grid = make_grid(datetime(2006, 1, 8, 0, 0, 30), datetime(2006, 1, 8, 0, 5), self.step)
+
+    def test_make_grid(self):
+        self.assertEqual(list(self.grid), [pds.Timestamp(2006, 1, 8, 0, m) for m in range(1, 6)])
+        self.assertEqual(len(make_grid(datetime(2006, 1, 8, 0, 0, 10), datetime(2006, 1, 8, 0, 0, 20), self.step)), 0)
+
+    def test_asof(self):
+        nearest = resample(self.df, self.grid, 'nearest', self.step, timedelta(seconds=5))
+        self.assertEqual(list(nearest[1]), [5., 11., 17., 23., 29.])
+        previous = resample(self.df, self.grid, 'previous', self.step, self.step)
+        self.assertEqual(list(previous[1]), [5., 11., 17., 23., 29.])
+        following = resample(self.df, self.grid, 'next', self.step, self.step)
+        self.assertEqual(list(following[1])[:4], [6., 12., 18., 24.])
+        self.assertTrue(np.isnan(following[1].iloc[4]))
+
+    def test_linear(self):
+        linear = resample(self.df, self.grid, 'linear', self.step, self.step)
+        self.assertEqual(list(linear[1])[:4], [5.5, 11.5, 17.5, 23.5])
+        self.assertTrue(np.isnan(linear[1].iloc[4]))
+        sparse = self.df.iloc[::12]
+        linear = resample(sparse, self.grid, 'linear', self.step, self.step)
+        self.assertTrue(linear[1].isna().all())
+
+    def test_bins(self):
+        mean = resample(self.df, self.grid, 'mean', self.step, self.step)
+        self.assertEqual(list(mean[1])[:4], [8.5, 14.5, 20.5, 26.5])
+        count = resample(self.df, self.grid, 'count', self.step, self.step)
+        self.assertEqual(list(count[1]), [6, 6, 6, 6, 0])
+
+    def test_join(self):
+        other = make_frame(datetime(2006, 1, 8, 0, 0, 0), 10, '1min', values=np.arange(10) * 10.)
+        df = join({'a': self.df, 'b': other}, self.grid, 'previous', self.step, self.step)
+        self.assertEqual(list(df.columns), ['a[0]', 'b[0]'])
+        self.assertEqual(list(df['b[0]']), [10., 20., 30., 40., 50.])
+        self.assertEqual(join_key(['a', 'b'], self.step, 'mean', self.step), 'join:mean:60:60:a,b')
+
+    def test_parameters_without_data_keep_their_columns(self):
+        self.assertEqual(resample(None, self.grid, 'mean', self.step, self.step, width=3).shape, (5, 3))
+        self.assertEqual(list(resample(None, self.grid, 'count', self.step, self.step, width=1)[0]), [0] * 5)
+        df = join({'a': None, 'b': self.df}, self.grid, 'nearest', self.step, self.step, widths={'a': 2})
+        self.assertEqual(list(df.columns), ['a[0]', 'a[1]', 'b[0]'])
+        self.assertTrue(df[['a[0]', 'a[1]']].isna().all().all())
@@ -0,0 +1,37 @@
+import unittest
+
+from .metrics import Metrics
+
+
+class _MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1.))
+
+    def test_counters(self):
+        self.metrics.inc('sciqlopcache_cache_hits_total')
+        self.metrics.inc('sciqlopcache_cache_hits_total', 2)
+        self.metrics.inc('sciqlopcache_cache_misses_total')
+        self.metrics.inc('sciqlopcache_bytes_served_total', 100, source='cache')
+        self.assertEqual(self.metrics.counter('sciqlopcache_cache_hits_total'), 3)
+        self.assertEqual(self.metrics.counter('sciqlopcache_bytes_served_total', source='cache'), 100)
+        self.assertEqual(self.metrics.counter('sciqlopcache_bytes_served_total', source='upstream'), 0)
+        self.assertEqual(self.metrics.hit_ratio(), 0.75)
+
+    def test_prometheus_histogram(self):
+        self.metrics.observe('sciqlopcache_stage_seconds', 0.05, stage='token')
+        self.metrics.observe('sciqlopcache_stage_seconds', 0.5, stage='token')
+        self.metrics.observe('sciqlopcache_stage_seconds', 5., stage='token')
+        txt = self.metrics.to_prometheus()
+        self.assertIn('# TYPE sciqlopcache_stage_seconds histogram', txt)
+        self.assertIn('sciqlopcache_stage_seconds_bucket{stage="token",le="0.1"} 1', txt)
+        self.assertIn('sciqlopcache_stage_seconds_bucket{stage="token",le="1.0"} 2', txt)
+        self.assertIn('sciqlopcache_stage_seconds_bucket{stage="token",le="+Inf"} 3', txt)
+        self.assertIn('sciqlopcache_stage_seconds_count{stage="token"} 3', txt)
+
+    def test_timer_and_gauges(self):
+        with self.metrics.timer('format'):
+            pass
+        txt = self.metrics.to_prometheus({'sciqlopcache_cache_entries': {(('parameter', 'c1_"b"'),): 4}})
+        self.assertIn('sciqlopcache_stage_seconds_count{stage="format"} 1', txt)
+        self.assertIn('# TYPE sciqlopcache_cache_entries gauge', txt)
+        self.assertIn('sciqlopcache_cache_entries{parameter="c1_\\"b\\""} 4', txt)
@@ -0,0 +1,94 @@
+import io
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from .cache import CacheLockedError, lock_folder
+from .datetime_range import DateTimeRange
+from .cached_amda import CachedAMDA
+from .scripts.prefill import main, prefill
+
+
+class _FakeCachedAMDA:
+    def __init__(self, cached=(), fail=()):
+        self.cached = list(cached)
+        self.fail = fail
+        self.fetched = []
+        self.saves = 0
+        self._lock = threading.Lock()
+
+    def fetch_missing(self, parameter_id, dt_range):
+        if parameter_id in self.fail:
+            raise RuntimeError('upstream error')
+        with self._lock:
+            if (parameter_id, dt_range.start_time) in self.cached:
+                return 0
+            self.fetched.append((parameter_id, dt_range.start_time))
+            return 1
+
+    def _save(self):
+        self.saves += 1
+
+    def find_parameters(self, missions=(), datasets=()):
+        return []
+
+
+class _PrefillTest(unittest.TestCase):
+    def setUp(self):
+        self.dt_range = DateTimeRange(datetime(2006, 1, 8), datetime(2006, 1, 11))
+
+    def test_prefill_all_chunks(self):
+        amda = _FakeCachedAMDA()
+        out = io.StringIO()
+        failed = prefill(amda, ['p1', 'p2'], self.dt_range, chunk=timedelta(days=1), jobs=3, out=out)
+        self.assertEqual(failed, 0)
+        self.assertEqual(len(amda.fetched), 6)
+        self.assertEqual(amda.saves, 6)
+        self.assertIn('[6/6]', out.getvalue())
+
+    def test_prefill_resumes(self):
+        amda = _FakeCachedAMDA(cached=[('p1', datetime(2006, 1, 8)), ('p1', datetime(2006, 1, 9))])
+        out = io.StringIO()
+        prefill(amda, ['p1'], self.dt_range, chunk=timedelta(days=1), out=out)
+        self.assertEqual(amda.fetched, [('p1', datetime(2006, 1, 10))])
+        self.assertEqual(out.getvalue().count('already cached'), 2)
+
+    def test_prefill_reports_failures(self):
+        amda = _FakeCachedAMDA(fail=['bad'])
+        failed = prefill(amda, ['bad', 'p1'], self.dt_range, chunk=timedelta(days=1), out=io.StringIO())
+        self.assertEqual(failed, 3)
+        self.assertEqual(len(amda.fetched), 3)
+
+
+class _LockFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_servers_share_tools_dont(self):
+        server, other_server = lock_folder(self.folder), lock_folder(self.folder)
+        with self.assertRaises(CacheLockedError):
+            lock_folder(self.folder, exclusive=True)
+        server.close()
+        other_server.close()
+        tool = lock_folder(self.folder, exclusive=True)
+        with self.assertRaises(CacheLockedError):
+            lock_folder(self.folder)
+        tool.close()
+
+    def test_cli_releases_the_lock(self):
+        with mock.patch('sciqlopcache.scripts.prefill.setup_logging'), \
+                mock.patch('sciqlopcache.scripts.prefill.get_appsettings',
+                           return_value={'amda_cache_folder': self.folder}), \
+                mock.patch.object(CachedAMDA, 'from_settings', side_effect=lambda _: _FakeCachedAMDA()), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as err:
+            self.assertEqual(main(['unused.ini', '2006-01-08', '2006-01-09', '--dataset', 'unknown']), 1)
+            self.assertIn('Nothing to prefill', err.getvalue())
+            server = lock_folder(self.folder)
+            self.assertEqual(main(['unused.ini', '2006-01-08', '2006-01-09', 'fake_b']), 1)
+            self.assertIn('/admin/prefill', err.getvalue())
+            server.close()
+        lock_folder(self.folder, exclusive=True).close()
@@ -0,0 +1,85 @@
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from .datetime_range import DateTimeRange
+from .scheduler import FetchScheduler, RateLimiter
+
+
+class _RateLimiterTest(unittest.TestCase):
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=50.)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50. - 0.01)
+
+
+class _FetchSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = FetchScheduler(max_concurrency=2, max_span=timedelta(days=1), max_points=1000,
+                                        retry_delay=0.001)
+        self.dt_range = DateTimeRange(datetime(2006, 1, 8), datetime(2006, 1, 11))
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def test_split(self):
+        self.assertEqual(len(self.scheduler.split([self.dt_range])), 3)
+        self.assertEqual(len(self.scheduler.split([self.dt_range], cadence=timedelta(seconds=36))), 8)
+        self.assertEqual(len(self.scheduler.split([self.dt_range], cadence=timedelta(hours=1))), 3)
+
+    def test_concurrency_cap(self):
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def fetch(r):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return r.start_time
+
+        pieces = self.scheduler.split([self.dt_range], cadence=timedelta(minutes=10))
+        threads = [threading.Thread(target=lambda: list(self.scheduler.run('server', pieces, fetch)))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(peak[0], 2)
+
+    def test_only_failed_pieces_are_retried(self):
+        calls = []
+
+        def fetch(r):
+            calls.append(r.start_time)
+            if r.start_time == datetime(2006, 1, 9) and calls.count(r.start_time) < 3:
+                raise RuntimeError('upstream error')
+            return r.start_time
+
+        results = list(self.scheduler.run('server', self.scheduler.split([self.dt_range]), fetch))
+        self.assertEqual(sorted(result for _, result, _ in results),
+                         [datetime(2006, 1, 8), datetime(2006, 1, 9), datetime(2006, 1, 10)])
+        self.assertEqual(calls.count(datetime(2006, 1, 9)), 3)
+        self.assertEqual(len(calls), 5)
+
+    def test_errors_are_reported_after_retries(self):
+        def fetch(r):
+            raise RuntimeError('upstream error')
+
+        results = list(self.scheduler.run('server', [self.dt_range], fetch))
+        self.assertEqual(len(results), 1)
+        piece, result, error = results[0]
+        self.assertEqual(piece, self.dt_range)
+        self.assertIsNone(result)
+        self.assertIsInstance(error, RuntimeError)
+
+    def test_rate_limits_are_per_server(self):
+        self.scheduler.rates = {'slow': 1.}
+        self.assertIsNot(self.scheduler.limiter('slow'), self.scheduler.limiter('fast'))
+        self.assertEqual(self.scheduler.limiter('slow').interval, 1.)
+        self.assertEqual(self.scheduler.limiter('fast').interval, 0.)
@@ -0,0 +1,71 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pds
+
+from .text_chunks import copy_range, read_text_index, render_table, render_text, text_range, write_text_chunk
+
+
+class _TextChunksTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fname = self.folder + '/chunk'
+        index = pds.date_range(datetime(2006, 1, 8), periods=10, freq='1min')
+        self.df = pds.DataFrame({1: np.arange(10.), 2: np.arange(10.) / 3}, index=index)
+        write_text_chunk(self.fname, self.df)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_render_text(self):
+        lines = render_text(self.df).decode().splitlines()
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(lines[1], '2006-01-08T00:01:00 1.000 0.333')
+        self.assertEqual(render_text(self.df[:0]), b'')
+        shifted = self.df.set_axis(self.df.index + pds.Timedelta(milliseconds=500))
+        self.assertEqual(render_text(shifted).decode().splitlines()[1], '2006-01-08T00:01:00.500000 1.000 0.333')
+
+    def test_render_table(self):
+        df = self.df.copy()
+        df.iloc[0, 0] = -10.
+        self.assertEqual(render_table(df).decode().splitlines()[:2],
+                         ['2006-01-08T00:00:00 -10.000 0.000', '2006-01-08T00:01:00   1.000 0.333'])
+        self.assertFalse(render_table(df).endswith(b'\n'))
+        self.assertEqual(render_table(df[:0]), b'')
+
+    def test_text_range(self):
+        with open(self.fname + '.txt', 'rb') as f:
+            text = f.read()
+        offset, size = text_range(self.fname, datetime(2006, 1, 8, 0, 2), datetime(2006, 1, 8, 0, 4))
+        self.assertEqual(text[offset:offset + size], render_text(self.df[datetime(2006, 1, 8, 0, 2):
+                                                                         datetime(2006, 1, 8, 0, 4)]))
+        self.assertEqual(text_range(self.fname, datetime(2006, 1, 9), datetime(2006, 1, 10))[1], 0)
+        self.assertEqual(text_range(self.fname, datetime(2006, 1, 7), datetime(2006, 1, 10)), (0, len(text)))
+
+    def test_index_is_memory_mapped(self):
+        times, offsets = read_text_index(self.fname)
+        self.assertIsInstance(times.base, np.memmap)
+        self.assertEqual(len(times), 11)
+        self.assertEqual(times[0], np.datetime64(datetime(2006, 1, 8), 'ns').astype(np.int64))
+        self.assertEqual(offsets[-1], os.path.getsize(self.fname + '.txt'))
+
+    def test_copy_range(self):
+        offset, size = text_range(self.fname, datetime(2006, 1, 8, 0, 2), datetime(2006, 1, 8, 0, 4))
+        expected = b'header\n' + render_text(self.df[datetime(2006, 1, 8, 0, 2):datetime(2006, 1, 8, 0, 4)]) * 2
+        memory = io.BytesIO()
+        memory.write(b'header\n')
+        copy_range(memory, self.fname + '.txt', offset, size)
+        copy_range(memory, self.fname + '.txt', offset, size)
+        self.assertEqual(memory.getvalue(), expected)
+        with open(self.folder + '/out', 'wb') as out:
+            out.write(b'header\n')
+            copy_range(out, self.fname + '.txt', offset, size)
+            copy_range(out, self.fname + '.txt', offset, size)
+        with open(self.folder + '/out', 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        self.assertFalse(os.path.exists(self.folder + '/.chunk.txt'))
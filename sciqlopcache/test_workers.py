@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from .chunk_codecs import read_chunk
+from .fake_amda import FakeAMDA
+from .text_chunks import TEXT_SUFFIX, render_text
+from .workers import WorkerPool, fetch_to_chunk, parse_amda_csv, render_chunk
+
+
+class _WorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.data_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_folder)
+        self.fname = self.data_folder + '/chunk'
+        with open(self.data_folder + '/answer.txt', 'w') as f:
+            f.write(FakeAMDA().render('fake_b', datetime(2006, 1, 8, 1), datetime(2006, 1, 8, 2)))
+
+    def test_parse_amda_csv(self):
+        df = parse_amda_csv(self.data_folder + '/answer.txt')
+        self.assertEqual(df.shape, (900, 3))
+        with open(self.data_folder + '/empty.txt', 'w') as f:
+            f.write('# nothing\n')
+        self.assertIsNone(parse_amda_csv(self.data_folder + '/empty.txt'))
+
+    def test_fetch_to_chunk(self):
+        size, checksum = fetch_to_chunk(self.data_folder + '/answer.txt', self.fname, 'zlib', {'product': 'fake_b'},
+                                        True)
+        self.assertEqual(size, os.path.getsize(self.fname))
+        self.assertEqual(len(read_chunk(self.fname, size, checksum)), 900)
+        self.assertTrue(os.path.exists(self.fname + TEXT_SUFFIX))
+
+    def test_render_chunk(self):
+        size, checksum = fetch_to_chunk(self.data_folder + '/answer.txt', self.fname, 'pickle', {})
+        df = read_chunk(self.fname)
+        start, stop = datetime(2006, 1, 8, 1, 10), datetime(2006, 1, 8, 1, 20)
+        pool = WorkerPool(1)
+        try:
+            written = pool.run(render_chunk, self.fname, size, checksum, start, stop, self.fname + '.out')
+        finally:
+            pool.shutdown()
+        with open(self.fname + '.out', 'rb') as f:
+            self.assertEqual(f.read(), render_text(df[start:stop]))
+        self.assertEqual(written, os.path.getsize(self.fname + '.out'))
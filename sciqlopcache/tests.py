@@ -16,6 +16,22 @@ class ViewTests(unittest.TestCase):
         info = my_view(request)
         self.assertEqual(info['project'], 'sciqlopcache')
 
+    def test_metrics(self):
+        from .views import metrics
+        from .metrics import Metrics
+
+        class _Amda:
+            def metrics_as_prometheus(self):
+                m = Metrics()
+                m.inc('sciqlopcache_requests_total')
+                return m.to_prometheus()
+
+        request = testing.DummyRequest()
+        request.registry.amda = _Amda()
+        response = metrics(request)
+        self.assertEqual(response.content_type, 'text/plain')
+        self.assertIn(b'sciqlopcache_requests_total 1', response.body)
+
 
 class FunctionalTests(unittest.TestCase):
     def setUp(self):
@@ -31,3 +47,151 @@ class FunctionalTests(unittest.TestCase):
     def test_auth(self):
         res = [self.testapp.get('/php/rest/auth.php', status=200).body for i in range(10)]
         self.assertTrue(res[1:]!=res[:-1])
+
+
+class DataRouteTests(unittest.TestCase):
+    def setUp(self):
+        import json
+        import shutil
+        import tempfile
+        from urllib.parse import urlsplit
+        from webtest import TestApp
+        from sciqlopcache import main
+        from .fake_amda import FakeAMDA
+        self.fake = FakeAMDA()
+        self.fake.start()
+        self.data_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_folder)
+        self.app = main({}, amda_cache_folder=self.data_folder, amda_server_url=self.fake.url,
+                        data_encodings='zstd gzip')
+        self.app.registry.amda._unpack_inventory(self.fake.inventory())
+        self.testapp = TestApp(self.app)
+        res = self.testapp.get('/php/rest/getParameter.php', params={
+            'startTime': '2006-01-08T01:00:00', 'stopTime': '2006-01-08T02:00:00', 'parameterID': 'fake_b'})
+        self.path = urlsplit(json.loads(res.text)['dataFileURLs']).path
+        self.body = self.testapp.get(self.path).body
+
+    def tearDown(self):
+        # CachedAMDA saves itself when collected, before the cleanup removes its folder
+        del self.app.registry.amda
+        self.fake.stop()
+
+    def test_range(self):
+        res = self.testapp.get(self.path, headers={'Range': 'bytes=100-199'}, status=206)
+        self.assertEqual(res.body, self.body[100:200])
+        self.assertEqual(res.headers['Content-Range'], f'bytes 100-199/{len(self.body)}')
+        res = self.testapp.get(self.path, headers={'Range': f'bytes={len(self.body) - 10}-'}, status=206)
+        self.assertEqual(res.body, self.body[-10:])
+        self.testapp.get(self.path, headers={'Range': f'bytes={len(self.body) + 10}-'}, status=416)
+
+    def test_conditional_get(self):
+        res = self.testapp.get(self.path)
+        self.assertTrue(res.etag)
+        self.testapp.get(self.path, headers={'If-None-Match': f'"{res.etag}"'}, status=304)
+        self.testapp.get(self.path, headers={'If-Modified-Since': res.headers['Last-Modified']}, status=304)
+        res = self.testapp.get(self.path, headers={'If-None-Match': '"other"'}, status=200)
+        self.assertEqual(res.body, self.body)
+
+    def _raw_get(self, headers):
+        # webtest transparently decodes gzip bodies
+        from webob import Request
+        return Request.blank(self.path, headers=headers).get_response(self.app)
+
+    def test_gzip(self):
+        import gzip
+        res = self._raw_get({'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.body), self.body)
+        self.assertLess(len(res.body), len(self.body))
+        self.assertTrue(res.etag.endswith('-gzip'))
+        res = self._raw_get({'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'})
+        self.assertEqual(res.status_code, 206)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(res.body, self.body[:10])
+
+    def test_zstd(self):
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest('zstandard is not installed')
+        res = self._raw_get({'Accept-Encoding': 'zstd, gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'zstd')
+        self.assertEqual(zstandard.ZstdDecompressor().decompressobj().decompress(res.body), self.body)
+
+    def test_join(self):
+        import json
+        from urllib.parse import urlsplit
+        res = self.testapp.get('/join', params={
+            'startTime': '2006-01-08T01:00:00', 'stopTime': '2006-01-08T01:10:00', 'parameterID': 'fake_b',
+            'step': '60', 'method': 'linear'})
+        body = self.testapp.get(urlsplit(json.loads(res.text)['dataFileURLs']).path).text
+        lines = body.splitlines()
+        self.assertIn('# COLUMNS : time fake_b[0] fake_b[1] fake_b[2]', lines)
+        data = [line.split() for line in lines if not line.startswith('#')]
+        self.assertEqual(len(data), 11)
+        self.assertEqual(data[0][0], '2006-01-08T01:00:00')
+        self.testapp.get('/join', params={'startTime': '2006-01-08T01:00:00', 'stopTime': '2006-01-08T01:10:00',
+                                          'parameterID': 'fake_b', 'step': '60', 'method': 'bogus'}, status=400)
+
+    def test_upstream_errors(self):
+        import json
+        amda = self.app.registry.amda
+        self.fake.failures = 1 + amda.scheduler.retries
+        amda.scheduler.retry_delay = 0.01
+        res = self.testapp.get('/php/rest/getParameter.php', params={
+            'startTime': '2006-01-09T01:00:00', 'stopTime': '2006-01-09T02:00:00', 'parameterID': 'fake_b'},
+            status=502)
+        self.assertFalse(json.loads(res.text)['success'])
+
+    def test_data_encodings(self):
+        from sciqlopcache import data_encodings
+        self.assertEqual(data_encodings({'data_encodings': 'gzip bogus'}), ['gzip'])
+        self.assertEqual(data_encodings({}), [])
+
+
+class AdminRouteTests(unittest.TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from webtest import TestApp
+        from sciqlopcache import main
+        from .fake_amda import FakeAMDA
+        self.fake = FakeAMDA()
+        self.fake.start()
+        self.data_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_folder)
+        self.app = main({}, amda_cache_folder=self.data_folder, amda_server_url=self.fake.url, admin_token='secret')
+        self.app.registry.amda._unpack_inventory(self.fake.inventory())
+        self.testapp = TestApp(self.app)
+        self.auth = {'Authorization': 'Bearer secret'}
+
+    def tearDown(self):
+        del self.app.registry.amda
+        self.fake.stop()
+
+    def test_token(self):
+        self.testapp.get('/admin/stats', status=403)
+        self.testapp.get('/admin/stats', headers={'Authorization': 'Bearer wrong'}, status=403)
+        self.assertEqual(self.testapp.get('/admin/stats', headers=self.auth).json, [])
+
+    def test_actions(self):
+        params = {'parameter': 'fake_b', 'startTime': '2006-01-08T01:00:00', 'stopTime': '2006-01-08T02:00:00'}
+        res = self.testapp.post('/admin/prefill', params, headers=self.auth)
+        self.assertEqual(res.json['requests'], 1)
+        stats = self.testapp.get('/admin/stats', {'parameter': 'fake_b'}, headers=self.auth).json
+        self.assertEqual(stats[0]['chunks'], 1)
+        res = self.testapp.post('/admin/compact', {'parameter': 'fake_b'}, headers=self.auth)
+        self.assertEqual(res.json['removed'], 0)
+        res = self.testapp.post('/admin/evict', {'parameter': 'fake_b'}, headers=self.auth)
+        self.assertEqual(res.json['removed'], 1)
+        self.testapp.post('/admin/prefill', {'parameter': 'fake_b'}, headers=self.auth, status=400)
+        self.testapp.post('/admin/bogus', {'parameter': 'fake_b'}, headers=self.auth, status=404)
+
+    def test_disabled_without_token(self):
+        from sciqlopcache import main
+        from webtest import TestApp
+        app = main({}, amda_cache_folder=self.data_folder)
+        try:
+            TestApp(app).get('/admin/stats', headers=self.auth, status=404)
+        finally:
+            del app.registry.amda
@@ -0,0 +1,103 @@
+"""Pre-rendered AMDA text of cached chunks.
+
+Next to a chunk file '<chunk>', '<chunk>.txt' holds its rows rendered as AMDA text lines and '<chunk>.idx.npy' the
+time (int64 ns) and byte offset of each line, plus the end offset. Any time range of the chunk is then a byte range of
+the text file, copied to the answer without parsing or formatting anything. Indexes are uncompressed and memory
+mapped when read, so looking them up costs no more than the pages touched, kept in the OS page cache.
+"""
+import io
+import os
+from typing import Tuple
+
+import numpy as np
+import pandas as pds
+
+from .chunk_codecs import atomic_write
+
+TEXT_SUFFIX = '.txt'
+INDEX_SUFFIX = '.idx.npy'
+# compressed indexes of older versions, only ever removed
+LEGACY_INDEX_SUFFIX = '.npz'
+SIDECAR_SUFFIXES = (TEXT_SUFFIX, INDEX_SUFFIX, LEGACY_INDEX_SUFFIX)
+# padding of the times row, past any row time
+_END = np.iinfo(np.int64).max
+
+
+def render_table(df: pds.DataFrame) -> bytes:
+    """The historical text answer: ISO 8601 time then the values with 3 decimals (pandas' default for single column
+    parameters), in columns aligned over the whole of df. Alignment depends on every row, so it can't be pre-rendered.
+    """
+    if not len(df):
+        return b''
+    df = df.set_axis(df.index.map(lambda t: t.isoformat()))
+    return df.to_string(index_names=False, header=False,
+                        formatters={i: "{:.3f}".format for i in range(1, df.shape[1])}).encode()
+
+
+def render_text(df: pds.DataFrame, na_rep: str = '') -> bytes:
+    """One line per row: ISO 8601 time then each value with 3 decimals, space separated.
+    Same times as render_table but unaligned, so that any range of rows renders the same whatever surrounds it.
+    """
+    if not len(df):
+        return b''
+    # like isoformat, fractional seconds only when there are some
+    whole_seconds = not (df.index.microsecond.any() or df.index.nanosecond.any())
+    date_format = '%Y-%m-%dT%H:%M:%S' if whole_seconds else '%Y-%m-%dT%H:%M:%S.%f'
+    return df.to_csv(sep=' ', header=False, float_format='%.3f', date_format=date_format,
+                     lineterminator='\n', na_rep=na_rep).encode()
+
+
+def write_text_chunk(fname: str, df: pds.DataFrame) -> int:
+    """Writes the text and row index of the chunk fname holding df, returns the text size"""
+    text = render_text(df)
+    buffer = np.frombuffer(text, dtype=np.uint8)
+    offsets = np.concatenate(([0], np.flatnonzero(buffer == ord('\n')) + 1)).astype(np.int64)
+    times = np.append(df.index.values.astype('datetime64[ns]').view(np.int64), _END)
+    index = io.BytesIO()
+    np.save(index, np.stack([times, offsets]))
+    atomic_write(fname + TEXT_SUFFIX, text)
+    atomic_write(fname + INDEX_SUFFIX, index.getvalue())
+    if os.path.exists(fname + LEGACY_INDEX_SUFFIX):
+        os.remove(fname + LEGACY_INDEX_SUFFIX)
+    return len(text)
+
+
+def read_text_index(fname: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Row times (padded with one value past them all) and offsets of the text of chunk fname, memory mapped"""
+    index = np.load(fname + INDEX_SUFFIX, mmap_mode='r')
+    if index.ndim != 2 or index.shape[0] != 2:
+        raise ValueError(f"{fname + INDEX_SUFFIX} is not a text index")
+    return index[0], index[1]
+
+
+def text_range(fname: str, start_time, stop_time) -> Tuple[int, int]:
+    """(offset, size) of the lines of chunk fname in [start_time, stop_time]"""
+    times, offsets = read_text_index(fname)
+    first = np.searchsorted(times, np.datetime64(start_time, 'ns').astype(np.int64), side='left')
+    last = np.searchsorted(times, np.datetime64(stop_time, 'ns').astype(np.int64), side='right')
+    return int(offsets[first]), int(offsets[max(first, last)] - offsets[first])
+
+
+def copy_range(out, fname: str, offset: int, size: int):
+    """Appends size bytes of fname starting at offset to the binary file out, with sendfile when possible"""
+    with open(fname, 'rb') as f:
+        try:
+            out_fd = out.fileno()
+        except (OSError, ValueError):
+            out_fd = None
+        if out_fd is not None and hasattr(os, 'sendfile'):
+            out.flush()
+            while size > 0:
+                sent = os.sendfile(out_fd, f.fileno(), offset, size)
+                if sent == 0:
+                    raise EOFError(f"{fname} is shorter than expected")
+                offset += sent
+                size -= sent
+            return
+        f.seek(offset)
+        while size > 0:
+            block = f.read(min(size, 1 << 20))
+            if not block:
+                raise EOFError(f"{fname} is shorter than expected")
+            out.write(block)
+            size -= len(block)
@@ -1,10 +1,20 @@
+import hmac
+import json
 import os
+import zlib
+from datetime import datetime, timedelta
 from tempfile import NamedTemporaryFile
 
+from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden, HTTPNotFound
 from pyramid.view import view_config
-from pyramid.response import Response, FileResponse
+from pyramid.response import Response, FileResponse, FileIter
 import uuid
 
+from .cached_amda import UpstreamError
+from .datetime_range import DateTimeRange
+from .join import check_method
+from .text_chunks import render_text
+
 import logging
 log = logging.getLogger(__name__)
 
@@ -33,10 +43,23 @@ def get_parameter(request):
         params.append(value)
 
     log.debug(f'New request with params {params}')
-    txt = request.registry.amda.get_parameter_as_txt(*params)
-    log.debug(f'Got data!')
-    with NamedTemporaryFile(delete=False, mode='w') as ofile:
-        ofile.write(txt)
+    return _data_file_response(request, lambda ofile: request.registry.amda.write_parameter_as_txt(*params, ofile))
+
+
+def _data_file_response(request, write):
+    """Has write fill a temporary file served on the data route and answers its URL the way AMDA does"""
+    with NamedTemporaryFile(delete=False, mode='wb') as ofile:
+        try:
+            write(ofile)
+        except UpstreamError as e:
+            log.warning(f'''{e}''')
+            ofile.close()
+            os.remove(ofile.name)
+            return Response(
+                status=502,
+                content_type="text/plain",
+                body=json.dumps({'success': False, 'status': 'error', 'message': str(e)}).encode())
+        log.debug(f'Got data!')
         request.registry.tmp_files.append(ofile.name)
         while len(request.registry.tmp_files)>10:
             f = request.registry.tmp_files.pop(0)
@@ -50,10 +73,165 @@ def get_parameter(request):
         )
 
 
+@view_config(route_name='join', renderer='json')
+def join(request):
+    """Parameters (comma separated parameterID) resampled every `step` seconds with `method`, one line per grid
+    point with the values of each parameter, nan where there is none within `tolerance` seconds
+    """
+    try:
+        start_time = datetime.fromisoformat(request.params['startTime'])
+        stop_time = datetime.fromisoformat(request.params['stopTime'])
+        parameter_ids = [p for p in request.params['parameterID'].split(',') if p]
+        step = timedelta(seconds=float(request.params['step']))
+        method = request.params.get('method', 'nearest')
+        check_method(method)
+        tolerance = timedelta(seconds=float(request.params['tolerance'])) if 'tolerance' in request.params else None
+    except (KeyError, ValueError) as e:
+        raise HTTPBadRequest(f'expected startTime, stopTime, parameterID, step and optional method and tolerance: {e}')
+    if not parameter_ids or step <= timedelta(0):
+        raise HTTPBadRequest('parameterID must name at least one parameter and step be positive')
+
+    def write(ofile):
+        df = request.registry.amda.get_joined(start_time, stop_time, parameter_ids, step, method, tolerance)
+        ofile.write(f'# PARAMETERS : {",".join(parameter_ids)}\n'
+                    f'# METHOD : {method}\n'
+                    f'# STEP : {step.total_seconds():g}\n'
+                    f'# INTERVAL_START : {start_time.isoformat()}\n'
+                    f'# INTERVAL_STOP : {stop_time.isoformat()}\n'
+                    f'# COLUMNS : time {" ".join(str(c) for c in df.columns)}\n'.encode())
+        ofile.write(render_text(df, na_rep='nan'))
+
+    return _data_file_response(request, write)
+
+
+@view_config(route_name='metrics')
+def metrics(request):
+    return Response(
+        content_type="text/plain",
+        charset="utf-8",
+        body=request.registry.amda.metrics_as_prometheus().encode()
+    )
+
+
+def _check_admin(request):
+    """Admin routes only exist when admin_token is set and need it as a bearer token"""
+    token = request.registry.settings.get('admin_token') if request.registry.settings else None
+    if not token:
+        raise HTTPNotFound()
+    given = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(given.encode(), f'Bearer {token}'.encode()):
+        raise HTTPForbidden()
+
+
+@view_config(route_name='admin_stats', renderer='json', request_method='GET')
+def admin_stats(request):
+    _check_admin(request)
+    amda = request.registry.amda
+    parameters = request.params.getall('parameter')
+    if parameters:
+        return [amda.parameter_stats(parameter_id) for parameter_id in parameters]
+    return amda.stats()
+
+
+@view_config(route_name='admin_action', renderer='json', request_method='POST')
+def admin_action(request):
+    _check_admin(request)
+    action = request.matchdict['action']
+    if action not in ('compact', 'evict', 'prefill'):
+        raise HTTPNotFound(f'unknown action {action}')
+    parameter_id = request.params.get('parameter')
+    if not parameter_id:
+        raise HTTPBadRequest('missing parameter')
+    if action == 'prefill':
+        try:
+            dt_range = DateTimeRange(datetime.fromisoformat(request.params['startTime']),
+                                     datetime.fromisoformat(request.params['stopTime']))
+        except (KeyError, ValueError) as e:
+            raise HTTPBadRequest(f'startTime and stopTime must be ISO 8601 times: {e}')
+    amda = request.registry.amda
+    if action == 'compact':
+        result = {'removed': amda.compact(parameter_id)}
+    elif action == 'evict':
+        result = {'removed': amda.evict(parameter_id)}
+    else:
+        result = {'requests': amda.fetch_missing(parameter_id, dt_range)}
+    amda._save()
+    return dict(result, parameter=parameter_id, action=action)
+
+
+_BLOCK_SIZE = 1 << 16
+
+
+def _zstd_compressor():
+    import zstandard
+    return zstandard.ZstdCompressor(level=3).compressobj()
+
+
+# Content-Encoding name -> streaming compressor factory
+DATA_ENCODERS = {
+    'gzip': lambda: zlib.compressobj(6, zlib.DEFLATED, 31),
+    'zstd': _zstd_compressor,
+}
+
+
+class RangeFileIter(FileIter):
+    """FileIter seeking to the requested range instead of reading and dropping what precedes it"""
+
+    def app_iter_range(self, start, stop):
+        self.file.seek(start)
+        remaining = stop - start
+        try:
+            while remaining > 0:
+                block = self.file.read(min(self.block_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+        finally:
+            self.file.close()
+
+
+def _encoded_iter(f, encoding):
+    compressor = DATA_ENCODERS[encoding]()
+    try:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            block = compressor.compress(block)
+            if block:
+                yield block
+        yield compressor.flush()
+    finally:
+        f.close()
+
+
+def _data_encoding(request):
+    """Preferred Content-Encoding among the enabled ones, None for identity"""
+    encodings = getattr(request.registry, 'data_encodings', ())
+    if not encodings or 'Accept-Encoding' not in request.headers:
+        return None
+    accepted = request.accept_encoding.acceptable_offers(list(encodings))
+    return accepted[0][0] if accepted else None
+
+
 @view_config(route_name='data', renderer='json')
 def data(request):
     datafile = '/'+'/'.join(request.matchdict['file'])
     if datafile != 'None' and os.path.exists(datafile):
-        return FileResponse(datafile)
+        # ranges apply to the identity representation, compressing is only worth it for whole files
+        encoding = None if request.range is not None else _data_encoding(request)
+        plain = request.range is None and encoding is None
+        response = FileResponse(datafile, request=request if plain else None)
+        stat = os.stat(datafile)
+        response.etag = f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+        if getattr(request.registry, 'data_encodings', ()):
+            response.vary = ('Accept-Encoding',)
+        if request.range is not None:
+            response.app_iter = RangeFileIter(response.app_iter.file, _BLOCK_SIZE)
+            response.content_length = stat.st_size
+        elif encoding is not None:
+            response.app_iter = _encoded_iter(response.app_iter.file, encoding)
+            response.content_length = None
+            response.content_encoding = encoding
+            response.etag = f'{response.etag}-{encoding}'
+        return response
     else:
         return Response('Bad request.'+datafile)
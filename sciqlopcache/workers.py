@@ -0,0 +1,76 @@
+"""CPU bound work run in worker processes.
+
+Parsing AMDA text and rendering it back hold the GIL, so in a threaded server one large request stalls all the
+others. The functions below are run by a WorkerPool in separate processes; they only exchange file names, ranges and
+a few numbers with the server, data goes through chunk files and never gets pickled.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from typing import Callable, Optional, Tuple
+
+import pandas as pds
+
+from .chunk_codecs import atomic_write, read_chunk, write_chunk
+from .text_chunks import render_text, write_text_chunk
+
+
+def parse_amda_csv(source) -> Optional[pds.DataFrame]:
+    """Parses an AMDA text answer (URL, path or file object), None when it holds no data"""
+    try:
+        return pds.read_csv(source, delim_whitespace=True, comment='#', parse_dates=True,
+                            infer_datetime_format=True, index_col=0, header=None)
+    except pds.errors.EmptyDataError:
+        return None
+
+
+def fetch_to_chunk(url: str, fname: str, codec: str, meta: dict,
+                   text: bool = False) -> Optional[Tuple[int, int]]:
+    """Downloads and parses the AMDA answer at url into the chunk file fname (and its text sidecars when text),
+    returns its (size, checksum) or None if the answer is empty
+    """
+    df = parse_amda_csv(url)
+    if df is None or not len(df):
+        return None
+    size, checksum = write_chunk(fname, df, codec, meta)
+    if text:
+        write_text_chunk(fname, df)
+    return size, checksum
+
+
+def render_chunk(fname: str, size: Optional[int], checksum: Optional[int], start_time: datetime,
+                 stop_time: datetime, out_fname: str) -> int:
+    """Writes the rows of chunk fname in [start_time, stop_time] as AMDA text lines to out_fname, returns its size"""
+    df = read_chunk(fname, size, checksum)
+    text = render_text(df[start_time:stop_time])
+    atomic_write(out_fname, text)
+    return len(text)
+
+
+class WorkerPool:
+    """Process pool started on first use, with spawned processes since the server is multi-threaded"""
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self._get_executor().submit(fn, *args)
+
+    def run(self, fn: Callable, *args):
+        return self.submit(fn, *args).result()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
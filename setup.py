@@ -40,10 +40,16 @@ setup(name='sciqlopcache',
       zip_safe=False,
       extras_require={
           'testing': tests_require,
+          'compression': ['zstandard', 'lz4'],
+          's3': ['boto3'],
       },
       install_requires=requires,
       entry_points="""\
       [paste.app_factory]
       main = sciqlopcache:main
+      [console_scripts]
+      sciqlopcache_prefill = sciqlopcache.scripts.prefill:main
+      sciqlopcache_fsck = sciqlopcache.scripts.fsck:main
+      sciqlopcache_admin = sciqlopcache.scripts.admin:main
       """,
       )